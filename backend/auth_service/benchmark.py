@@ -0,0 +1,103 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+import httpx
+import numpy as np
+from fastapi import HTTPException
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import user_cache
+from database import SQLALCHEMY_DATABASE_URL
+from models import User
+from main import app, lifespan
+
+# 进程内 (ASGI) 压测 /users/me 与 /token 的吞吐：
+#   me-sync    : 改造前的实现 (同步 def 接口 + 同步 SQLAlchemy，在线程池中执行)，临时挂到 app 上对照
+#   me-nocache : 异步 SQLAlchemy，每次查库
+#   me-cached  : 异步 SQLAlchemy + 读穿缓存
+#   login      : 登录 (查库 + Argon2 进程池校验)
+# 需要可用的 DATABASE_URL 与 REDIS_URL；示例：
+#   DATABASE_URL=sqlite:////tmp/auth_bench.db?check_same_thread=false python benchmark.py
+
+HEADERS = {"X-Internal-Key": os.getenv("INTERNAL_API_KEY") or ""}
+
+
+async def run_load(name: str, call, requests: int, concurrency: int):
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            start = time.perf_counter()
+            status = await call(i)
+            latencies.append(time.perf_counter() - start)
+            errors += status != 200
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies = np.array(latencies) * 1000
+    return {
+        "scenario": name,
+        "requests": requests,
+        "rps": round(requests / elapsed, 1),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 2),
+        "errors": errors,
+    }
+
+
+async def main(args):
+    usernames = [f"bench_user_{i}" for i in range(args.users)]
+    # 改造前的同步实现，作为对照
+    sync_engine = create_engine(SQLALCHEMY_DATABASE_URL)
+    SyncSession = sessionmaker(bind=sync_engine)
+
+    def read_users_me_sync(username: str):
+        with SyncSession() as db:
+            user = db.query(User).filter(User.username == username).first()
+            if user is None:
+                raise HTTPException(status_code=404, detail="User not found")
+            return {"id": user.id, "username": user.username, "balance": user.balance}
+
+    app.add_api_route("/bench/users/me-sync", read_users_me_sync, methods=["GET"])
+
+    async with lifespan(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://auth") as client:
+            for username in usernames:
+                await client.post("/register", json={"username": username, "password": "bench"}, headers=HEADERS)
+
+            async def me_sync(i):
+                resp = await client.get("/bench/users/me-sync", params={"username": usernames[i % len(usernames)]})
+                return resp.status_code
+
+            async def me(i):
+                resp = await client.get("/users/me", params={"username": usernames[i % len(usernames)]}, headers=HEADERS)
+                return resp.status_code
+
+            async def login(i):
+                resp = await client.post("/token", json={"username": usernames[i % len(usernames)], "password": "bench"},
+                                         headers=HEADERS)
+                return resp.status_code
+
+            results = [await run_load("me-sync", me_sync, args.requests, args.concurrency)]
+            user_cache.USER_CACHE_ENABLED = False
+            results.append(await run_load("me-nocache", me, args.requests, args.concurrency))
+            user_cache.USER_CACHE_ENABLED = True
+            results.append(await run_load("me-cached", me, args.requests, args.concurrency))
+            results.append(await run_load("login", login, args.login_requests, args.concurrency))
+    sync_engine.dispose()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="auth_service /users/me 与登录吞吐对比")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--login-requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=50)
+    asyncio.run(main(parser.parse_args()))
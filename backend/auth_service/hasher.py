@@ -0,0 +1,73 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from prometheus_client import Counter, Gauge, Histogram
+from utils import get_password_hash, verify_and_update_password
+
+# Argon2 是刻意设计的 CPU/内存密集计算，放在默认线程池里会与其它请求争抢。
+# 这里用独立的、大小固定的进程池执行，并限制排队长度：队列满时直接返回 503，而不是让所有请求一起变慢。
+
+ARGON2_WORKERS = int(os.getenv("ARGON2_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+ARGON2_MAX_QUEUE = int(os.getenv("ARGON2_MAX_QUEUE", 32))
+
+HASH_SECONDS = Histogram(
+    "auth_password_hash_seconds",
+    "密码哈希/校验耗时 (含排队)",
+    ["op"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10),
+)
+QUEUE_DEPTH = Gauge("auth_password_queue_depth", "进程池中排队 + 执行中的哈希任务数")
+REJECTED = Counter("auth_password_rejected_total", "进程池已满被拒绝的哈希任务数", ["op"])
+
+
+class HasherOverloaded(Exception):
+    """排队已满，调用方应返回 503"""
+
+
+class PasswordHasher:
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_pending = workers + max_queue
+        self._pending = 0
+        self._executor = None
+
+    def start(self):
+        # spawn 而不是 fork：父进程里已有 OpenTelemetry 等后台线程，fork 后子进程可能死锁
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    async def warm_up(self):
+        # 预先拉起所有子进程，避免第一批登录请求承担进程启动耗时
+        await asyncio.gather(*(self._run("warmup", get_password_hash, "warmup") for _ in range(self.workers)))
+
+    def shutdown(self):
+        if self._executor:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self, op: str, fn, *args):
+        if self._pending >= self.max_pending:
+            REJECTED.labels(op=op).inc()
+            raise HasherOverloaded()
+        self._pending += 1
+        QUEUE_DEPTH.set(self._pending)
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self._pending -= 1
+            QUEUE_DEPTH.set(self._pending)
+            HASH_SECONDS.labels(op=op).observe(time.perf_counter() - start)
+
+    async def hash(self, password: str) -> str:
+        return await self._run("hash", get_password_hash, password)
+
+    async def verify_and_update(self, password: str, hashed_password: str):
+        return await self._run("verify", verify_and_update_password, password, hashed_password)
+
+
+# 全局单例：在 lifespan 中 start()/shutdown()
+password_hasher = PasswordHasher(ARGON2_WORKERS, ARGON2_MAX_QUEUE)
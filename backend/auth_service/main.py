@@ -1,40 +1,48 @@
 from fastapi import FastAPI, Depends, HTTPException, status, Security
-from sqlalchemy.orm import Session
+from contextlib import asynccontextmanager
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
-from database import get_db, engine
+from database import get_db, engine, redis_client
 from models import Base, User
-from utils import get_password_hash, verify_password, create_access_token
+from utils import create_access_token
+from hasher import password_hasher, HasherOverloaded
+from metering import record_usage, cache_balance, flush_loop, flush_pending, CHARGE_SQL
+from user_cache import user_cache, to_profile
+import asyncio
 from fastapi.security import APIKeyHeader
 import os
-from prometheus_fastapi_instrumentator import Instrumentator
-from opentelemetry import trace
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from opentelemetry.sdk.resources import SERVICE_NAME, Resource
-
-# 自动创建表结构 (生产环境建议用 Alembic，这里简化)
-Base.metadata.create_all(bind=engine)
-
-app = FastAPI(title="Auth Service")
-
-# 自动通过 /metrics 接口暴露指标
-Instrumentator().instrument(app).expose(app)
-
-# 设置服务名称
-resource = Resource(attributes={SERVICE_NAME: "auth-service"})
-
-provider = TracerProvider(resource=resource)
-
-# 配置导出器 (发送到 Jaeger 容器的 4317 端口)
-otlp_exporter = OTLPSpanExporter(endpoint="http://jaeger:4317", insecure=True)
-span_processor = BatchSpanProcessor(otlp_exporter)
-provider.add_span_processor(span_processor)
-trace.set_tracer_provider(provider)
-
-# 自动植入 FastAPI
-FastAPIInstrumentor.instrument_app(app)
+from common.observability import instrument_app, start_tracing, shutdown_tracing
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_tracing("auth-service")
+    # 自动创建表结构 (生产环境建议用 Alembic，这里简化)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    # 启动时拉起密码哈希进程池
+    password_hasher.start()
+    await password_hasher.warm_up()
+    print(f"✅ Password hasher pool started ({password_hasher.workers} workers)")
+    # 后台批量落库扣费
+    flush_task = asyncio.create_task(flush_loop())
+    yield
+    flush_task.cancel()
+    try:
+        await flush_pending()
+    except Exception as e:
+        print(f"⚠️ 退出前扣费落库失败: {e}")
+    await redis_client.close()
+    await engine.dispose()
+    password_hasher.shutdown()
+    shutdown_tracing()
+
+
+app = FastAPI(title="Auth Service", lifespan=lifespan)
+
+# 自动通过 /metrics 接口暴露指标；追踪在 lifespan 中按配置启用
+instrument_app(app)
 
 #零信任安全逻辑
 INTERNAL_KEY = os.getenv("INTERNAL_API_KEY")
@@ -71,59 +79,121 @@ class UserInfo(BaseModel):
     balance: float
 
 
+class UsageReport(BaseModel):
+    username: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+# 哈希进程池已满：快速失败，让客户端稍后重试
+overloaded_exception = HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="Auth service is busy, please retry later",
+    headers={"Retry-After": "1"},
+)
+
+
+async def _cache_balance(user: User):
+    # 把余额写入 Redis 供网关做预检查；Redis 不可用时不影响登录/注册
+    try:
+        await cache_balance(user.username, user.balance)
+    except Exception as e:
+        print(f"⚠️ 缓存余额失败: {e}")
+
+
+async def _get_user(db: AsyncSession, username: str):
+    return (await db.execute(select(User).where(User.username == username))).scalar_one_or_none()
+
+
 # --- 接口 ---
+# 密码哈希在独立进程池中执行，数据库使用异步驱动，均不占用事件循环
 @app.post("/register", response_model=UserInfo, dependencies=[Depends(verify_internal_key)])
-def register(user: UserRegister, db: Session = Depends(get_db)):
+async def register(user: UserRegister, db: AsyncSession = Depends(get_db)):
     # 1. 检查用户是否存在
-    db_user = db.query(User).filter(User.username == user.username).first()
+    db_user = await _get_user(db, user.username)
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
 
     # 2. 创建新用户
-    hashed_pwd = get_password_hash(user.password)
+    try:
+        hashed_pwd = await password_hasher.hash(user.password)
+    except HasherOverloaded:
+        raise overloaded_exception
     new_user = User(username=user.username, hashed_password=hashed_pwd)
 
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
+    await user_cache.invalidate(new_user.username)
+    await _cache_balance(new_user)
     return new_user
 
 
 @app.post("/token", response_model=Token, dependencies=[Depends(verify_internal_key)])
-def login_for_access_token(user: UserLogin, db: Session = Depends(get_db)):
-    # 1. 查用户
-    db_user = db.query(User).filter(User.username == user.username).first()
-    if not db_user or not verify_password(user.password, db_user.hashed_password):
+async def login_for_access_token(user: UserLogin, db: AsyncSession = Depends(get_db)):
+    # 1. 查用户 (需要密码哈希，不走资料缓存)
+    db_user = await _get_user(db, user.username)
+    verified, new_hash = False, None
+    if db_user:
+        try:
+            verified, new_hash = await password_hasher.verify_and_update(user.password, db_user.hashed_password)
+        except HasherOverloaded:
+            raise overloaded_exception
+    if not verified:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    # 2. 签发 Token (把用户ID和用户名存进 Token)
+    # 2. Argon2 参数已调整：用本次登录的明文按新参数重算哈希
+    if new_hash:
+        db_user.hashed_password = new_hash
+        await db.commit()
+
+    await _cache_balance(db_user)
+
+    # 3. 签发 Token (把用户ID和用户名存进 Token)
     access_token = create_access_token(data={"sub": db_user.username, "user_id": db_user.id})
     return {"access_token": access_token, "token_type": "bearer"}
 
 
 @app.get("/users/me", response_model=UserInfo, dependencies=[Depends(verify_internal_key)])
-def read_users_me(username: str, db: Session = Depends(get_db)):
-    # 这个接口主要供 Gateway 验证 Token 后调用，获取最新余额
-    user = db.query(User).filter(User.username == username).first()
+async def read_users_me(username: str, db: AsyncSession = Depends(get_db)):
+    # 这个接口主要供 Gateway 验证 Token 后调用，获取最新余额 (读穿缓存，余额变化时失效)
+    async def load():
+        db_user = await _get_user(db, username)
+        return to_profile(db_user) if db_user else None
+
+    user = await user_cache.get(username, load)
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return user
 
 
-# 简单扣费接口 (供 Gateway/Billing 调用)
+# 简单扣费接口 (供 Gateway/Billing 调用)：条件 UPDATE 保证并发下不会扣成负数
 @app.post("/users/{user_id}/deduct", dependencies=[Depends(verify_internal_key)])
-def deduct_balance(user_id: int, amount: float, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == user_id).first()
+async def deduct_balance(user_id: int, amount: float, db: AsyncSession = Depends(get_db)):
+    user = (await db.execute(select(User).where(User.id == user_id))).scalar_one_or_none()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    if user.balance < amount:
+    result = await db.execute(CHARGE_SQL, {"username": user.username, "amount": amount})
+    await db.commit()
+    if result.rowcount == 0:
         raise HTTPException(status_code=402, detail="Insufficient balance")  # 402 Payment Required
 
-    user.balance -= amount
-    db.commit()
-    return {"status": "success", "new_balance": user.balance}
\ No newline at end of file
+    await db.refresh(user)
+    await user_cache.invalidate(user.username)
+    await _cache_balance(user)
+    return {"status": "success", "new_balance": user.balance}
+
+
+# 用量上报 (供 LLM Service 在每次回答结束后调用)：只在 Redis 里原子累加，由后台任务批量落库
+@app.post("/usage", dependencies=[Depends(verify_internal_key)])
+async def report_usage(report: UsageReport):
+    try:
+        amount = await record_usage(report.username, report.prompt_tokens, report.completion_tokens)
+        return {"status": "accepted", "amount": amount}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,131 @@
+import asyncio
+import os
+from prometheus_client import Counter, Histogram
+from sqlalchemy import bindparam, text
+from database import SessionLocal, redis_client
+from user_cache import user_cache
+
+# 计费流水线：
+# 1. LLM Service 每次回答结束后上报 token 用量，这里按单价折算金额，用 Redis HINCRBYFLOAT 原子累加到 billing:{username}.pending
+# 2. 后台任务定期批量取出待扣金额，在一个 MySQL 事务里执行条件扣减 (UPDATE ... WHERE balance >= ?)，再回写缓存余额
+# 3. 网关在调用模型前读取 billing:{username} 的 balance - pending 做余额预检查，余额不足直接拒绝
+# billing:{username} 是一个 Hash：balance (最近一次从 MySQL 读到的余额) / pending (尚未落库的扣费)，
+# 每次写入都刷新 TTL，长期不活跃的用户自动过期 (网关读不到时放行，登录时重新写入)
+
+PRICE_PER_1K_PROMPT_TOKENS = float(os.getenv("PRICE_PER_1K_PROMPT_TOKENS", 0.002))
+PRICE_PER_1K_COMPLETION_TOKENS = float(os.getenv("PRICE_PER_1K_COMPLETION_TOKENS", 0.006))
+BILLING_FLUSH_INTERVAL = float(os.getenv("BILLING_FLUSH_INTERVAL", 2.0))
+BILLING_FLUSH_BATCH = int(os.getenv("BILLING_FLUSH_BATCH", 500))
+BILLING_CACHE_TTL = int(os.getenv("BILLING_CACHE_TTL", 86400))
+
+BILLING_KEY = "billing:{}"
+DIRTY_KEY = "billing:dirty"  # 有待扣金额的用户集合
+# HINCRBYFLOAT 反复加减会留下 1e-17 级别的浮点残差，低于该值视为已结清
+PENDING_EPSILON = 1e-9
+
+# 落库后结清 (KEYS: billing:{username}; ARGV: 已落库金额, 落库后余额 (可为空), TTL)
+# 减去已落库金额后残差归零时删除 pending 字段，避免下一轮把残差当作新扣费
+SETTLE_LUA = """
+local pending = tonumber(redis.call('HINCRBYFLOAT', KEYS[1], 'pending', -tonumber(ARGV[1])))
+if math.abs(pending) < 1e-9 then
+    redis.call('HDEL', KEYS[1], 'pending')
+end
+if ARGV[2] ~= '' then
+    redis.call('HSET', KEYS[1], 'balance', ARGV[2])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+settle_pending = redis_client.register_script(SETTLE_LUA)
+
+CHARGES = Counter("auth_billing_charges_total", "累计到 Redis 的扣费次数")
+FLUSHED = Counter("auth_billing_flushed_total", "批量落库的用户扣费数 (result: charged / insufficient)", ["result"])
+FLUSH_SECONDS = Histogram("auth_billing_flush_seconds", "一次批量落库的耗时",
+                          buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+
+CHARGE_SQL = text("UPDATE users SET balance = balance - :amount WHERE username = :username AND balance >= :amount")
+# 余额不足以覆盖已产生的用量：扣到 0 为止，随后预检查会拒绝该用户的新请求
+DRAIN_SQL = text("UPDATE users SET balance = 0 WHERE username = :username")
+BALANCES_SQL = text("SELECT username, balance FROM users WHERE username IN :names").bindparams(
+    bindparam("names", expanding=True))
+
+
+def usage_cost(prompt_tokens: int, completion_tokens: int) -> float:
+    return (prompt_tokens * PRICE_PER_1K_PROMPT_TOKENS + completion_tokens * PRICE_PER_1K_COMPLETION_TOKENS) / 1000
+
+
+async def cache_balance(username: str, balance: float):
+    key = BILLING_KEY.format(username)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hset(key, "balance", balance)
+    pipe.expire(key, BILLING_CACHE_TTL)
+    await pipe.execute()
+
+
+async def record_usage(username: str, prompt_tokens: int, completion_tokens: int) -> float:
+    amount = usage_cost(prompt_tokens, completion_tokens)
+    if amount <= 0:
+        return 0.0
+    key = BILLING_KEY.format(username)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hincrbyfloat(key, "pending", amount)
+    pipe.expire(key, BILLING_CACHE_TTL)
+    pipe.sadd(DIRTY_KEY, username)
+    await pipe.execute()
+    CHARGES.inc()
+    return amount
+
+
+async def _apply_charges(charges: dict) -> tuple:
+    """在一个事务里执行所有用户的条件扣减，返回 (扣减后余额, 余额不足的用户)"""
+    insufficient = []
+    async with SessionLocal() as db:
+        for username, amount in charges.items():
+            result = await db.execute(CHARGE_SQL, {"username": username, "amount": amount})
+            if result.rowcount == 0:
+                insufficient.append(username)
+                await db.execute(DRAIN_SQL, {"username": username})
+        rows = (await db.execute(BALANCES_SQL, {"names": list(charges)})).all()
+        await db.commit()
+    return {username: balance for username, balance in rows}, insufficient
+
+
+async def flush_pending():
+    """把 Redis 中累计的扣费批量写入 MySQL"""
+    users = await redis_client.spop(DIRTY_KEY, BILLING_FLUSH_BATCH)
+    if not users:
+        return
+    pipe = redis_client.pipeline(transaction=False)
+    for username in users:
+        pipe.hget(BILLING_KEY.format(username), "pending")
+    charges = {u: float(p) for u, p in zip(users, await pipe.execute()) if p and float(p) > PENDING_EPSILON}
+    if not charges:
+        return
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    try:
+        balances, insufficient = await _apply_charges(charges)
+    except Exception:
+        await redis_client.sadd(DIRTY_KEY, *charges)  # 落库失败：放回集合，下一轮重试
+        raise
+    FLUSH_SECONDS.observe(loop.time() - started)
+    FLUSHED.labels(result="insufficient").inc(len(insufficient))
+    FLUSHED.labels(result="charged").inc(len(charges) - len(insufficient))
+
+    # 只减去本次已落库的金额，期间新增的扣费保留在 pending 里 (对应用户已重新加入 dirty 集合)
+    pipe = redis_client.pipeline(transaction=False)
+    for username, amount in charges.items():
+        await settle_pending(keys=[BILLING_KEY.format(username)],
+                             args=[amount, balances.get(username, ""), BILLING_CACHE_TTL], client=pipe)
+    await pipe.execute()
+    await user_cache.invalidate(*charges)
+
+
+async def flush_loop():
+    while True:
+        await asyncio.sleep(BILLING_FLUSH_INTERVAL)
+        try:
+            await flush_pending()
+        except Exception as e:
+            print(f"⚠️ 扣费落库失败，稍后重试: {e}")
@@ -0,0 +1,106 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+from prometheus_client import Counter
+from database import redis_client
+
+# 用户资料的读穿缓存：进程内 (秒级 TTL，挡住同一用户的高频调用) -> Redis (分钟级 TTL，多实例共享) -> MySQL
+# 余额变化 (扣费落库 / 扣费接口) 与注册时主动失效；进程内条目最多滞后 USER_CACHE_LOCAL_TTL 秒。
+# 失效时递增该用户的版本号，回填前核对版本号：读库之后发生的失效不会被旧数据覆盖
+
+USER_CACHE_ENABLED = os.getenv("USER_CACHE_ENABLED", "true").lower() == "true"
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 300))
+USER_CACHE_LOCAL_TTL = float(os.getenv("USER_CACHE_LOCAL_TTL", 2.0))
+USER_CACHE_LOCAL_MAX = int(os.getenv("USER_CACHE_LOCAL_MAX", 10000))
+
+USER_KEY = "user:{}"
+USER_GEN_KEY = "user:{}:gen"
+USER_GEN_TTL = 86400
+
+# 版本号与读库前一致才回填 (KEYS: 资料, 版本号; ARGV: 读库前的版本号, 资料, TTL)
+FILL_IF_CURRENT_LUA = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+CACHE_REQUESTS = Counter(
+    "auth_user_cache_requests_total",
+    "用户资料缓存查询次数",
+    ["tier", "result"],
+)
+
+
+def to_profile(user) -> dict:
+    # 只缓存对外返回的字段，密码哈希不进缓存
+    return {"id": user.id, "username": user.username, "balance": user.balance}
+
+
+class UserCache:
+    def __init__(self):
+        self._local: "OrderedDict[str, tuple]" = OrderedDict()  # username -> (profile, 过期时间)
+        self._fill = redis_client.register_script(FILL_IF_CURRENT_LUA)
+
+    def _put_local(self, username: str, profile: dict):
+        self._local[username] = (profile, time.monotonic() + USER_CACHE_LOCAL_TTL)
+        self._local.move_to_end(username)
+        if len(self._local) > USER_CACHE_LOCAL_MAX:
+            self._local.popitem(last=False)
+
+    async def get(self, username: str, loader: Callable[[], Awaitable[Optional[dict]]]) -> Optional[dict]:
+        if not USER_CACHE_ENABLED:
+            return await loader()
+
+        entry = self._local.get(username)
+        if entry is not None and entry[1] > time.monotonic():
+            CACHE_REQUESTS.labels(tier="local", result="hit").inc()
+            return entry[0]
+        CACHE_REQUESTS.labels(tier="local", result="miss").inc()
+
+        keys = [USER_KEY.format(username), USER_GEN_KEY.format(username)]
+        try:
+            cached, generation = await redis_client.mget(keys)
+        except Exception as e:
+            print(f"⚠️ 用户缓存读取失败: {e}")
+            cached, generation = None, None
+        if cached is not None:
+            CACHE_REQUESTS.labels(tier="redis", result="hit").inc()
+            profile = json.loads(cached)
+            self._put_local(username, profile)
+            return profile
+        CACHE_REQUESTS.labels(tier="redis", result="miss").inc()
+
+        # 不存在的用户不缓存；读库期间被失效过 (版本号变化) 的结果只返回本次，不回填
+        profile = await loader()
+        if profile is not None:
+            try:
+                filled = await self._fill(keys=keys, args=[generation or "", json.dumps(profile), USER_CACHE_TTL])
+            except Exception as e:
+                print(f"⚠️ 用户缓存写入失败: {e}")
+                filled = 0
+            if filled:
+                self._put_local(username, profile)
+        return profile
+
+    async def invalidate(self, *usernames: str):
+        if not usernames:
+            return
+        for username in usernames:
+            self._local.pop(username, None)
+        try:
+            async with redis_client.pipeline(transaction=True) as pipe:
+                for username in usernames:
+                    pipe.incr(USER_GEN_KEY.format(username))
+                    pipe.expire(USER_GEN_KEY.format(username), USER_GEN_TTL)
+                pipe.delete(*(USER_KEY.format(u) for u in usernames))
+                await pipe.execute()
+        except Exception as e:
+            print(f"⚠️ 用户缓存失效失败: {e}")
+
+
+# 全局单例
+user_cache = UserCache()
@@ -3,8 +3,18 @@ from datetime import datetime, timedelta
 from jose import jwt
 import os
 
-# 1. 密码加密配置
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+# 1. 密码加密配置 (Argon2 参数可配置；参数调整后，旧哈希在用户下次登录时自动按新参数重算)
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", 3))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", 65536))  # KiB
+ARGON2_PARALLELISM = int(os.getenv("ARGON2_PARALLELISM", 4))
+
+pwd_context = CryptContext(
+    schemes=["argon2"],
+    deprecated="auto",
+    argon2__time_cost=ARGON2_TIME_COST,
+    argon2__memory_cost=ARGON2_MEMORY_COST,
+    argon2__parallelism=ARGON2_PARALLELISM,
+)
 
 # 2. JWT 配置
 SECRET_KEY = os.getenv("SECRET_KEY", "unsafe_secret_key")
@@ -17,6 +27,12 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+def verify_and_update_password(plain_password, hashed_password):
+    """
+    返回 (是否匹配, 新哈希)；哈希参数与当前配置不一致时新哈希不为 None，调用方应写回数据库
+    """
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -0,0 +1,96 @@
+import os
+from prometheus_fastapi_instrumentator import Instrumentator
+
+# ==========================================
+# 各服务共用的可观测性初始化
+# - Prometheus：import 时挂载 (中间件只能在应用启动前添加)，通过 /metrics 暴露
+# - OpenTelemetry：未配置 OTEL_EXPORTER_OTLP_ENDPOINT 时为 no-op，不导入 SDK 与导出器；
+#   配置后 import 时只给 FastAPI 挂钩子，TracerProvider 与导出器在 lifespan 中创建
+# ==========================================
+
+# 如 http://jaeger:4317 (grpc) 或 http://jaeger:4318 (http/protobuf)；留空则不追踪
+OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "")
+# grpc 需要 grpcio (opentelemetry-exporter-otlp-proto-grpc)，http/protobuf 不需要
+OTLP_PROTOCOL = os.getenv("OTEL_EXPORTER_OTLP_PROTOCOL", "grpc")
+# 采样策略 (取值同 OpenTelemetry 标准环境变量)：
+#   parentbased_traceidratio (默认)：入口服务按比例采样，下游服务跟随上游的决定，保证链路完整
+#   traceidratio / parentbased_always_on / always_on / always_off
+TRACES_SAMPLER = os.getenv("OTEL_TRACES_SAMPLER", "parentbased_traceidratio")
+TRACES_SAMPLER_ARG = float(os.getenv("OTEL_TRACES_SAMPLER_ARG", 0.1))
+
+_provider = None
+
+
+def tracing_enabled() -> bool:
+    return bool(OTLP_ENDPOINT) and TRACES_SAMPLER != "always_off"
+
+
+def instrument_app(app):
+    """
+    import 时调用：挂载 /metrics；启用追踪时给 FastAPI 挂钩子 (lifespan 中设置 TracerProvider 之后才真正记录 span)
+    """
+    Instrumentator().instrument(app).expose(app)
+    if tracing_enabled():
+        from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+        FastAPIInstrumentor.instrument_app(app)
+
+
+def _build_sampler():
+    from opentelemetry.sdk.trace.sampling import ALWAYS_ON, ParentBased, TraceIdRatioBased
+
+    samplers = {
+        "parentbased_traceidratio": lambda: ParentBased(TraceIdRatioBased(TRACES_SAMPLER_ARG)),
+        "traceidratio": lambda: TraceIdRatioBased(TRACES_SAMPLER_ARG),
+        "parentbased_always_on": lambda: ParentBased(ALWAYS_ON),
+        "always_on": lambda: ALWAYS_ON,
+    }
+    if TRACES_SAMPLER not in samplers:
+        print(f"⚠️ 未知的 OTEL_TRACES_SAMPLER={TRACES_SAMPLER}，使用 parentbased_traceidratio")
+    return samplers.get(TRACES_SAMPLER, samplers["parentbased_traceidratio"])()
+
+
+def _build_exporter():
+    if OTLP_PROTOCOL == "grpc":
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        return OTLPSpanExporter(endpoint=OTLP_ENDPOINT, insecure=True)
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    return OTLPSpanExporter(endpoint=f"{OTLP_ENDPOINT.rstrip('/')}/v1/traces")
+
+
+def start_tracing(service_name: str, instrument_httpx: bool = False):
+    """
+    lifespan 启动时调用：创建 TracerProvider 与导出器。instrument_httpx=True 时对 httpx 调用生成客户端 span，
+    并通过 traceparent 头把 trace 上下文传给下游服务
+    """
+    global _provider
+    if not tracing_enabled() or _provider is not None:
+        return
+    try:
+        exporter = _build_exporter()
+    except ImportError as e:
+        print(f"⚠️ OTLP {OTLP_PROTOCOL} 导出器不可用，追踪已关闭: {e}")
+        return
+
+    from opentelemetry import trace
+    from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+    _provider = TracerProvider(resource=Resource(attributes={SERVICE_NAME: service_name}), sampler=_build_sampler())
+    _provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(_provider)
+
+    if instrument_httpx:
+        from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
+        HTTPXClientInstrumentor().instrument()
+    print(f"✅ Tracing enabled ({OTLP_PROTOCOL} -> {OTLP_ENDPOINT}, {TRACES_SAMPLER}={TRACES_SAMPLER_ARG})")
+
+
+def shutdown_tracing():
+    """
+    lifespan 关闭时调用：导出缓冲中剩余的 span
+    """
+    global _provider
+    if _provider is not None:
+        _provider.shutdown()
+        _provider = None
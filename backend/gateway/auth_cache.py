@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Optional
+from jose import JWTError, jwt
+from prometheus_client import Counter
+from config import settings
+
+# 已验证 JWT 的本地缓存：同一个 Token 只做一次 HMAC 校验与 claims 解析，之后按摘要直接取出 claims，
+# 条目在 Token 的 exp 到期时失效。
+# 吊销列表 (可选) 存在 Redis ZSET 中 (成员=Token 摘要, 分数=exp)，本地保留一份快照，按版本号定期刷新，
+# 请求路径上只做一次集合查找，不访问 Redis。
+
+REVOKED_KEY = "auth:revoked"
+REVOKED_VERSION_KEY = "auth:revoked:version"
+
+JWT_CACHE_REQUESTS = Counter(
+    "gateway_jwt_cache_requests_total",
+    "JWT 校验缓存查询次数 (result: hit / miss / revoked)",
+    ["result"],
+)
+
+
+def token_digest(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class VerifiedTokenCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # digest -> (claims, 过期时间)
+        self.redis = None
+        self._revoked: set = set()
+        self._revoked_version = None
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def bind(self, redis_client):
+        # 复用 lifespan 中创建的 Redis 连接；未绑定时不启用吊销检查
+        self.redis = redis_client
+
+    async def start(self):
+        if self.redis is not None and settings.JWT_REVOCATION_ENABLED:
+            try:
+                await self.refresh_revoked()
+            except Exception as e:
+                print(f"⚠️ Token 吊销列表加载失败，稍后重试: {e}")
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self):
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+    def decode(self, token: str) -> dict:
+        """
+        返回已验证的 claims；校验失败时抛出 JWTError (与 jwt.decode 一致)
+        """
+        digest = token_digest(token)
+        if digest in self._revoked:
+            JWT_CACHE_REQUESTS.labels(result="revoked").inc()
+            raise JWTError("Token has been revoked")
+
+        entry = self._entries.get(digest)
+        if entry is not None:
+            claims, expires_at = entry
+            if time.time() < expires_at:
+                self._entries.move_to_end(digest)
+                JWT_CACHE_REQUESTS.labels(result="hit").inc()
+                return claims
+            del self._entries[digest]
+
+        JWT_CACHE_REQUESTS.labels(result="miss").inc()
+        claims = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        # 没有 exp 的 Token 最多缓存 JWT_CACHE_MAX_TTL 秒
+        expires_at = min(claims.get("exp", float("inf")), time.time() + settings.JWT_CACHE_MAX_TTL)
+        self._entries[digest] = (claims, expires_at)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return claims
+
+    async def revoke(self, token: str, claims: dict):
+        """吊销 Token (登出)：写入 Redis 并立即在本实例生效，其它实例在下次刷新时生效"""
+        digest = token_digest(token)
+        self._revoked.add(digest)
+        self._entries.pop(digest, None)
+        if self.redis is None:
+            return
+        expires_at = claims.get("exp") or time.time() + settings.JWT_CACHE_MAX_TTL
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zadd(REVOKED_KEY, {digest: expires_at})
+        pipe.incr(REVOKED_VERSION_KEY)
+        await pipe.execute()
+
+    async def refresh_revoked(self):
+        # 版本号没变就不重新拉取整个集合
+        version = await self.redis.get(REVOKED_VERSION_KEY)
+        if version == self._revoked_version and version is not None:
+            return
+        now = time.time()
+        await self.redis.zremrangebyscore(REVOKED_KEY, 0, now)  # 已过期的 Token 无需再记录
+        self._revoked = set(await self.redis.zrangebyscore(REVOKED_KEY, now, "+inf"))
+        self._revoked_version = version
+        for digest in self._revoked:
+            self._entries.pop(digest, None)
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(settings.JWT_REVOCATION_REFRESH)
+            try:
+                await self.refresh_revoked()
+            except Exception as e:
+                # Redis 不可用时保留上一次的快照
+                print(f"⚠️ Token 吊销列表刷新失败: {e}")
+
+
+# 全局单例
+token_cache = VerifiedTokenCache(settings.JWT_CACHE_MAX_ENTRIES)
@@ -0,0 +1,48 @@
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+from jose import jwt
+from config import settings
+from auth_cache import VerifiedTokenCache
+
+
+def make_tokens(n: int):
+    # 与 Auth Service 签发的 Token 结构一致 (sub / user_id / exp)
+    expire = datetime.utcnow() + timedelta(days=1)
+    return [
+        jwt.encode({"sub": f"user_{i}", "user_id": i, "exp": expire}, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
+        for i in range(n)
+    ]
+
+
+def measure(name: str, fn, tokens, rounds: int):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for token in tokens:
+            fn(token)
+    elapsed = time.perf_counter() - start
+    calls = rounds * len(tokens)
+    return {"method": name, "calls": calls, "us_per_call": round(elapsed / calls * 1e6, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对比每次 jwt.decode 与已验证 Token 缓存的单次鉴权耗时")
+    parser.add_argument("--tokens", type=int, default=100, help="不同 Token 数 (模拟在线用户数)")
+    parser.add_argument("--rounds", type=int, default=200, help="每个 Token 重复鉴权次数")
+    args = parser.parse_args()
+
+    tokens = make_tokens(args.tokens)
+    cache = VerifiedTokenCache(max_entries=max(args.tokens, 1))
+
+    results = [
+        measure("jwt.decode", lambda t: jwt.decode(t, settings.SECRET_KEY, algorithms=[settings.ALGORITHM]),
+                tokens, args.rounds),
+        measure("cached", cache.decode, tokens, args.rounds),
+    ]
+    results.append({"speedup": round(results[0]["us_per_call"] / results[1]["us_per_call"], 1)})
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+from prometheus_client import Counter
+from config import settings
+
+# 余额预检查：读取 Auth Service 维护的 billing:{username} (balance = 最近落库余额, pending = 未落库扣费)，
+# 余额已用完的用户在调用模型前直接拒绝。没有缓存记录或 Redis 不可用时放行，最终以 MySQL 条件扣减为准。
+
+BILLING_KEY = "billing:{}"
+
+PRECHECK_REJECTED = Counter("gateway_billing_precheck_rejected_total", "余额不足被预检查拒绝的请求数")
+
+
+class BalanceGuard:
+    def __init__(self):
+        self.redis = None
+
+    def bind(self, redis_client):
+        # 复用 lifespan 中创建的 Redis 连接
+        self.redis = redis_client
+
+    async def has_funds(self, username: str) -> bool:
+        if not settings.BILLING_PRECHECK or self.redis is None:
+            return True
+        try:
+            balance, pending = await self.redis.hmget(BILLING_KEY.format(username), "balance", "pending")
+        except Exception as e:
+            print(f"⚠️ 余额预检查失败，放行: {e}")
+            return True
+        if balance is None:
+            return True
+        if float(balance) - float(pending or 0) <= settings.BILLING_MIN_BALANCE:
+            PRECHECK_REJECTED.inc()
+            return False
+        return True
+
+
+# 全局单例
+balance_guard = BalanceGuard()
@@ -1,8 +1,22 @@
 import os
+import json
 from dotenv import load_dotenv
 
 load_dotenv()
 
+
+def _upstream(prefix: str, url: str, timeout: float, max_connections: int, max_keepalive: int):
+    """读取单个上游服务的连接池配置 (环境变量前缀: AUTH_ / LLM_ / KB_)"""
+    return {
+        "base_url": url,
+        "timeout": float(os.getenv(f"{prefix}_TIMEOUT", timeout)),
+        "connect_timeout": float(os.getenv(f"{prefix}_CONNECT_TIMEOUT", 5.0)),
+        "max_connections": int(os.getenv(f"{prefix}_MAX_CONNECTIONS", max_connections)),
+        "max_keepalive_connections": int(os.getenv(f"{prefix}_MAX_KEEPALIVE", max_keepalive)),
+        "keepalive_expiry": float(os.getenv(f"{prefix}_KEEPALIVE_EXPIRY", 30.0)),
+    }
+
+
 class Config:
     LLM_SERVICE_URL = os.getenv("LLM_SERVICE_URL", "http://llm-service:8000")
     KB_SERVICE_URL = os.getenv("KB_SERVICE_URL", "http://kb-service:8000")
@@ -12,4 +26,49 @@ class Config:
     SECRET_KEY = os.getenv("SECRET_KEY", "unsafe_secret_key")
     ALGORITHM = "HS256"
 
-settings = Config()
\ No newline at end of file
+    # 👇 已验证 Token 的本地缓存 (条目在 Token 的 exp 到期时失效) 与 Redis 吊销列表
+    JWT_CACHE_MAX_ENTRIES = int(os.getenv("JWT_CACHE_MAX_ENTRIES", 10000))
+    JWT_CACHE_MAX_TTL = int(os.getenv("JWT_CACHE_MAX_TTL", 3600))
+    JWT_REVOCATION_ENABLED = os.getenv("JWT_REVOCATION_ENABLED", "true").lower() == "true"
+    JWT_REVOCATION_REFRESH = float(os.getenv("JWT_REVOCATION_REFRESH", 5.0))
+
+    # 👇 预取检索：Token 校验通过后、限流的同时提前让 LLM Service 开始检索 (被限流拒绝的请求也会产生检索开销，默认关闭)
+    SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "false").lower() == "true"
+
+    # 👇 Redis (限流 + SSE 续传缓冲)
+    REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+
+    # 👇 限流规则 {路由: {"default" / "role:<角色>" / "user:<用户名>": "次数/秒数"}}，优先级 用户 > 角色 > 默认
+    RATE_LIMITS = json.loads(os.getenv("RATE_LIMITS", json.dumps({
+        "chat": {"default": "10/60", "role:admin": "60/60"},
+    })))
+    # 全局余量高于该比例时只做本地令牌桶判断，命中数每 RATE_LIMIT_SYNC_INTERVAL 秒批量同步到 Redis
+    RATE_LIMIT_LOCAL_HEADROOM = float(os.getenv("RATE_LIMIT_LOCAL_HEADROOM", 0.3))
+    RATE_LIMIT_SYNC_INTERVAL = float(os.getenv("RATE_LIMIT_SYNC_INTERVAL", 1.0))
+    # Redis 超过该耗时或报错时进入降级模式 (仅本地令牌桶)，冷却期后再尝试
+    RATE_LIMIT_REDIS_TIMEOUT = float(os.getenv("RATE_LIMIT_REDIS_TIMEOUT", 0.05))
+    RATE_LIMIT_DEGRADED_COOLDOWN = float(os.getenv("RATE_LIMIT_DEGRADED_COOLDOWN", 10.0))
+    RATE_LIMIT_MAX_SUBJECTS = int(os.getenv("RATE_LIMIT_MAX_SUBJECTS", 100000))
+
+    # 👇 余额预检查：balance - pending 不高于该值时拒绝对话请求 (402)
+    BILLING_PRECHECK = os.getenv("BILLING_PRECHECK", "true").lower() == "true"
+    BILLING_MIN_BALANCE = float(os.getenv("BILLING_MIN_BALANCE", 0.0))
+
+    # 👇 可续传 SSE：每个回答最多缓冲多少个事件、断线后保留多久
+    SSE_BUFFER_MAXLEN = int(os.getenv("SSE_BUFFER_MAXLEN", 5000))
+    SSE_BUFFER_TTL = int(os.getenv("SSE_BUFFER_TTL", 300))
+    SSE_READ_BATCH = int(os.getenv("SSE_READ_BATCH", 100))
+    SSE_KEEPALIVE = float(os.getenv("SSE_KEEPALIVE", 15.0))
+    SSE_IDLE_TIMEOUT = float(os.getenv("SSE_IDLE_TIMEOUT", 120.0))
+
+    # 👇 上游连接池 (长连接复用，避免每个请求都重新握手)
+    UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() == "true"
+    UPSTREAMS = {
+        "auth": _upstream("AUTH", AUTH_SERVICE_URL, timeout=10.0, max_connections=50, max_keepalive=20),
+        # 流式对话耗时较长，超时与连接数都要放宽
+        "llm": _upstream("LLM", LLM_SERVICE_URL, timeout=60.0, max_connections=200, max_keepalive=50),
+        "kb": _upstream("KB", KB_SERVICE_URL, timeout=10.0, max_connections=20, max_keepalive=10),
+    }
+
+
+settings = Config()
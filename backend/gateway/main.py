@@ -1,22 +1,21 @@
 from fastapi import FastAPI, HTTPException, Request, Depends, status
 from fastapi.responses import StreamingResponse, JSONResponse
+from starlette.background import BackgroundTask
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
-from fastapi_limiter import FastAPILimiter
-from fastapi_limiter.depends import RateLimiter
+import asyncio
 import redis.asyncio as redis
-from jose import JWTError, jwt
-import httpx
+from jose import JWTError
 import os
 from config import settings
-from prometheus_fastapi_instrumentator import Instrumentator
-from opentelemetry import trace
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+from upstream import upstreams, UpstreamPoolCollector
+from ratelimit import limiter
+from auth_cache import token_cache
+from billing import balance_guard
+from sse import sse_buffer, iter_upstream_events, parse_last_event_id, spawn, SSE_RESUMES
+from prometheus_client import REGISTRY
+from common.observability import instrument_app, start_tracing, shutdown_tracing
 
 # 读取内部密钥
 INTERNAL_KEY = os.getenv("INTERNAL_API_KEY")
@@ -27,37 +26,41 @@ INTERNAL_KEY = os.getenv("INTERNAL_API_KEY")
 # ==========================================
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # 0. 启动时：按配置启用链路追踪 (对下游的 httpx 调用传递 trace 上下文)
+    start_tracing("gateway-service", instrument_httpx=True)
+
     # 1. 启动时：连接 Redis 用于限流
     # 注意：在 Docker 网络中，主机名是 'redis'，端口 6379
-    redis_connection = redis.from_url("redis://redis:6379/0", encoding="utf-8", decode_responses=True)
-    await FastAPILimiter.init(redis_connection)
-    print("✅ Rate Limiter Initialized via Redis")
+    redis_connection = redis.from_url(settings.REDIS_URL, encoding="utf-8", decode_responses=True)
+    limiter.bind(redis_connection)
+    await limiter.start()
+    print("✅ Rate Limiter Initialized (local token bucket + Redis sliding window)")
+    # 同一个连接也用作 SSE 续传缓冲与 Token 吊销列表
+    sse_buffer.bind(redis_connection)
+    token_cache.bind(redis_connection)
+    balance_guard.bind(redis_connection)
+    await token_cache.start()
+
+    # 2. 启动时：创建上游服务的长连接池
+    await upstreams.start()
 
     yield  # 应用运行中...
 
-    # 2. 关闭时：断开连接
+    # 3. 关闭时：同步剩余限流计数并断开连接
+    await limiter.close()
+    await token_cache.close()
+    await upstreams.close()
     await redis_connection.close()
+    shutdown_tracing()
 
 
 # 初始化 App，注入 lifespan
 app = FastAPI(title="AI API Gateway", lifespan=lifespan)
 
-# 自动通过 /metrics 接口暴露指标
-Instrumentator().instrument(app).expose(app)
-
-# 设置服务名称
-resource = Resource(attributes={SERVICE_NAME: "gateway-service"})
-
-provider = TracerProvider(resource=resource)
-
-# 配置导出器 (发送到 Jaeger 容器的 4317 端口)
-otlp_exporter = OTLPSpanExporter(endpoint="http://jaeger:4317", insecure=True)
-span_processor = BatchSpanProcessor(otlp_exporter)
-provider.add_span_processor(span_processor)
-trace.set_tracer_provider(provider)
-
-# 自动植入 FastAPI
-FastAPIInstrumentor.instrument_app(app)
+# 自动通过 /metrics 接口暴露指标；追踪在 lifespan 中按配置启用
+instrument_app(app)
+# 上游连接池状态 (in_use / idle / waiters) 也一并在 /metrics 暴露
+REGISTRY.register(UpstreamPoolCollector(upstreams))
 
 # 1. CORS 配置
 app.add_middleware(
@@ -66,6 +69,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Stream-Id"],  # 前端断线续传需要读取
 )
 
 # 2. 认证逻辑
@@ -79,7 +83,8 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        # 同一个 Token 只做一次签名校验，之后直接使用缓存的 claims
+        payload = token_cache.decode(token)
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
@@ -88,6 +93,25 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         raise credentials_exception
 
 
+# 限流依赖：按 用户 > 角色 > 路由默认 的规则判断 (规则见 settings.RATE_LIMITS)
+def rate_limit(route: str):
+    async def dependency(user: dict = Depends(get_current_user)):
+        allowed, retry_after = await limiter.check(route, user)
+        if not allowed:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too Many Requests",
+                headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+            )
+    return dependency
+
+
+# 余额预检查：在调用模型之前拒绝余额已用完的用户
+async def require_balance(user: dict = Depends(get_current_user)):
+    if not await balance_guard.has_funds(user['username']):
+        raise HTTPException(status_code=status.HTTP_402_PAYMENT_REQUIRED, detail="Insufficient balance")
+
+
 # 简单的管理员权限检查
 async def get_admin_user(user: dict = Depends(get_current_user)):
     if user.get("role") != "admin":
@@ -108,13 +132,12 @@ def health_check():
 async def register_proxy(request: Request):
     try:
         body = await request.json()
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                f"{settings.AUTH_SERVICE_URL}/register",
-                json=body,
-                headers={"X-Internal-Key": INTERNAL_KEY}
-            )
-            return JSONResponse(content=resp.json(), status_code=resp.status_code)
+        resp = await upstreams.get("auth").post(
+            "/register",
+            json=body,
+            headers={"X-Internal-Key": INTERNAL_KEY}
+        )
+        return JSONResponse(content=resp.json(), status_code=resp.status_code)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -123,13 +146,21 @@ async def register_proxy(request: Request):
 async def login_proxy(request: Request):
     try:
         body = await request.json()
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                f"{settings.AUTH_SERVICE_URL}/token",
-                json=body,
-                headers={"X-Internal-Key": INTERNAL_KEY}
-            )
-            return JSONResponse(content=resp.json(), status_code=resp.status_code)
+        resp = await upstreams.get("auth").post(
+            "/token",
+            json=body,
+            headers={"X-Internal-Key": INTERNAL_KEY}
+        )
+        return JSONResponse(content=resp.json(), status_code=resp.status_code)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# 登出：吊销当前 Token (写入 Redis 吊销列表，各网关实例在几秒内同步)
+@app.post("/api/auth/logout", status_code=status.HTTP_204_NO_CONTENT)
+async def logout(token: str = Depends(oauth2_scheme), user: dict = Depends(get_current_user)):
+    try:
+        await token_cache.revoke(token, token_cache.decode(token))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -138,49 +169,118 @@ async def login_proxy(request: Request):
 # 4. 业务接口 (RESTful 路由 + 限流 + 零信任)
 # ==========================================
 
+_prefetch_tasks = set()
+
+
+async def speculative_prefetch(request: Request, user: dict = Depends(get_current_user)):
+    """
+    Token 校验通过后、限流与余额检查之前就通知 LLM Service 开始检索，
+    检索与限流/转发重叠，聊天请求到达 LLM Service 时可直接复用结果 (按用户隔离)
+    """
+    if not settings.SPECULATIVE_RETRIEVAL:
+        return
+    try:
+        query = (await request.json()).get("query")
+    except Exception:
+        return
+    if not query:
+        return
+    task = asyncio.create_task(upstreams.get("llm").post(
+        "/conversations/prefetch",
+        json={"query": query, "user_id": user["username"]},
+        headers={"X-Internal-Key": INTERNAL_KEY}
+    ))
+    _prefetch_tasks.add(task)
+    task.add_done_callback(_prefetch_tasks.discard)
+
+
+async def pump_llm_stream(stream, body: dict):
+    """
+    后台读取 LLM Service 的输出并写入续传缓冲。与客户端连接解耦：客户端断线后生成继续，重连可补发。
+    """
+    client = upstreams.get("llm")
+    try:
+        req = client.build_request(
+            "POST",
+            "/conversations/chat",
+            json=body,
+            headers={"X-Internal-Key": INTERNAL_KEY}  # 零信任 Key
+        )
+        response = await client.send(req, stream=True)
+        try:
+            if response.status_code != 200:
+                await stream.append("error", f"Error: {response.status_code}")
+                return
+
+            # 上游已按 SSE 合并成帧 (文本 / error / usage)，按收到的批次写入缓冲并补上事件 ID
+            async for events in iter_upstream_events(response.aiter_text()):
+                await stream.append_many(events)
+        finally:
+            # 共享客户端不会随请求关闭，必须手动归还连接到池中
+            await response.aclose()
+    except Exception as e:
+        try:
+            await stream.append("error", f"Error: {str(e)}")
+        except Exception:
+            pass
+    finally:
+        try:
+            await stream.append("done")
+        except Exception as e:
+            print(f"⚠️ SSE 流 {stream.stream_id} 结束标记写入失败: {e}")
+
+
 # 转发聊天请求 (LLM Service)
-# 🔥 限流策略：每 60 秒最多 10 次请求
-@app.post("/api/conversations/chat", dependencies=[Depends(RateLimiter(times=10, seconds=60))])
+# 🔥 限流策略：默认每用户每 60 秒最多 10 次请求 (可按用户/角色配置)
+@app.post("/api/conversations/chat",
+          dependencies=[Depends(speculative_prefetch), Depends(rate_limit("chat")), Depends(require_balance)])
 async def chat_proxy(request: Request, user: dict = Depends(get_current_user)):
     try:
         body = await request.json()
         body['user_id'] = user['username']
 
-        async def proxy_stream():
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                try:
-                    req = client.build_request(
-                        "POST",
-                        f"{settings.LLM_SERVICE_URL}/conversations/chat",
-                        json=body,
-                        headers={"X-Internal-Key": INTERNAL_KEY}  # 零信任 Key
-                    )
-                    response = await client.send(req, stream=True)
-
-                    if response.status_code != 200:
-                        yield f"Error: {response.status_code}".encode()
-                        return
-
-                    async for chunk in response.aiter_bytes():
-                        yield chunk
-                except Exception as e:
-                    yield f"Error: {str(e)}".encode()
-
-        return StreamingResponse(proxy_stream(), media_type="text/event-stream")
+        stream = await sse_buffer.open(user['username'])
+        spawn(pump_llm_stream(stream, body))
+
+        return StreamingResponse(
+            sse_buffer.events(stream.stream_id),
+            media_type="text/event-stream",
+            headers={"X-Stream-Id": stream.stream_id, "Cache-Control": "no-cache"},
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# 断线续传：带上 Last-Event-ID (请求头或 last_event_id 参数) 重连，补发缺失事件后继续跟随实时输出
+# 不走聊天限流，续传不会重新触发检索与生成
+@app.get("/api/conversations/chat/{stream_id}")
+async def chat_resume(stream_id: str, request: Request, last_event_id: str = None,
+                      user: dict = Depends(get_current_user)):
+    owner = await sse_buffer.owner(stream_id)
+    if owner is None or owner != user['username']:
+        SSE_RESUMES.labels("not_found").inc()
+        raise HTTPException(status_code=404, detail="Stream not found or expired")
+
+    resume_from, seq = parse_last_event_id(request.headers.get("last-event-id") or last_event_id)
+    if resume_from != stream_id:
+        seq = 0
+    SSE_RESUMES.labels("ok").inc()
+    return StreamingResponse(
+        sse_buffer.events(stream_id, seq),
+        media_type="text/event-stream",
+        headers={"X-Stream-Id": stream_id, "Cache-Control": "no-cache"},
+    )
+
+
 # 清空记忆接口
 @app.delete("/api/conversations")
 async def clear_history_proxy(user: dict = Depends(get_current_user)):
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.delete(
-                f"{settings.LLM_SERVICE_URL}/conversations/{user['username']}",
-                headers={"X-Internal-Key": INTERNAL_KEY}
-            )
-            return JSONResponse(status_code=resp.status_code, content={})
+        resp = await upstreams.get("llm").delete(
+            f"/conversations/{user['username']}",
+            headers={"X-Internal-Key": INTERNAL_KEY}
+        )
+        return JSONResponse(status_code=resp.status_code, content={})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -190,12 +290,44 @@ async def clear_history_proxy(user: dict = Depends(get_current_user)):
 async def create_doc_proxy(request: Request, user: dict = Depends(get_admin_user)):
     try:
         body = await request.json()
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                f"{settings.KB_SERVICE_URL}/documents",
-                json=body,
-                headers={"X-Internal-Key": INTERNAL_KEY}
-            )
-            return JSONResponse(content=resp.json(), status_code=resp.status_code)
+        resp = await upstreams.get("kb").post(
+            "/documents",
+            json=body,
+            headers={"X-Internal-Key": INTERNAL_KEY}
+        )
+        return JSONResponse(content=resp.json(), status_code=resp.status_code)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# 批量导入/删除知识库文档 (RBAC: 仅管理员)，NDJSON 请求体边读边转发，不在网关缓存
+async def bulk_doc_proxy(request: Request, path: str):
+    client = upstreams.get("kb")
+    try:
+        req = client.build_request(
+            "POST",
+            path,
+            content=request.stream(),
+            headers={"X-Internal-Key": INTERNAL_KEY, "Content-Type": "application/x-ndjson"},
+            timeout=None,  # 大批量导入耗时不可预估
+        )
+        resp = await client.send(req, stream=True)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+    # 逐块转发 NDJSON 状态行，发送完毕后归还连接
+    return StreamingResponse(
+        resp.aiter_raw(),
+        status_code=resp.status_code,
+        media_type=resp.headers.get("content-type"),
+        background=BackgroundTask(resp.aclose),
+    )
+
+
+@app.post("/api/documents/bulk")
+async def bulk_upsert_docs_proxy(request: Request, user: dict = Depends(get_admin_user)):
+    return await bulk_doc_proxy(request, "/documents/bulk")
+
+
+@app.post("/api/documents/bulk-delete")
+async def bulk_delete_docs_proxy(request: Request, user: dict = Depends(get_admin_user)):
+    return await bulk_doc_proxy(request, "/documents/bulk-delete")
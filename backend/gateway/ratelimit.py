@@ -0,0 +1,224 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional, Tuple
+from prometheus_client import Counter, Histogram
+from config import settings
+
+# 混合限流：本地令牌桶 + Redis 滑动窗口
+# - 热路径：本地令牌桶判断，已知全局余量充足时直接放行，不访问 Redis；本地命中数由后台任务批量同步到 Redis
+# - 接近上限 / 全局状态未知时：同步执行 Lua 滑动窗口脚本，以 Redis 为准
+# - Redis 慢或不可用：进入降级模式，仅按本地令牌桶判断 (单实例内仍然准确，多实例间放宽)
+
+DECISION_SECONDS = Histogram(
+    "gateway_ratelimit_decision_seconds",
+    "限流判断耗时 (path: local / redis / degraded)",
+    ["path"],
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1),
+)
+REJECTED = Counter(
+    "gateway_ratelimit_rejected_total",
+    "被限流拒绝的请求数",
+    ["route", "path"],
+)
+
+# 滑动窗口 (ZSET 存每次命中的时间戳)
+# KEYS[1]=窗口 key；ARGV: now_ms, window_ms, limit, synced, nonce, check
+# synced: 本地已放行、需要补记的命中数 (无条件写入)；check=1 时再判断本次请求是否放行
+SLIDING_WINDOW_LUA = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+local synced = tonumber(ARGV[4])
+redis.call('ZREMRANGEBYSCORE', key, 0, now - window)
+local count = redis.call('ZCARD', key)
+for i = 1, synced do
+    redis.call('ZADD', key, now, ARGV[5] .. ':' .. i)
+end
+count = count + synced
+local allowed = 1
+if ARGV[6] == '1' then
+    if count + 1 > limit then
+        allowed = 0
+    else
+        redis.call('ZADD', key, now, ARGV[5] .. ':c')
+        count = count + 1
+    end
+end
+redis.call('PEXPIRE', key, window)
+return {allowed, count}
+"""
+
+
+def parse_limit(value: str) -> Tuple[int, float]:
+    """'10/60' -> (10 次, 60 秒)"""
+    times, seconds = value.split("/")
+    return int(times), float(seconds)
+
+
+class _Subject:
+    """单个 (路由, 用户) 的本地状态"""
+    __slots__ = ("times", "seconds", "tokens", "updated", "pending", "global_count", "global_at")
+
+    def __init__(self, times: int, seconds: float):
+        self.times = times
+        self.seconds = seconds
+        self.tokens = float(times)
+        self.updated = time.monotonic()
+        self.pending = 0  # 本地放行、尚未同步到 Redis 的命中数
+        self.global_count = None  # 上次同步时 Redis 窗口内的命中数
+        self.global_at = 0.0
+
+
+class HybridRateLimiter:
+    def __init__(self, rules: dict):
+        self.rules = {
+            route: {name: parse_limit(value) for name, value in route_rules.items()}
+            for route, route_rules in rules.items()
+        }
+        self.redis = None
+        self._script = None
+        self._subjects: "OrderedDict[Tuple[str, str], _Subject]" = OrderedDict()
+        self._degraded_until = 0.0
+        self._sync_task: Optional[asyncio.Task] = None
+
+    def bind(self, redis_client):
+        # 复用 lifespan 中创建的 Redis 连接
+        self.redis = redis_client
+        self._script = redis_client.register_script(SLIDING_WINDOW_LUA)
+
+    async def start(self):
+        self._sync_task = asyncio.create_task(self._sync_loop())
+
+    async def close(self):
+        if self._sync_task:
+            self._sync_task.cancel()
+            self._sync_task = None
+        await self.sync()
+
+    def resolve(self, route: str, user: dict) -> Optional[Tuple[int, float]]:
+        """优先级：用户 > 角色 > 路由默认；路由未配置时不限流"""
+        rules = self.rules.get(route)
+        if not rules:
+            return None
+        return (rules.get(f"user:{user['username']}")
+                or rules.get(f"role:{user.get('role', 'user')}")
+                or rules.get("default"))
+
+    def _subject(self, route: str, username: str, times: int, seconds: float) -> _Subject:
+        key = (route, username)
+        subject = self._subjects.get(key)
+        if subject is None or (subject.times, subject.seconds) != (times, seconds):
+            subject = self._subjects[key] = _Subject(times, seconds)
+            if len(self._subjects) > settings.RATE_LIMIT_MAX_SUBJECTS:
+                self._subjects.popitem(last=False)
+        else:
+            self._subjects.move_to_end(key)
+        return subject
+
+    @property
+    def degraded(self) -> bool:
+        return self.redis is None or time.monotonic() < self._degraded_until
+
+    def _call(self, route: str, username: str, subject: _Subject, synced: int, check: bool, client=None):
+        return self._script(
+            keys=[f"rl:{route}:{username}"],
+            args=[int(time.time() * 1000), int(subject.seconds * 1000), subject.times, synced,
+                  uuid.uuid4().hex, int(check)],
+            client=client,
+        )
+
+    def _mark_degraded(self, e: Exception):
+        if not self.degraded:
+            print(f"⚠️ 限流 Redis 不可用，{settings.RATE_LIMIT_DEGRADED_COOLDOWN}s 内仅使用本地令牌桶: {e!r}")
+        self._degraded_until = time.monotonic() + settings.RATE_LIMIT_DEGRADED_COOLDOWN
+
+    async def check(self, route: str, user: dict) -> Tuple[bool, float]:
+        """
+        返回 (是否放行, 建议重试秒数)
+        """
+        limit = self.resolve(route, user)
+        if limit is None:
+            return True, 0.0
+        times, seconds = limit
+        started = time.perf_counter()
+        subject = self._subject(route, user["username"], times, seconds)
+
+        # 1. 本地令牌桶 (单实例内的硬上限)
+        now = time.monotonic()
+        subject.tokens = min(times, subject.tokens + (now - subject.updated) * times / seconds)
+        subject.updated = now
+        if subject.tokens < 1:
+            return self._decide(route, "local", started, False, (1 - subject.tokens) * seconds / times)
+
+        # 2. 全局余量充足 (上次同步的计数 + 本地未同步命中，仍低于上限减去余量)，直接本地放行
+        headroom = max(1, int(times * settings.RATE_LIMIT_LOCAL_HEADROOM))
+        fresh = subject.global_count is not None and now - subject.global_at < seconds
+        if self.degraded or (fresh and subject.global_count + subject.pending + 1 <= times - headroom):
+            subject.tokens -= 1
+            if not self.degraded:
+                subject.pending += 1  # 降级期间的命中不补记，避免恢复后集中扣减
+            return self._decide(route, "degraded" if self.degraded else "local", started, True, 0.0)
+
+        # 3. 接近上限或状态未知：同步走 Redis 滑动窗口 (带上本地未同步的命中)
+        pending, subject.pending = subject.pending, 0
+        try:
+            allowed, count = await asyncio.wait_for(
+                self._call(route, user["username"], subject, pending, check=True),
+                timeout=settings.RATE_LIMIT_REDIS_TIMEOUT,
+            )
+        except Exception as e:
+            self._mark_degraded(e)
+            subject.pending += pending  # 未写入 Redis 的命中留到恢复后的下一次同步
+            subject.tokens -= 1
+            return self._decide(route, "degraded", started, True, 0.0)
+
+        subject.global_count = int(count)
+        subject.global_at = time.monotonic()
+        if allowed:
+            subject.tokens -= 1
+        return self._decide(route, "redis", started, bool(allowed), 0.0 if allowed else seconds / times)
+
+    @staticmethod
+    def _decide(route: str, path: str, started: float, allowed: bool, retry_after: float):
+        DECISION_SECONDS.labels(path=path).observe(time.perf_counter() - started)
+        if not allowed:
+            REJECTED.labels(route=route, path=path).inc()
+        return allowed, retry_after
+
+    async def sync(self):
+        """把本地放行的命中通过一个 pipeline 批量写入 Redis，并刷新各用户的全局计数"""
+        if self.degraded:
+            return  # 降级前未同步的命中保留到 Redis 恢复后再写入
+        batch = [(key, subject, subject.pending) for key, subject in self._subjects.items() if subject.pending]
+        if not batch:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for (route, username), subject, pending in batch:
+            subject.pending -= pending
+            await self._call(route, username, subject, pending, check=False, client=pipe)  # 仅加入 pipeline
+        try:
+            results = await asyncio.wait_for(pipe.execute(), timeout=settings.RATE_LIMIT_REDIS_TIMEOUT * 4)
+        except Exception as e:
+            self._mark_degraded(e)
+            for _, subject, pending in batch:
+                subject.pending += pending
+            return
+        synced_at = time.monotonic()
+        for (_, subject, _), (_, count) in zip(batch, results):
+            subject.global_count = int(count)
+            subject.global_at = synced_at
+
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(settings.RATE_LIMIT_SYNC_INTERVAL)
+            try:
+                await self.sync()
+            except Exception as e:
+                print(f"⚠️ 限流计数同步失败: {e}")
+
+
+# 全局单例：lifespan 中 bind Redis 连接并启动同步任务
+limiter = HybridRateLimiter(settings.RATE_LIMITS)
@@ -0,0 +1,151 @@
+import asyncio
+import uuid
+from typing import AsyncIterator, List, Optional, Tuple
+from prometheus_client import Counter
+from config import settings
+
+# 可续传的 SSE：上游输出先写入 Redis Stream (有界 + TTL)，客户端从 Stream 读取。
+# - 生产者 (读上游) 与消费者 (写客户端) 解耦：客户端断线不会中断生成，慢客户端也不会让网关内存无限增长
+# - 事件 ID 为 "{stream_id}:{seq}"，重连时带上 Last-Event-ID 即可补发缺失事件并继续跟随实时输出
+
+STREAM_KEY = "sse:{}"
+OWNER_KEY = "sse:{}:owner"
+
+SSE_RESUMES = Counter(
+    "gateway_sse_resumes_total",
+    "Last-Event-ID 重连次数 (result: ok / gap / not_found)",
+    ["result"],
+)
+
+
+def format_event(event_id: str, event: str, data: str) -> bytes:
+    """按 SSE 规范组帧：多行数据拆成多个 data: 行，客户端按 \\n 拼回"""
+    lines = [f"id: {event_id}"]
+    if event != "message":
+        lines.append(f"event: {event}")
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return ("\n".join(lines) + "\n\n").encode()
+
+
+def parse_last_event_id(value: Optional[str]) -> Tuple[Optional[str], int]:
+    """解析 Last-Event-ID ("{stream_id}:{seq}")，格式不对时视为从头开始"""
+    if not value or ":" not in value:
+        return None, 0
+    stream_id, _, seq = value.rpartition(":")
+    try:
+        return stream_id, int(seq)
+    except ValueError:
+        return stream_id, 0
+
+
+async def iter_upstream_events(text_chunks: AsyncIterator[str]) -> AsyncIterator[List[Tuple[str, str]]]:
+    """
+    解析 LLM Service 输出的 SSE 帧，每收到一段网络数据产出其中完整的 [(event, data)]；
+    帧可能被拆到多个网络包里，一个网络包也可能带多帧 (按批写入缓冲，减少 Redis 往返)
+    """
+    buffer = ""
+    async for text in text_chunks:
+        buffer += text
+        events = []
+        while "\n\n" in buffer:
+            frame, buffer = buffer.split("\n\n", 1)
+            event, data = "message", []
+            for line in frame.split("\n"):
+                if line.startswith("event: "):
+                    event = line[7:]
+                elif line.startswith("data: "):
+                    data.append(line[6:])
+            if data:
+                events.append((event, "\n".join(data)))
+        if events:
+            yield events
+
+
+class ReplayStream:
+    """单个回答的写入端，由后台任务持有"""
+
+    def __init__(self, buffer: "SSEReplayBuffer", stream_id: str):
+        self.buffer = buffer
+        self.stream_id = stream_id
+        self.seq = 0
+
+    async def append(self, event: str, data: str = ""):
+        await self.append_many([(event, data)])
+
+    async def append_many(self, events: List[Tuple[str, str]]):
+        """一批事件一次往返写入，同时续期 Stream 与归属 key (长回答不会先丢失归属导致无法续传)"""
+        key = STREAM_KEY.format(self.stream_id)
+        pipe = self.buffer.redis.pipeline(transaction=False)
+        for event, data in events:
+            self.seq += 1
+            # 显式指定递增 ID (0-seq)，超出 MAXLEN 的旧事件被裁剪，重连时据此判断是否有缺口
+            pipe.xadd(key, {"event": event, "data": data}, id=f"0-{self.seq}",
+                      maxlen=settings.SSE_BUFFER_MAXLEN, approximate=False)
+        pipe.expire(key, settings.SSE_BUFFER_TTL)
+        pipe.expire(OWNER_KEY.format(self.stream_id), settings.SSE_BUFFER_TTL)
+        await pipe.execute()
+
+
+class SSEReplayBuffer:
+    def __init__(self):
+        self.redis = None
+
+    def bind(self, redis_client):
+        # 复用 lifespan 中创建的 Redis 连接 (decode_responses=True)
+        self.redis = redis_client
+
+    async def open(self, owner: str) -> ReplayStream:
+        stream_id = uuid.uuid4().hex
+        await self.redis.set(OWNER_KEY.format(stream_id), owner, ex=settings.SSE_BUFFER_TTL)
+        return ReplayStream(self, stream_id)
+
+    async def owner(self, stream_id: str) -> Optional[str]:
+        return await self.redis.get(OWNER_KEY.format(stream_id))
+
+    async def events(self, stream_id: str, after_seq: int = 0) -> AsyncIterator[bytes]:
+        """
+        从 after_seq 之后开始读取：先补发缓冲区里已有的事件，再阻塞等待实时事件，直到 done。
+        每次最多读 SSE_READ_BATCH 条，客户端写不动时这里不会继续读，内存占用与客户端速度无关。
+        """
+        key = STREAM_KEY.format(stream_id)
+        last_id = f"0-{after_seq}"
+        expected = after_seq + 1
+        idle = 0.0
+        while True:
+            result = await self.redis.xread({key: last_id}, count=settings.SSE_READ_BATCH,
+                                            block=int(settings.SSE_KEEPALIVE * 1000))
+            if not result:
+                idle += settings.SSE_KEEPALIVE
+                if idle >= settings.SSE_IDLE_TIMEOUT:
+                    yield format_event(f"{stream_id}:{expected - 1}", "error", "Error: stream timeout")
+                    return
+                # 注释行保活，防止代理/移动网络断开空闲连接
+                yield b": ping\n\n"
+                continue
+            idle = 0.0
+            for entry_id, fields in result[0][1]:
+                seq = int(entry_id.split("-")[1])
+                if seq != expected:
+                    # 缺失的事件已被裁剪，无法续传
+                    SSE_RESUMES.labels("gap").inc()
+                    yield format_event(f"{stream_id}:{seq}", "error", "Error: stream gap, please retry the question")
+                    return
+                yield format_event(f"{stream_id}:{seq}", fields["event"], fields["data"])
+                if fields["event"] == "done":
+                    return
+                last_id = entry_id
+                expected = seq + 1
+
+
+# 全局单例：lifespan 中 bind Redis 连接
+sse_buffer = SSEReplayBuffer()
+
+_pump_tasks = set()
+
+
+def spawn(coro):
+    """后台任务需要持有引用，否则可能在完成前被 GC 回收"""
+    task = asyncio.create_task(coro)
+    _pump_tasks.add(task)
+    task.add_done_callback(_pump_tasks.discard)
+    return task
@@ -0,0 +1,153 @@
+import httpx
+from prometheus_client.core import GaugeMetricFamily
+from config import settings
+
+
+def _http2_available() -> bool:
+    # httpx 的 HTTP/2 依赖可选的 h2 包，没装时自动降级为 HTTP/1.1
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class _CountedStream(httpx.AsyncByteStream):
+    """响应体关闭 (读完或提前 aclose) 时把在途请求数减一，只减一次"""
+
+    def __init__(self, stream, transport: "InFlightTransport"):
+        self._stream = stream
+        self._transport = transport
+        self._closed = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            self._transport.in_flight -= 1
+        await self._stream.aclose()
+
+
+class InFlightTransport(httpx.AsyncBaseTransport):
+    """
+    包装 httpx 默认的 transport，只用公开接口统计在途请求数 (已发出、响应尚未关闭)
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self.transport = transport
+        self.in_flight = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.in_flight += 1
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            self.in_flight -= 1
+            raise
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_CountedStream(response.stream, self),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def _pool_state(transport: httpx.AsyncBaseTransport):
+    """
+    尽力读取 httpcore 连接池的 (idle, waiters)。httpx 没有公开连接池状态，
+    这些是内部结构，版本变化后读不到时返回 ("unknown", "unknown")
+    """
+    try:
+        pool = transport._pool
+        idle = sum(1 for c in pool.connections if c.is_idle())
+        waiters = sum(1 for r in pool._requests if r.connection is None)
+        return idle, waiters
+    except Exception:
+        return "unknown", "unknown"
+
+
+class UpstreamClients:
+    """
+    按上游服务 (auth / llm / kb) 维护的长连接 httpx 客户端注册表。
+    在 lifespan 中 start()/close()，请求处理函数通过 get(name) 复用连接池。
+    """
+
+    def __init__(self, upstreams: dict):
+        self._upstreams = upstreams
+        self._clients: dict[str, httpx.AsyncClient] = {}
+        self._transports: dict[str, InFlightTransport] = {}
+
+    async def start(self):
+        http2 = settings.UPSTREAM_HTTP2 and _http2_available()
+        if settings.UPSTREAM_HTTP2 and not http2:
+            print("⚠️ UPSTREAM_HTTP2 已开启但未安装 h2，回退到 HTTP/1.1")
+
+        for name, cfg in self._upstreams.items():
+            transport = InFlightTransport(httpx.AsyncHTTPTransport(
+                http2=http2,
+                limits=httpx.Limits(
+                    max_connections=cfg["max_connections"],
+                    max_keepalive_connections=cfg["max_keepalive_connections"],
+                    keepalive_expiry=cfg["keepalive_expiry"],
+                ),
+            ))
+            self._transports[name] = transport
+            self._clients[name] = httpx.AsyncClient(
+                base_url=cfg["base_url"],
+                timeout=httpx.Timeout(cfg["timeout"], connect=cfg["connect_timeout"]),
+                transport=transport,
+            )
+
+    async def close(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+        self._transports.clear()
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        client = self._clients.get(name)
+        if client is None:
+            raise RuntimeError(f"Upstream client '{name}' is not started")
+        return client
+
+    def stats(self) -> dict:
+        """
+        各上游的 in_use (在途请求数，由 InFlightTransport 统计) 与 idle / waiters (连接池内部状态，读不到时为 "unknown")
+        """
+        result = {}
+        for name, transport in self._transports.items():
+            idle, waiters = _pool_state(transport.transport)
+            result[name] = {"in_use": transport.in_flight, "idle": idle, "waiters": waiters}
+        return result
+
+
+class UpstreamPoolCollector:
+    """Prometheus 自定义 Collector：抓取 /metrics 时实时读取连接池状态"""
+
+    def __init__(self, registry: UpstreamClients):
+        self._registry = registry
+
+    def collect(self):
+        descriptions = {
+            "in_use": "Upstream HTTP requests in flight",
+            "idle": "Upstream HTTP pool connections (idle)",
+            "waiters": "Upstream HTTP requests waiting for a pooled connection",
+        }
+        families = {
+            key: GaugeMetricFamily(f"gateway_upstream_pool_{key}", description, labels=["upstream"])
+            for key, description in descriptions.items()
+        }
+        for name, values in self._registry.stats().items():
+            for key, value in values.items():
+                if value != "unknown":
+                    families[key].add_metric([name], value)
+        yield from families.values()
+
+
+upstreams = UpstreamClients(settings.UPSTREAMS)
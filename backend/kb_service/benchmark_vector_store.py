@@ -0,0 +1,99 @@
+import argparse
+import json
+import shutil
+import tempfile
+import time
+import numpy as np
+from core.config import settings
+from core.local_store import LocalCollection
+
+
+def make_dataset(n: int, dim: int, queries: int, clusters: int = 100, seed: int = 0):
+    """
+    生成带聚类结构的合成向量 (比纯随机向量更接近真实 Embedding 分布)
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    data = centers[rng.integers(clusters, size=n)] + 0.3 * rng.normal(size=(n, dim)).astype(np.float32)
+    q = centers[rng.integers(clusters, size=queries)] + 0.3 * rng.normal(size=(queries, dim)).astype(np.float32)
+    return data, q
+
+
+def ground_truth(data: np.ndarray, queries: np.ndarray, k: int):
+    data = data / np.linalg.norm(data, axis=1, keepdims=True)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    scores = queries @ data.T
+    return [set(f"d{i}" for i in np.argsort(-row)[:k]) for row in scores]
+
+
+def measure(name: str, query_fn, queries: np.ndarray, truth, k: int):
+    latencies, recall = [], []
+    for q, expected in zip(queries, truth):
+        start = time.perf_counter()
+        ids = query_fn(q)
+        latencies.append((time.perf_counter() - start) * 1000)
+        recall.append(len(set(ids) & expected) / k)
+    latencies = np.array(latencies)
+    return {
+        "backend": name,
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+        f"recall@{k}": round(float(np.mean(recall)), 4),
+    }
+
+
+def load(collection, data: np.ndarray, batch: int = 5000):
+    for start in range(0, len(data), batch):
+        ids = [f"d{i}" for i in range(start, min(start + batch, len(data)))]
+        collection.upsert(ids=ids, embeddings=data[start:start + batch].tolist(), metadatas=[{"id": i} for i in ids])
+
+
+def main(n: int, dim: int, num_queries: int, k: int, with_chroma: bool):
+    data, queries = make_dataset(n, dim, num_queries)
+    truth = ground_truth(data, queries, k)
+    report = []
+
+    path = tempfile.mkdtemp(prefix="local_store_bench_")
+    try:
+        exact = LocalCollection(path)
+        load(exact, data)
+        report.append(measure("local-exact", lambda q: exact.query([q], n_results=k)["ids"][0], queries, truth, k))
+
+        ivf = LocalCollection(path, ann="ivf", ann_min_rows=0,
+                              nlist=settings.LOCAL_ANN_NLIST, nprobe=settings.LOCAL_ANN_NPROBE)
+        ivf.query([queries[0]], n_results=k)  # 预先训练，避免计入首个查询
+        report.append(measure("local-ivf", lambda q: ivf.query([q], n_results=k)["ids"][0], queries, truth, k))
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+    if with_chroma:
+        import chromadb
+        client = chromadb.HttpClient(host=settings.CHROMA_HOST, port=settings.CHROMA_PORT)
+        name = "bench_local_store"
+        try:
+            client.delete_collection(name)
+        except Exception:
+            pass
+        collection = client.create_collection(name, metadata={"hnsw:space": "cosine"})
+        try:
+            load(collection, data)
+            report.append(measure(
+                "chroma-http",
+                lambda q: collection.query(query_embeddings=[q.tolist()], n_results=k, include=[])["ids"][0],
+                queries, truth, k,
+            ))
+        finally:
+            client.delete_collection(name)
+
+    print(json.dumps({"n": n, "dim": dim, "queries": num_queries, "results": report}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地向量库 vs Chroma 延迟/召回对比")
+    parser.add_argument("--n", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--chroma", action="store_true", help="同时测试远程 Chroma (需要 Chroma 服务可用)")
+    args = parser.parse_args()
+    main(args.n, args.dim, args.queries, args.top_k, args.chroma)
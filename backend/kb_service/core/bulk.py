@@ -0,0 +1,150 @@
+# kb_service/core/bulk.py
+import hashlib
+import json
+import time
+from typing import List
+from .config import settings
+from .chunking import chunk_document, parent_filter
+from .db import get_embeddings
+from .lexical import get_lexical_index, log_changes
+from .version import bump_kb_version
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def to_document(item: dict):
+    """
+    转换为待入库的 (id, content, metadata)。content_hash 决定是否需要重新切分、向量化，
+    meta_hash 覆盖分类等元数据：只有元数据变化时原地更新元数据，不重新 Embedding
+    """
+    content = item["content"]
+    if item.get("similar_questions"):
+        # 将 similar_questions 合并到 content 中，增加被召回的概率
+        content = f"{content}\n\n相关问题参考:\n" + "\n".join(item["similar_questions"])
+
+    metadata = {
+        "id": item["id"],
+        "category": item.get("category") or "General",
+        "topic": item.get("topic") or "",
+        "source": item.get("source") or "Bulk Import",
+    }
+    # 模型名与分块参数也参与哈希，切换 Embedding 模型或分块大小后会整体重新切分、向量化
+    meta_hash = _digest(json.dumps(metadata, sort_keys=True, ensure_ascii=False))
+    metadata["content_hash"] = _digest(f"{settings.EMBEDDING_MODEL_NAME}\n{settings.CHUNK_SIZE}/{settings.CHUNK_OVERLAP}\n{content}")
+    metadata["meta_hash"] = meta_hash
+    return item["id"], content, metadata
+
+
+def with_retry(fn, retries: int, base_delay: float = 1.0):
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = base_delay * (2 ** attempt)
+            print(f"⚠️ 第 {attempt + 1} 次失败，{delay:.0f}s 后重试: {e}")
+            time.sleep(delay)
+
+
+def embed_batch(texts: List[str]):
+    """
+    直接调用 OpenAI 兼容接口，以便拿到真实的 token 用量
+    """
+    embeddings = get_embeddings()
+    embeddings = getattr(embeddings, "inner", embeddings)  # 绕过查询缓存
+    response = embeddings.client.create(input=texts, model=embeddings.model)
+    usage = getattr(response, "usage", None)
+    return [d.embedding for d in response.data], (usage.total_tokens if usage else 0)
+
+
+def stored_chunks(collection, doc_ids: List[str], retries: int = 0) -> dict:
+    """
+    文档 ID -> [(分块 ID, content_hash, meta_hash)]，一次按元数据查询取回
+    """
+    existing = with_retry(lambda: collection.get(where=parent_filter(doc_ids), include=["metadatas"]), retries)
+    chunks = {}
+    for chunk_id, metadata in zip(existing["ids"], existing["metadatas"]):
+        metadata = metadata or {}
+        chunks.setdefault(metadata.get("parent_id", chunk_id), []).append(
+            (chunk_id, metadata.get("content_hash"), metadata.get("meta_hash"))
+        )
+    return chunks
+
+
+def upsert_batch(collection, items: List[dict], retries: int = 0):
+    """
+    幂等地写入一批文档：内容与元数据都未变的跳过；只有元数据变化的原地更新元数据；
+    其余切分后一次 Embedding + 一次 upsert，并删除旧版本多出来的分块。
+    返回 ({id: "upserted" | "metadata_updated" | "unchanged"}, embedding tokens)
+    """
+    docs = {}
+    for item in items:
+        doc_id, content, metadata = to_document(item)
+        docs[doc_id] = (content, metadata)  # 同一批内重复 ID 以最后一条为准
+
+    ids = list(docs)
+    stored = stored_chunks(collection, ids, retries)
+    statuses = {}
+    for doc_id in ids:
+        metadata = docs[doc_id][1]
+        chunks = stored.get(doc_id)
+        if not chunks or any(h != metadata["content_hash"] for _, h, _ in chunks):
+            statuses[doc_id] = "upserted"
+        elif any(m != metadata["meta_hash"] for _, _, m in chunks):
+            statuses[doc_id] = "metadata_updated"
+        else:
+            statuses[doc_id] = "unchanged"
+
+    tokens = 0
+    retagged = [chunk for doc_id in ids if statuses[doc_id] == "metadata_updated"
+                for chunk in chunk_document(doc_id, *docs[doc_id])]
+    if retagged:
+        # 内容相同则分块结果相同，分块 ID 不变，只替换元数据
+        with_retry(lambda: collection.update(
+            ids=[chunk_id for chunk_id, _, _ in retagged],
+            metadatas=[metadata for _, _, metadata in retagged],
+        ), retries)
+
+    changed = [doc_id for doc_id in ids if statuses[doc_id] == "upserted"]
+    if changed:
+        chunks = [chunk for doc_id in changed for chunk in chunk_document(doc_id, *docs[doc_id])]
+        chunk_ids = [chunk_id for chunk_id, _, _ in chunks]
+        contents = [content for _, content, _ in chunks]
+        new_ids = set(chunk_ids)
+        stale = [chunk_id for doc_id in changed for chunk_id, _, _ in stored.get(doc_id, []) if chunk_id not in new_ids]
+
+        vectors, tokens = with_retry(lambda: embed_batch(contents), retries)
+        with_retry(lambda: collection.upsert(
+            ids=chunk_ids,
+            embeddings=vectors,
+            documents=contents,
+            metadatas=[metadata for _, _, metadata in chunks],
+        ), retries)
+        if stale:
+            with_retry(lambda: collection.delete(ids=stale), retries)
+            get_lexical_index().remove_many(stale)
+        get_lexical_index().add_many(
+            zip(chunk_ids, contents), {chunk_id: metadata["content_hash"] for chunk_id, _, metadata in chunks}
+        )
+        log_changes(chunk_ids + stale)
+    if changed or retagged:
+        bump_kb_version()
+    return statuses, tokens
+
+
+def delete_batch(collection, ids: List[str], retries: int = 0):
+    """
+    删除文档的全部分块：先按 parent_id 查出分块 ID，再一次删除。
+    返回 {id: "deleted" | "not_found"}，没有删除任何分块时不推进知识库版本
+    """
+    stored = stored_chunks(collection, ids, retries)
+    chunk_ids = [chunk_id for chunks in stored.values() for chunk_id, _, _ in chunks]
+    if chunk_ids:
+        with_retry(lambda: collection.delete(ids=chunk_ids), retries)
+        get_lexical_index().remove_many(chunk_ids)
+        log_changes(chunk_ids)
+        bump_kb_version()
+    return {doc_id: ("deleted" if doc_id in stored else "not_found") for doc_id in ids}
@@ -0,0 +1,153 @@
+# kb_service/core/chunking.py
+import re
+from typing import List, Tuple
+from .config import settings
+
+# 入库前把长文档切成多个分块，每块单独向量化，检索时返回最相关的分块 (可扩展到相邻分块)。
+# 切分按结构逐级进行：标题 (Markdown #) -> 段落 (空行) -> 句子 (中英文句末标点) -> 定长；
+# 分块不跨越标题，相邻分块以整句重叠 CHUNK_OVERLAP，长度按 token 估算 (中日韩字符约 1 token/字)。
+
+HEADING = re.compile(r"^#{1,6}\s")
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+# 句末标点后切分并保留标点；英文句号要求后跟空白，避免切断小数、版本号
+SENTENCE_END = re.compile(r"(?<=[。！？!?；;])|(?<=\.\s)|(?<=\n)")
+
+
+def _is_cjk(ch: str) -> bool:
+    return "㐀" <= ch <= "鿿" or "぀" <= ch <= "ヿ" or "가" <= ch <= "힯"
+
+
+def estimate_tokens(text: str) -> int:
+    cjk = sum(1 for ch in text if _is_cjk(ch))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def chunk_id(parent_id: str, index: int, count: int) -> str:
+    # 只有一块的文档沿用文档 ID，与未分块时写入的数据一致
+    return parent_id if count == 1 else f"{parent_id}#{index}"
+
+
+def split_sections(text: str) -> List[str]:
+    sections, lines = [], []
+    for line in text.splitlines():
+        if HEADING.match(line) and any(l.strip() for l in lines):
+            sections.append("\n".join(lines).strip())
+            lines = []
+        lines.append(line)
+    if any(l.strip() for l in lines):
+        sections.append("\n".join(lines).strip())
+    return sections
+
+
+def _hard_split(text: str, limit: int) -> List[str]:
+    """
+    没有标点可切的超长句子 (如代码、URL) 按估算 token 数定长切开
+    """
+    pieces, start, cost = [], 0, 0.0
+    for i, ch in enumerate(text):
+        cost += 1 if _is_cjk(ch) else 0.25
+        if cost > limit:
+            pieces.append(text[start:i])
+            start, cost = i, (1 if _is_cjk(ch) else 0.25)
+    pieces.append(text[start:])
+    return [p for p in pieces if p]
+
+
+def split_units(section: str, limit: int) -> List[str]:
+    """
+    切成不超过 limit 的句子级片段；段落最后一句带上段落分隔符，拼接后还原原文结构
+    """
+    units = []
+    for paragraph in PARAGRAPH_BREAK.split(section):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        sentences = [s for s in SENTENCE_END.split(paragraph) if s]
+        for sentence in sentences:
+            units.extend(_hard_split(sentence, limit) if estimate_tokens(sentence) > limit else [sentence])
+        units[-1] += "\n\n"
+    return units
+
+
+def _finish(units: List[str], overlap_units: int) -> Tuple[str, int]:
+    """
+    返回 (分块文本, 开头与上一块重复的字符数)
+    """
+    joined = "".join(units)
+    leading = len(joined) - len(joined.lstrip())
+    repeated = len("".join(units[:overlap_units]).rstrip()) - leading if overlap_units else 0
+    return joined.strip(), max(0, repeated)
+
+
+def merge_units(units: List[str], size: int, overlap: int) -> List[Tuple[str, int]]:
+    chunks, current, current_len, carried = [], [], 0, 0
+    for unit in units:
+        n = estimate_tokens(unit)
+        if current and current_len + n > size:
+            chunks.append(_finish(current, carried))
+            # 新分块以上一块末尾的若干整句开头，总量不超过 overlap
+            tail, tail_len = [], 0
+            for previous in reversed(current):
+                cost = estimate_tokens(previous)
+                if tail_len + cost > overlap:
+                    break
+                tail.insert(0, previous)
+                tail_len += cost
+            current, current_len, carried = tail, tail_len, len(tail)
+        current.append(unit)
+        current_len += n
+    if current:
+        chunks.append(_finish(current, carried))
+    return chunks
+
+
+def split_text(text: str, size: int = None, overlap: int = None) -> List[Tuple[str, int]]:
+    """
+    返回 [(分块文本, 开头与上一块重复的字符数)]
+    """
+    size = size or settings.CHUNK_SIZE
+    overlap = min(overlap if overlap is not None else settings.CHUNK_OVERLAP, size // 2)
+    if estimate_tokens(text) <= size:
+        return [(text, 0)]
+    chunks = []
+    for section in split_sections(text):
+        # 单个片段不超过 size - overlap，保证加上重叠部分后仍放得下
+        chunks.extend(merge_units(split_units(section, size - overlap), size, overlap))
+    return chunks or [(text, 0)]
+
+
+def chunk_document(doc_id: str, content: str, metadata: dict) -> List[Tuple[str, str, dict]]:
+    """
+    返回 [(分块 ID, 分块文本, 分块元数据)]。元数据沿用文档的元数据，id 为分块 ID，
+    parent_id / chunk_index / chunk_count 用于按文档删除与检索时扩展相邻分块，overlap 为开头重复的字符数
+    """
+    chunks = split_text(content)
+    count = len(chunks)
+    return [
+        (chunk_id(doc_id, i, count), text,
+         dict(metadata, id=chunk_id(doc_id, i, count), parent_id=doc_id, chunk_index=i, chunk_count=count, overlap=overlap))
+        for i, (text, overlap) in enumerate(chunks)
+    ]
+
+
+def parent_filter(doc_ids: List[str]) -> dict:
+    """
+    匹配这些文档的全部分块 (含分块功能上线前写入、没有 parent_id 的整篇文档)
+    """
+    return {"$or": [{"parent_id": {"$in": doc_ids}}, {"id": {"$in": doc_ids}}]}
+
+
+def join_chunks(chunks: List[dict]) -> str:
+    """
+    按顺序拼接相邻分块，去掉每块开头与上一块重复的部分
+    """
+    text = ""
+    for chunk in chunks:
+        overlap = chunk["metadata"].get("overlap", 0)
+        if not text:
+            text = chunk["content"]
+        elif overlap:
+            text += chunk["content"][overlap:]
+        else:
+            text += "\n\n" + chunk["content"]  # 不重叠的相邻分块 (如跨标题) 按段落拼接
+    return text
@@ -17,5 +17,53 @@ class Config:
     CHROMA_PORT = int(os.getenv("CHROMA_PORT", 8000))
     COLLECTION_NAME = "llm_dev_knowledge"
 
+    # 向量库后端：chroma (远程 HTTP) / local (进程内内存映射文件)
+    VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+    LOCAL_STORE_PATH = os.getenv("LOCAL_STORE_PATH", os.path.join(os.path.dirname(__file__), "..", "local_store"))
+    # 多 worker 部署时各进程以只读映射共享向量文件，写入通过文件锁跨进程串行，无需额外配置；
+    # 设为 true 则本服务完全不写入 (如只负责检索的副本)
+    LOCAL_STORE_READONLY = os.getenv("LOCAL_STORE_READONLY", "false").lower() == "true"
+    # 近似检索：none (精确) / ivf，集合超过 LOCAL_ANN_MIN_ROWS 条时启用
+    LOCAL_ANN = os.getenv("LOCAL_ANN", "none")
+    LOCAL_ANN_MIN_ROWS = int(os.getenv("LOCAL_ANN_MIN_ROWS", 50000))
+    LOCAL_ANN_NLIST = int(os.getenv("LOCAL_ANN_NLIST", 256))
+    LOCAL_ANN_NPROBE = int(os.getenv("LOCAL_ANN_NPROBE", 16))
 
-settings = Config()
\ No newline at end of file
+    # 启动预热时是否额外调用一次 Embedding 接口 (会产生少量费用)
+    WARMUP_EMBEDDING = os.getenv("WARMUP_EMBEDDING", "true").lower() == "true"
+    # 预热失败或连接重建后，后台每隔多少秒重试预热 (/ready 只读取状态，不触发预热)
+    WARMUP_RETRY_INTERVAL = float(os.getenv("WARMUP_RETRY_INTERVAL", 5.0))
+
+    # 查询向量缓存：进程内 LRU (按字节限制) + Redis 共享层 (留空 REDIS_URL 则只用 LRU)
+    REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+    EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+    EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+    EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", 7 * 24 * 3600))
+
+
+    # 批量接口每批写入的文档数 (一次 Embedding 请求 + 一次 Chroma upsert)
+    BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", 64))
+
+
+    # 混合检索：默认检索模式 (vector / lexical / hybrid)、倒排索引分词器 (ngram / jieba) 与持久化路径
+    SEARCH_MODE = os.getenv("SEARCH_MODE", "hybrid")
+    LEXICAL_TOKENIZER = os.getenv("LEXICAL_TOKENIZER", "ngram")
+    LEXICAL_INDEX_PATH = os.getenv("LEXICAL_INDEX_PATH", os.path.join(os.path.dirname(__file__), "..", "lexical.idx"))
+    LEXICAL_FLUSH_INTERVAL = float(os.getenv("LEXICAL_FLUSH_INTERVAL", 5.0))
+    LEXICAL_CHANGELOG_MAX_BYTES = int(os.getenv("LEXICAL_CHANGELOG_MAX_BYTES", 8 * 1024 * 1024))
+
+    # 分块入库：超过 CHUNK_SIZE (估算 token) 的文档按 标题 -> 段落 -> 句子 切分，相邻分块重叠 CHUNK_OVERLAP；
+    # 检索时默认把命中的分块向两侧各扩展 SEARCH_EXPAND 个相邻分块
+    CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 400))
+    CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 60))
+    SEARCH_EXPAND = int(os.getenv("SEARCH_EXPAND", 0))
+
+    # 检索后重排：多取 RERANK_FETCH_FACTOR 倍候选，丢弃与查询余弦相似度低于 RERANK_MIN_SCORE 的文档
+    # (阈值与 Embedding 模型有关)，再用 MMR 选出 top_k；RERANK_LAMBDA 越大越偏向相关性，越小越偏向多样性
+    RERANK_ENABLED = os.getenv("RERANK_ENABLED", "true").lower() == "true"
+    RERANK_FETCH_FACTOR = int(os.getenv("RERANK_FETCH_FACTOR", 4))
+    RERANK_LAMBDA = float(os.getenv("RERANK_LAMBDA", 0.5))
+    RERANK_MIN_SCORE = float(os.getenv("RERANK_MIN_SCORE", 0.2))
+
+
+settings = Config()
@@ -1,33 +1,131 @@
 # kb_service/core/db.py
+import threading
 import chromadb
+import httpx
+import openai
 from langchain_openai import OpenAIEmbeddings
 from langchain_chroma import Chroma
 from .config import settings
+from .embedding_cache import build_cached_embeddings
+from .local_store import LocalCollection, LocalVectorStore
+
+# 进程级单例：Embedding 客户端、Chroma 连接与 LangChain 包装器只创建一次，
+# 所有请求 (包括线程池中并发执行的同步接口) 共享同一份实例
+_lock = threading.Lock()
+_embeddings = None
+_client = None
+_vector_store = None
+_ready = False
+_embedding_warmed = False
+
+# 视为"连接已失效"的异常，遇到时重建连接后重试一次
+RECONNECT_ERRORS = (ConnectionError, httpx.TransportError, openai.APIConnectionError)
+
+
+def is_connection_error(e: BaseException) -> bool:
+    """
+    chromadb 会把连接失败包装成 ValueError 等普通异常 (如 "Could not connect to a Chroma server")，
+    沿异常链查找底层的连接错误
+    """
+    for _ in range(8):
+        if e is None:
+            return False
+        if isinstance(e, RECONNECT_ERRORS):
+            return True
+        e = e.__cause__ or e.__context__
+    return False
+
+
+def get_embeddings():
+    """
+    获取共享的 Embedding 客户端 (查询向量带两级缓存)
+    """
+    global _embeddings
+    if _embeddings is None:
+        with _lock:
+            if _embeddings is None:
+                _embeddings = build_cached_embeddings(OpenAIEmbeddings(
+                    api_key=settings.OPENAI_API_KEY,
+                    base_url=settings.OPENAI_BASE_URL,
+                    model=settings.EMBEDDING_MODEL_NAME,
+                    check_embedding_ctx_length=False  # 阿里云有时候不需要这个检查，关闭以防报错
+                ))
+    return _embeddings
 
 
 def get_vector_store():
     """
-    获取 LangChain 兼容的 Chroma 向量存储对象
-    """
-    # 1. 初始化 Embedding 模型 (关键修改点！)
-    embeddings = OpenAIEmbeddings(
-        api_key=settings.OPENAI_API_KEY,
-        base_url=settings.OPENAI_BASE_URL,
-        model=settings.EMBEDDING_MODEL_NAME,
-        check_embedding_ctx_length=False  # 阿里云有时候不需要这个检查，关闭以防报错
-    )
-
-    # 2. 连接到 Docker 中的 Chroma 服务
-    client = chromadb.HttpClient(
-        host=settings.CHROMA_HOST,
-        port=settings.CHROMA_PORT
-    )
-
-    # 3. 返回 LangChain 的 Chroma 包装器
-    vector_store = Chroma(
-        client=client,
-        collection_name=settings.COLLECTION_NAME,
-        embedding_function=embeddings,
-    )
-
-    return vector_store
\ No newline at end of file
+    获取 LangChain 兼容的 Chroma 向量存储对象 (进程内单例)，
+    VECTOR_BACKEND=local 时返回接口相同的本地向量库
+    """
+    global _client, _vector_store
+    if _vector_store is None:
+        embeddings = get_embeddings()
+        with _lock:
+            if _vector_store is None and settings.VECTOR_BACKEND == "local":
+                collection = LocalCollection(
+                    settings.LOCAL_STORE_PATH,
+                    readonly=settings.LOCAL_STORE_READONLY,
+                    ann=settings.LOCAL_ANN,
+                    ann_min_rows=settings.LOCAL_ANN_MIN_ROWS,
+                    nlist=settings.LOCAL_ANN_NLIST,
+                    nprobe=settings.LOCAL_ANN_NPROBE,
+                )
+                _vector_store = LocalVectorStore(collection, embeddings)
+            elif _vector_store is None:
+                # 连接到 Docker 中的 Chroma 服务
+                _client = chromadb.HttpClient(
+                    host=settings.CHROMA_HOST,
+                    port=settings.CHROMA_PORT
+                )
+                _vector_store = Chroma(
+                    client=_client,
+                    collection_name=settings.COLLECTION_NAME,
+                    embedding_function=embeddings,
+                )
+    return _vector_store
+
+
+def reset_vector_store():
+    """
+    丢弃当前的 Chroma 连接，下次 get_vector_store() 时重新建立
+    """
+    global _client, _vector_store, _ready
+    with _lock:
+        _client = None
+        _vector_store = None
+        _ready = False
+
+
+def run_with_reconnect(fn):
+    """
+    以共享向量库执行 fn(vector_store)；连接失效时重建一次再重试
+    """
+    try:
+        return fn(get_vector_store())
+    except Exception as e:
+        if not is_connection_error(e):
+            raise
+        print(f"⚠️ Chroma 连接异常，正在重连: {e}")
+        reset_vector_store()
+        return fn(get_vector_store())
+
+
+def warm_up():
+    """
+    预热：建立 Chroma 连接、加载集合，并 (可选) 发起一次 Embedding 请求，
+    避免部署后的第一次检索承担全部冷启动开销。Embedding 请求每个进程只成功发起一次
+    """
+    global _ready, _embedding_warmed
+    vector_store = get_vector_store()
+    if _client is not None:
+        _client.heartbeat()
+    vector_store._collection.count()
+    if settings.WARMUP_EMBEDDING and not _embedding_warmed:
+        get_embeddings().embed_query("warm up")
+        _embedding_warmed = True
+    _ready = True
+
+
+def is_ready() -> bool:
+    return _ready
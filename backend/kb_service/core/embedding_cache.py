@@ -0,0 +1,193 @@
+# kb_service/core/embedding_cache.py
+import hashlib
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import List, Optional
+
+import redis
+from langchain_core.embeddings import Embeddings
+from prometheus_client import Counter, Gauge
+
+from .config import settings
+
+CACHE_REQUESTS = Counter(
+    "kb_embedding_cache_requests_total",
+    "Query embedding cache lookups",
+    ["tier", "result"],
+)
+CACHE_BYTES = Gauge("kb_embedding_cache_lru_bytes", "Bytes held by the in-process embedding LRU")
+
+
+def normalize_query(text: str) -> str:
+    """
+    归一化查询文本：全角转半角、合并空白、统一小写，让同一问题的不同写法命中同一条缓存
+    """
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.split()).lower()
+
+
+def cache_key(model_name: str, text: str) -> str:
+    # 模型名是 key 的一部分，切换 Embedding 模型后旧向量自然不会被复用
+    digest = hashlib.sha256(normalize_query(text).encode("utf-8")).hexdigest()
+    return f"kb:emb:{model_name}:{digest}"
+
+
+class EmbeddingLRU:
+    """
+    进程内 LRU，按向量占用的字节数 (float32) 限制容量，线程安全
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[str, array]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[array]:
+        with self._lock:
+            vec = self._data.get(key)
+            if vec is not None:
+                self._data.move_to_end(key)
+            return vec
+
+    def put(self, key: str, vec: array):
+        size = len(vec) * vec.itemsize
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old) * old.itemsize
+            self._data[key] = vec
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= len(evicted) * evicted.itemsize
+            CACHE_BYTES.set(self._bytes)
+
+
+class RedisEmbeddingTier:
+    """
+    共享的 Redis 缓存层。Redis 出错时暂时停用一段时间，不拖慢检索
+    """
+
+    def __init__(self, url: str, ttl: int, cooldown: float = 30.0):
+        self.ttl = ttl
+        self.cooldown = cooldown
+        self._disabled_until = 0.0
+        self._client = redis.Redis.from_url(url, socket_timeout=0.1, socket_connect_timeout=0.1)
+
+    def _available(self) -> bool:
+        return time.monotonic() >= self._disabled_until
+
+    def _fail(self, e: Exception):
+        print(f"⚠️ Embedding 缓存 Redis 不可用，暂停 {self.cooldown}s: {e}")
+        self._disabled_until = time.monotonic() + self.cooldown
+
+    def get(self, key: str) -> Optional[array]:
+        if not self._available():
+            return None
+        try:
+            raw = self._client.get(key)
+        except redis.RedisError as e:
+            self._fail(e)
+            return None
+        if raw is None:
+            return None
+        vec = array("f")
+        vec.frombytes(raw)
+        return vec
+
+    def put(self, key: str, vec: array):
+        if not self._available():
+            return
+        try:
+            self._client.set(key, vec.tobytes(), ex=self.ttl)
+        except redis.RedisError as e:
+            self._fail(e)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    给查询向量加两级缓存 (进程内 LRU -> Redis -> Embedding API)。
+    只缓存 embed_query，文档入库走 embed_documents 时直接透传
+    """
+
+    def __init__(self, inner: Embeddings, model_name: str, lru: EmbeddingLRU,
+                 remote: Optional[RedisEmbeddingTier] = None):
+        self.inner = inner
+        self.model_name = model_name
+        self.lru = lru
+        self.remote = remote
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.inner.embed_documents(texts)
+
+    def _lookup(self, key: str) -> Optional[array]:
+        vec = self.lru.get(key)
+        if vec is not None:
+            CACHE_REQUESTS.labels(tier="lru", result="hit").inc()
+            return vec
+        CACHE_REQUESTS.labels(tier="lru", result="miss").inc()
+
+        if self.remote is not None:
+            vec = self.remote.get(key)
+            if vec is not None:
+                CACHE_REQUESTS.labels(tier="redis", result="hit").inc()
+                self.lru.put(key, vec)
+                return vec
+            CACHE_REQUESTS.labels(tier="redis", result="miss").inc()
+        return None
+
+    def _store(self, key: str, vector: List[float]):
+        vec = array("f", vector)
+        self.lru.put(key, vec)
+        if self.remote is not None:
+            self.remote.put(key, vec)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = cache_key(self.model_name, text)
+        vec = self._lookup(key)
+        if vec is not None:
+            return vec.tolist()
+
+        result = self.inner.embed_query(text)
+        self._store(key, result)
+        return result
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        批量获取查询向量：先查缓存，未命中的合并成一次 Embedding 请求
+        """
+        keys = [cache_key(self.model_name, t) for t in texts]
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        missing = {}  # key -> 需要回填的下标列表 (同一批内重复的问题只算一次)
+
+        for i, key in enumerate(keys):
+            vec = self._lookup(key)
+            if vec is not None:
+                results[i] = vec.tolist()
+            else:
+                missing.setdefault(key, []).append(i)
+
+        if missing:
+            order = list(missing)
+            vectors = self.inner.embed_documents([texts[missing[k][0]] for k in order])
+            for key, vector in zip(order, vectors):
+                self._store(key, vector)
+                for i in missing[key]:
+                    results[i] = vector
+        return results
+
+
+def build_cached_embeddings(inner: Embeddings) -> Embeddings:
+    if not settings.EMBEDDING_CACHE_ENABLED:
+        return inner
+    lru = EmbeddingLRU(settings.EMBEDDING_CACHE_MAX_BYTES)
+    remote = None
+    if settings.REDIS_URL:
+        remote = RedisEmbeddingTier(settings.REDIS_URL, settings.EMBEDDING_CACHE_TTL)
+    return CachedEmbeddings(inner, settings.EMBEDDING_MODEL_NAME, lru, remote)
@@ -0,0 +1,423 @@
+# kb_service/core/lexical.py
+import fcntl
+import math
+import os
+import pickle
+import re
+import threading
+import unicodedata
+import uuid
+from array import array
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .config import settings
+from .db import get_vector_store
+
+_WORD_RE = re.compile(r"[a-z0-9_]+|[㐀-鿿豈-﫿]+")
+_CJK_RE = re.compile(r"[㐀-鿿豈-﫿]")
+
+
+# ==========================================
+# 1. 分词器 (可插拔)
+# ==========================================
+def ngram_tokenize(text: str) -> List[str]:
+    """
+    英文/数字按单词切分，中文按字符二元组 (bigram) 切分，单字词保留为 unigram
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for word in _WORD_RE.findall(text):
+        if not _CJK_RE.match(word):
+            tokens.append(word)
+        elif len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+def jieba_tokenize(text: str) -> List[str]:
+    import jieba
+    text = unicodedata.normalize("NFKC", text).lower()
+    return [t for t in jieba.lcut_for_search(text) if t.strip() and _WORD_RE.fullmatch(t)]
+
+
+TOKENIZERS: Dict[str, Callable[[str], List[str]]] = {
+    "ngram": ngram_tokenize,
+    "jieba": jieba_tokenize,
+}
+
+
+# ==========================================
+# 2. BM25 倒排索引
+# ==========================================
+class BM25Index:
+    """
+    进程内 BM25 倒排索引。
+    倒排表用 array('I') 存储 (文档序号, 词频)，删除采用墓碑标记，墓碑过多时整体压缩。
+    每个文档记录入库时的 content_hash，用于与向量库对账
+    """
+
+    def __init__(self, tokenizer: str = "ngram", k1: float = 1.2, b: float = 0.75):
+        self.tokenizer_name = tokenizer
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self._doc_ids: List[Optional[str]] = []   # 文档序号 -> 文档 ID (None 表示已删除)
+        self._doc_index: Dict[str, int] = {}      # 文档 ID -> 文档序号
+        self._hashes: Dict[str, Optional[str]] = {}  # 文档 ID -> content_hash
+        self._doc_len = array("I")
+        self._postings: Dict[str, Tuple[array, array]] = {}
+        self._total_len = 0
+        self._dead = 0
+        self.dirty = False
+
+    @property
+    def tokenize(self):
+        return TOKENIZERS[self.tokenizer_name]
+
+    def __len__(self):
+        return len(self._doc_index)
+
+    def _remove(self, doc_id: str):
+        num = self._doc_index.pop(doc_id, None)
+        self._hashes.pop(doc_id, None)
+        if num is not None:
+            self._doc_ids[num] = None
+            self._total_len -= self._doc_len[num]
+            self._dead += 1
+
+    def add_many(self, docs: Iterable[Tuple[str, str]], hashes: Optional[Dict[str, str]] = None):
+        """
+        新增或覆盖文档 (同 ID 先删后加)；hashes 为文档 ID -> content_hash
+        """
+        hashes = hashes or {}
+        with self._lock:
+            for doc_id, text in docs:
+                self._remove(doc_id)
+                num = len(self._doc_ids)
+                self._doc_ids.append(doc_id)
+                self._doc_index[doc_id] = num
+                self._hashes[doc_id] = hashes.get(doc_id)
+
+                tf: Dict[str, int] = {}
+                tokens = self.tokenize(text)
+                for token in tokens:
+                    tf[token] = tf.get(token, 0) + 1
+                for token, count in tf.items():
+                    nums, freqs = self._postings.setdefault(token, (array("I"), array("I")))
+                    nums.append(num)
+                    freqs.append(count)
+                self._doc_len.append(len(tokens))
+                self._total_len += len(tokens)
+            self._maybe_compact()
+            self.dirty = True
+
+    def remove_many(self, doc_ids: Iterable[str]):
+        with self._lock:
+            for doc_id in doc_ids:
+                self._remove(doc_id)
+            self._maybe_compact()
+            self.dirty = True
+
+    def _maybe_compact(self):
+        # 墓碑超过 30% 时重建倒排表，回收空间并保证 df 统计准确
+        if self._dead < 1000 or self._dead < 0.3 * len(self._doc_ids):
+            return
+        remap = array("i", [-1]) * len(self._doc_ids)
+        doc_ids, doc_len = [], array("I")
+        for num, doc_id in enumerate(self._doc_ids):
+            if doc_id is not None:
+                remap[num] = len(doc_ids)
+                doc_ids.append(doc_id)
+                doc_len.append(self._doc_len[num])
+
+        postings = {}
+        for token, (nums, freqs) in self._postings.items():
+            new_nums, new_freqs = array("I"), array("I")
+            for num, freq in zip(nums, freqs):
+                if remap[num] >= 0:
+                    new_nums.append(remap[num])
+                    new_freqs.append(freq)
+            if new_nums:
+                postings[token] = (new_nums, new_freqs)
+
+        self._doc_ids, self._doc_len, self._postings = doc_ids, doc_len, postings
+        self._doc_index = {doc_id: num for num, doc_id in enumerate(doc_ids)}
+        self._dead = 0
+
+    def search(self, query: str, top_k: int) -> List[Tuple[str, float]]:
+        """
+        返回 [(文档 ID, BM25 分数)]，按分数降序
+        """
+        terms = set(self.tokenize(query))
+        with self._lock:
+            n = len(self._doc_index)
+            if not n or not terms:
+                return []
+            avg_len = self._total_len / n
+            scores: Dict[int, float] = {}
+            doc_ids, doc_len = self._doc_ids, self._doc_len
+            for term in terms:
+                entry = self._postings.get(term)
+                if entry is None:
+                    continue
+                # df 按倒排表长度计 (含墓碑)，墓碑最多占 30%，压缩后恢复精确；墓碑在打分时直接跳过
+                df = min(len(entry[0]), n)
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                for num, freq in zip(*entry):
+                    if doc_ids[num] is None:
+                        continue
+                    norm = self.k1 * (1 - self.b + self.b * doc_len[num] / avg_len)
+                    scores[num] = scores.get(num, 0.0) + idf * freq * (self.k1 + 1) / (freq + norm)
+            best = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:top_k]
+            return [(self._doc_ids[num], score) for num, score in best]
+
+    # ---------- 持久化 ----------
+    def save(self, path: str):
+        with self._lock:
+            self._maybe_compact()
+            state = {
+                "tokenizer": self.tokenizer_name,
+                "doc_ids": self._doc_ids,
+                "hashes": self._hashes,
+                "doc_len": self._doc_len,
+                "postings": self._postings,
+                "total_len": self._total_len,
+                "dead": self._dead,
+            }
+            tmp = f"{path}.tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+            self.dirty = False
+
+    @classmethod
+    def load(cls, path: str, tokenizer: str) -> Optional["BM25Index"]:
+        """
+        读取磁盘上的索引；文件不存在或分词器不一致时返回 None (需要重建)
+        """
+        try:
+            with open(path, "rb") as f:
+                state = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        if state.get("tokenizer") != tokenizer:
+            return None
+        index = cls(tokenizer)
+        index._doc_ids = state["doc_ids"]
+        index._doc_len = state["doc_len"]
+        index._postings = state["postings"]
+        index._total_len = state["total_len"]
+        index._dead = state["dead"]
+        index._doc_index = {doc_id: num for num, doc_id in enumerate(index._doc_ids) if doc_id is not None}
+        index._hashes = state.get("hashes") or dict.fromkeys(index._doc_index)
+        return index
+
+    def diff(self, stored: Dict[str, Optional[str]]) -> Tuple[List[str], List[str]]:
+        """
+        与向量库中的 {文档 ID: content_hash} 对比，返回 (需删除的 ID, 需重新索引的 ID)
+        """
+        with self._lock:
+            stale = [doc_id for doc_id in self._doc_index if doc_id not in stored]
+            missing = [
+                doc_id for doc_id, digest in stored.items()
+                if doc_id not in self._doc_index or self._hashes.get(doc_id) != digest
+            ]
+        return stale, missing
+
+
+# ==========================================
+# 3. 进程内单例 + 结果融合
+# ==========================================
+# 每个 worker 各持有一份索引并写同一个快照文件，快照只用于加速启动，加载后以向量库为准对账一次。
+# 之后各进程把改动过的分块 ID 追加到变更日志 (快照路径 + ".changes")，定期只回放其他进程追加的部分，
+# 同步开销与改动量成正比，不随集合大小增长。日志超过 LEXICAL_CHANGELOG_MAX_BYTES 时轮转，
+# 读取位置落在旧日志上的进程发现 inode 变化后退回全量对账一次
+_lock = threading.Lock()
+_index: Optional[BM25Index] = None
+_writer_id = uuid.uuid4().hex  # 标记本进程写入的日志行，回放时跳过
+_log_position: Tuple[Optional[int], int] = (None, 0)  # (变更日志 inode, 已回放到的偏移)
+
+
+def _changelog_path() -> str:
+    return f"{settings.LEXICAL_INDEX_PATH}.changes"
+
+
+def _changelog_end() -> Tuple[int, int]:
+    """
+    变更日志当前的 (inode, 大小)，不存在时创建
+    """
+    with open(_changelog_path(), "ab") as f:
+        stat = os.fstat(f.fileno())
+        return stat.st_ino, stat.st_size
+
+
+@contextmanager
+def _locked_changelog():
+    """
+    以排他锁打开当前的变更日志。拿到锁后若文件已被轮转 (路径指向新 inode)，重新打开新文件
+    """
+    path = _changelog_path()
+    while True:
+        f = open(path, "ab")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+            break
+        f.close()
+    try:
+        yield f
+    finally:
+        f.close()  # 关闭即释放锁
+
+
+def log_changes(doc_ids: Iterable[str]):
+    """
+    记录本进程新增 / 覆盖 / 删除的分块 ID，供其他进程回放
+    """
+    data = "".join(f"{_writer_id}\t{doc_id}\n" for doc_id in doc_ids).encode("utf-8")
+    if data:
+        with _locked_changelog() as f:
+            f.write(data)
+
+
+def _replay_changes(index: BM25Index, collection, page_size: int = 500) -> bool:
+    """
+    回放其他进程追加的变更：库中仍存在的分块重新索引，已删除的移出索引。
+    日志已被轮转 (读取位置失效) 时返回 False，需要全量对账
+    """
+    global _log_position
+    inode, offset = _log_position
+    try:
+        with open(_changelog_path(), "rb") as f:
+            if os.fstat(f.fileno()).st_ino != inode:
+                return False
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        return False
+    data = data[:data.rfind(b"\n") + 1]  # 只处理完整的行
+    changed = []
+    for line in data.decode("utf-8").splitlines():
+        writer, doc_id = line.split("\t", 1)
+        if writer != _writer_id:
+            changed.append(doc_id)
+    changed = list(dict.fromkeys(changed))
+    for start in range(0, len(changed), page_size):
+        ids = changed[start:start + page_size]
+        page = collection.get(ids=ids, include=["documents", "metadatas"])
+        index.remove_many(set(ids) - set(page["ids"]))
+        index.add_many(zip(page["ids"], page["documents"]), _content_hashes(page["ids"], page["metadatas"]))
+    _log_position = (inode, offset + len(data))
+    return True
+
+
+def _rotate_changelog(index: BM25Index, collection):
+    """
+    日志过大时轮转：持锁回放到末尾后换成空文件，轮转期间其他进程无法追加
+    """
+    global _log_position
+    if os.path.getsize(_changelog_path()) < settings.LEXICAL_CHANGELOG_MAX_BYTES:
+        return
+    with _locked_changelog():
+        if not _replay_changes(index, collection):
+            reconcile_with_collection(index, collection)
+        tmp = f"{_changelog_path()}.tmp"
+        open(tmp, "wb").close()
+        os.replace(tmp, _changelog_path())
+        _log_position = (os.stat(_changelog_path()).st_ino, 0)
+
+
+def _content_hashes(ids: List[str], metadatas: List[Optional[dict]]) -> Dict[str, Optional[str]]:
+    return {doc_id: (metadata or {}).get("content_hash") for doc_id, metadata in zip(ids, metadatas)}
+
+
+def rebuild_from_collection(collection, page_size: int = 500) -> BM25Index:
+    """
+    首次启动 (磁盘上还没有索引) 时从 Chroma 全量构建
+    """
+    index = BM25Index(settings.LEXICAL_TOKENIZER)
+    offset = 0
+    while True:
+        page = collection.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        index.add_many(zip(page["ids"], page["documents"]), _content_hashes(page["ids"], page["metadatas"]))
+        offset += len(page["ids"])
+    return index
+
+
+def reconcile_with_collection(index: BM25Index, collection, page_size: int = 500) -> int:
+    """
+    按 content_hash 与向量库对账 (只读元数据)：删除库中已不存在的文档，
+    补上缺失或内容已变的文档。返回改动的文档数
+    """
+    stored: Dict[str, Optional[str]] = {}
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        stored.update(_content_hashes(page["ids"], page["metadatas"]))
+        offset += len(page["ids"])
+
+    stale, missing = index.diff(stored)
+    if stale:
+        index.remove_many(stale)
+    for start in range(0, len(missing), page_size):
+        page = collection.get(ids=missing[start:start + page_size], include=["documents", "metadatas"])
+        index.add_many(zip(page["ids"], page["documents"]), _content_hashes(page["ids"], page["metadatas"]))
+    return len(stale) + len(missing)
+
+
+def get_lexical_index(collection=None) -> BM25Index:
+    """
+    获取共享的倒排索引：优先从磁盘加载并与 Chroma 集合对账，没有时全量构建
+    """
+    global _index, _log_position
+    if _index is None:
+        with _lock:
+            if _index is None:
+                path = settings.LEXICAL_INDEX_PATH
+                collection = collection if collection is not None else get_vector_store()._collection
+                # 先记下日志位置再对账：对账期间追加的改动下次回放时再处理一遍 (幂等)
+                _log_position = _changelog_end()
+                index = BM25Index.load(path, settings.LEXICAL_TOKENIZER)
+                if index is None:
+                    index = rebuild_from_collection(collection)
+                    index.dirty = True
+                elif reconcile_with_collection(index, collection):
+                    print(f"🔄 倒排索引已与向量库对账 ({len(index)} 篇)")
+                _index = index
+    return _index
+
+
+def flush_lexical_index():
+    """
+    回放其他进程 (其他 worker / ingest.py) 的变更日志，有改动时写盘，
+    不会用本进程的旧索引覆盖掉其他进程新增的文档
+    """
+    global _log_position
+    if _index is None:
+        return
+    with _lock:
+        collection = get_vector_store()._collection
+        if not _replay_changes(_index, collection):
+            print("🔄 变更日志已轮转，与向量库全量对账")
+            _log_position = _changelog_end()
+            reconcile_with_collection(_index, collection)
+        if _index.dirty:
+            _index.save(settings.LEXICAL_INDEX_PATH)
+        _rotate_changelog(_index, collection)
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """
+    RRF：score(d) = Σ 1 / (k + rank)，rank 从 1 开始
+    """
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
@@ -0,0 +1,414 @@
+# kb_service/core/local_store.py
+import fcntl
+import json
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+
+
+# ==========================================
+# 1. 元数据侧存储 (SQLite)
+# ==========================================
+_KEY_RE = re.compile(r"^[A-Za-z0-9_]+$")  # 元数据字段名会拼进 JSON 路径，只允许安全字符
+
+
+def _where_sql(where: Optional[dict]):
+    """
+    把 Chroma 风格的 where 条件翻译成 SQL (支持等值、$eq/$ne/$in/$nin 以及 $and/$or)
+    """
+    if not where:
+        return "1=1", []
+    if "$and" in where or "$or" in where:
+        op = "$and" if "$and" in where else "$or"
+        parts = [_where_sql(w) for w in where[op]]
+        sql = f" {'AND' if op == '$and' else 'OR'} ".join(f"({p[0]})" for p in parts)
+        return sql, [arg for p in parts for arg in p[1]]
+
+    clauses, args = [], []
+    for key, cond in where.items():
+        if not _KEY_RE.match(key):
+            raise ValueError(f"Invalid metadata key in where filter: {key!r}")
+        field = f"json_extract(metadata, '$.{key}')"
+        if not isinstance(cond, dict):
+            cond = {"$eq": cond}
+        for op, value in cond.items():
+            if op in ("$in", "$nin"):
+                marks = ",".join("?" * len(value))
+                clauses.append(f"{field} {'IN' if op == '$in' else 'NOT IN'} ({marks})")
+                args.extend(value)
+            elif op in ("$eq", "$ne"):
+                clauses.append(f"{field} {'=' if op == '$eq' else '!='} ?")
+                args.append(value)
+            else:
+                raise ValueError(f"Unsupported where operator: {op}")
+    return " AND ".join(clauses), args
+
+
+# ==========================================
+# 2. 近似索引 (IVF：k-means 粗聚类 + 只扫描最近的 nprobe 个桶)
+# ==========================================
+class IVFIndex:
+    def __init__(self, nlist: int, nprobe: int):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids = None
+        self.lists: List[np.ndarray] = []
+        self.covered = np.zeros(0, dtype=bool)  # 训练/分桶时已覆盖的行
+
+    def train(self, vectors: np.ndarray, rows: np.ndarray, iterations: int = 10, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        sample = rows if len(rows) <= self.nlist * 64 else rng.choice(rows, self.nlist * 64, replace=False)
+        data = np.asarray(vectors[np.sort(sample)])
+        centroids = data[rng.choice(len(data), min(self.nlist, len(data)), replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(data @ centroids.T, axis=1)
+            for c in range(len(centroids)):
+                members = data[assign == c]
+                if len(members):
+                    mean = members.mean(axis=0)
+                    centroids[c] = mean / (np.linalg.norm(mean) or 1.0)
+        self.centroids = centroids
+        self.assign(vectors, rows)
+
+    def assign(self, vectors: np.ndarray, rows: np.ndarray, batch: int = 8192):
+        buckets: List[List[np.ndarray]] = [[] for _ in range(len(self.centroids))]
+        for start in range(0, len(rows), batch):
+            chunk = rows[start:start + batch]
+            assign = np.argmax(np.asarray(vectors[chunk]) @ self.centroids.T, axis=1)
+            for c in np.unique(assign):
+                buckets[c].append(chunk[assign == c])
+        self.lists = [np.concatenate(b) if b else np.empty(0, dtype=np.int64) for b in buckets]
+        self.covered = np.zeros(int(rows.max()) + 1 if len(rows) else 0, dtype=bool)
+        self.covered[rows] = True
+
+    def uncovered(self, alive: np.ndarray) -> np.ndarray:
+        """
+        分桶之后新增的行：查询时直接精确扫描，超过一定比例再重新训练
+        """
+        mask = alive.copy()
+        n = min(len(mask), len(self.covered))
+        mask[:n] &= ~self.covered[:n]
+        return np.flatnonzero(mask)
+
+    def candidates(self, query: np.ndarray) -> np.ndarray:
+        probes = np.argsort(-(self.centroids @ query))[:self.nprobe]
+        return np.concatenate([self.lists[c] for c in probes])
+
+
+# ==========================================
+# 3. 兼容 chromadb.Collection 的本地集合
+# ==========================================
+class LocalCollection:
+    """
+    进程内向量集合：向量以 float32 矩阵存放在内存映射文件中 (已归一化，点积即余弦相似度)，
+    元数据与原文存放在 SQLite。只实现本服务用到的 chromadb.Collection 接口子集。
+
+    检索一律使用只读映射，多个 worker 进程共享同一份页缓存；任一进程都可以写入，
+    写入时持有目录下 write.lock 的排他文件锁，跨进程串行分配行号、扩容并写入向量。
+    写入方提交后，其他进程会在下一次访问时通过 SQLite data_version 发现变化并重新加载。
+    readonly=True 时本进程不写入 (如只负责检索的副本)。
+    """
+
+    def __init__(self, path: str, readonly: bool = False, ann: str = "none",
+                 ann_min_rows: int = 50000, nlist: int = 256, nprobe: int = 16):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.readonly = readonly
+        self.ann = ann
+        self.ann_min_rows = ann_min_rows
+        self.nlist = nlist
+        self.nprobe = nprobe
+
+        self._lock = threading.RLock()
+        self._vectors_path = os.path.join(path, "vectors.f32")
+        self._lock_path = os.path.join(path, "write.lock")
+        self._db = sqlite3.connect(os.path.join(path, "meta.sqlite3"), check_same_thread=False)
+        if not readonly:
+            self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS docs ("
+            "row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, document TEXT, metadata TEXT)"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.commit()
+
+        self.dim: Optional[int] = None
+        self._vectors: Optional[np.ndarray] = None
+        self._alive = np.zeros(0, dtype=bool)
+        self._version = None
+        self._ivf: Optional[IVFIndex] = None
+        self._refresh()
+
+    # ---------- 内部状态 ----------
+    def _refresh(self):
+        """
+        SQLite 数据有变化 (本进程或其他进程写入) 时重新加载存活行与内存映射
+        """
+        version = self._db.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._version and self._vectors is not None:
+            return
+        row = self._db.execute("SELECT value FROM kv WHERE key = 'dim'").fetchone()
+        self.dim = int(row[0]) if row else None
+        rows = np.fromiter((r for (r,) in self._db.execute("SELECT row FROM docs")), dtype=np.int64)
+        self._map()
+        self._alive = np.zeros(len(self._vectors) if self._vectors is not None else 0, dtype=bool)
+        self._alive[rows[rows < len(self._alive)]] = True
+        self._version = version
+
+    def _map(self):
+        if self.dim is None:
+            self._vectors = None
+            return
+        row_bytes = self.dim * 4
+        size = os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0
+        if size == 0:
+            self._vectors = None
+            return
+        if self._vectors is not None and len(self._vectors) * row_bytes == size:
+            return
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(size // row_bytes, self.dim))
+
+    def _grow(self, min_rows: int) -> int:
+        """
+        保证向量文件至少容纳 min_rows 行 (按 2 倍扩容，减少频繁 remap)，返回文件行数。须持有写锁
+        """
+        row_bytes = self.dim * 4
+        size = os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0
+        if size < min_rows * row_bytes:
+            capacity = max(1024, min_rows, (size // row_bytes) * 2)
+            with open(self._vectors_path, "ab") as f:
+                f.truncate(capacity * row_bytes)
+            size = capacity * row_bytes
+        return size // row_bytes
+
+    @contextmanager
+    def _writing(self):
+        """
+        跨进程写锁 (flock)：同一时刻只有一个进程在分配行号与写入；锁随进程退出自动释放
+        """
+        if self.readonly:
+            raise RuntimeError("Local vector store is opened read-only")
+        with self._lock, open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                yield
+            finally:
+                self._version = None  # 下次访问时重新加载
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _rows_for(self, ids: List[str]) -> Dict[str, int]:
+        marks = ",".join("?" * len(ids))
+        return dict(self._db.execute(f"SELECT id, row FROM docs WHERE id IN ({marks})", ids).fetchall())
+
+    def _ann_index(self):
+        """
+        返回 (IVF 索引, 未分桶的行)。集合较小或未开启时返回 (None, None) 走精确检索
+        """
+        alive_count = int(self._alive.sum())
+        if self.ann != "ivf" or alive_count < self.ann_min_rows:
+            return None, None
+        extra = self._ivf.uncovered(self._alive) if self._ivf is not None else None
+        if self._ivf is None or len(extra) > 0.1 * alive_count:
+            ivf = IVFIndex(self.nlist, self.nprobe)
+            ivf.train(self._vectors, np.flatnonzero(self._alive))
+            self._ivf = ivf
+            extra = np.empty(0, dtype=np.int64)
+        return self._ivf, extra
+
+    # ---------- chromadb.Collection 兼容接口 ----------
+    def count(self) -> int:
+        with self._lock:
+            self._refresh()
+            return int(self._alive.sum())
+
+    def upsert(self, ids: List[str], embeddings, documents=None, metadatas=None):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1.0, norms)
+        documents = documents or [None] * len(ids)
+        metadatas = metadatas or [None] * len(ids)
+
+        with self._writing():
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._db.execute("INSERT OR REPLACE INTO kv VALUES ('dim', ?)", (str(self.dim),))
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} != collection dimension {self.dim}")
+
+            existing = self._rows_for(ids)
+            next_row = (self._db.execute("SELECT COALESCE(MAX(row), -1) FROM docs").fetchone()[0]) + 1
+            rows = []
+            for doc_id in ids:
+                if doc_id not in existing:
+                    existing[doc_id] = next_row
+                    next_row += 1
+                rows.append(existing[doc_id])
+
+            writable = np.memmap(self._vectors_path, dtype=np.float32, mode="r+",
+                                 shape=(self._grow(next_row), self.dim))
+            writable[rows] = vectors
+            writable.flush()
+            del writable
+            self._db.executemany(
+                "INSERT OR REPLACE INTO docs (row, id, document, metadata) VALUES (?, ?, ?, ?)",
+                [(row, doc_id, doc, json.dumps(meta, ensure_ascii=False) if meta is not None else None)
+                 for row, doc_id, doc, meta in zip(rows, ids, documents, metadatas)],
+            )
+            self._db.commit()
+
+    add = upsert
+
+    def update(self, ids: List[str], metadatas=None, documents=None):
+        """
+        只替换已有记录的原文 / 元数据，向量不变 (不存在的 ID 忽略)
+        """
+        with self._writing():
+            if metadatas is not None:
+                self._db.executemany(
+                    "UPDATE docs SET metadata = ? WHERE id = ?",
+                    [(json.dumps(meta, ensure_ascii=False) if meta is not None else None, doc_id)
+                     for doc_id, meta in zip(ids, metadatas)],
+                )
+            if documents is not None:
+                self._db.executemany("UPDATE docs SET document = ? WHERE id = ?", list(zip(documents, ids)))
+            self._db.commit()
+
+    def delete(self, ids: List[str]):
+        with self._writing():
+            marks = ",".join("?" * len(ids))
+            self._db.execute(f"DELETE FROM docs WHERE id IN ({marks})", ids)
+            self._db.commit()
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[dict] = None,
+            limit: Optional[int] = None, offset: Optional[int] = None, include=("documents", "metadatas")):
+        with self._lock:
+            self._refresh()
+            sql, args = _where_sql(where)
+            if ids is not None:
+                sql += f" AND id IN ({','.join('?' * len(ids))})"
+                args = args + list(ids)
+            sql = f"SELECT row, id, document, metadata FROM docs WHERE {sql} ORDER BY row"
+            if limit is not None:
+                sql += f" LIMIT {int(limit)} OFFSET {int(offset or 0)}"
+            records = self._db.execute(sql, args).fetchall()
+            vectors = self._vectors
+
+        result = {"ids": [r[1] for r in records]}
+        if "documents" in include:
+            result["documents"] = [r[2] for r in records]
+        if "metadatas" in include:
+            result["metadatas"] = [json.loads(r[3]) if r[3] else None for r in records]
+        if "embeddings" in include:
+            result["embeddings"] = [np.array(vectors[r[0]]) for r in records]
+        return result
+
+    def query(self, query_embeddings, n_results: int = 10, where: Optional[dict] = None,
+              include=("documents", "metadatas", "distances")):
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+
+        with self._lock:
+            self._refresh()
+            vectors, alive = self._vectors, self._alive
+            if where:
+                sql, args = _where_sql(where)
+                allowed = np.fromiter((r for (r,) in self._db.execute(f"SELECT row FROM docs WHERE {sql}", args)),
+                                      dtype=np.int64)
+                alive = np.zeros_like(alive)
+                alive[allowed[allowed < len(alive)]] = True  # 其他进程刚追加、尚未映射的行下次刷新后可见
+            ivf, extra = (None, None) if where or vectors is None else self._ann_index()
+
+        top_rows, top_dist = [], []
+        for q in queries:
+            if vectors is None or not alive.any():
+                top_rows.append(np.empty(0, dtype=np.int64))
+                top_dist.append(np.empty(0, dtype=np.float32))
+                continue
+            if ivf is not None:
+                candidates = np.concatenate([ivf.candidates(q), extra])
+                candidates = np.unique(candidates[alive[candidates]])
+            else:
+                candidates = None
+
+            if candidates is None:
+                # 精确检索：整块矩阵乘，死行置为 -inf
+                scores = np.asarray(vectors[:len(alive)] @ q)
+                scores[~alive] = -np.inf
+                rows = np.arange(len(scores))
+            else:
+                scores = np.asarray(vectors[candidates] @ q)
+                rows = candidates
+
+            k = min(n_results, int(np.isfinite(scores).sum()))
+            if k == 0:
+                top_rows.append(np.empty(0, dtype=np.int64))
+                top_dist.append(np.empty(0, dtype=np.float32))
+                continue
+            part = np.argpartition(-scores, k - 1)[:k]
+            order = part[np.argsort(-scores[part])]
+            top_rows.append(rows[order])
+            top_dist.append(1.0 - scores[order])  # 余弦距离，越小越相关
+
+        all_rows = sorted({int(r) for rows in top_rows for r in rows})
+        records = {}
+        if all_rows:
+            with self._lock:
+                marks = ",".join("?" * len(all_rows))
+                for row, doc_id, doc, meta in self._db.execute(
+                        f"SELECT row, id, document, metadata FROM docs WHERE row IN ({marks})", all_rows):
+                    records[row] = (doc_id, doc, json.loads(meta) if meta else None)
+
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for rows, dists in zip(top_rows, top_dist):
+            hits = [(records[int(r)], float(d)) for r, d in zip(rows, dists) if int(r) in records]
+            result["ids"].append([h[0][0] for h in hits])
+            result["documents"].append([h[0][1] for h in hits])
+            result["metadatas"].append([h[0][2] for h in hits])
+            result["distances"].append([h[1] for h in hits])
+        return result
+
+
+# ==========================================
+# 4. 兼容 langchain_chroma.Chroma 的包装器
+# ==========================================
+class LocalVectorStore:
+    """
+    提供与 LangChain Chroma 包装器相同的调用方式 (本服务用到的部分)
+    """
+
+    def __init__(self, collection: LocalCollection, embedding_function):
+        self._collection = collection
+        self._embedding_function = embedding_function
+
+    @property
+    def embeddings(self):
+        return self._embedding_function
+
+    def add_documents(self, documents: List[Document], ids: List[str]):
+        vectors = self._embedding_function.embed_documents([d.page_content for d in documents])
+        self._collection.upsert(
+            ids=ids,
+            embeddings=vectors,
+            documents=[d.page_content for d in documents],
+            metadatas=[d.metadata for d in documents],
+        )
+        return ids
+
+    def delete(self, ids: List[str]):
+        self._collection.delete(ids=ids)
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: Optional[dict] = None):
+        raw = self._collection.query(
+            query_embeddings=[self._embedding_function.embed_query(query)], n_results=k, where=filter
+        )
+        return [
+            (Document(page_content=doc, metadata=meta or {}), dist)
+            for doc, meta, dist in zip(raw["documents"][0], raw["metadatas"][0], raw["distances"][0])
+        ]
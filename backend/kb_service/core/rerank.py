@@ -0,0 +1,54 @@
+# kb_service/core/rerank.py
+from typing import List, Tuple
+import numpy as np
+
+# 检索后重排：多取候选，用库中已存的文档向量做 MMR (最大边际相关)，
+# 在相关性与多样性之间取舍，避免内容几乎相同的文档 (如合并了相似问题的条目) 占满上下文。
+# 全程只用已有向量，不额外调用 Embedding 接口。
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+def mmr(query: np.ndarray, docs: np.ndarray, k: int, lambda_mult: float) -> Tuple[List[int], np.ndarray]:
+    """
+    query / docs 为已归一化向量。返回 (按选中顺序排列的下标, 每个文档与查询的余弦相似度)。
+    每步选 lambda * 相关性 - (1 - lambda) * 与已选文档的最大相似度 最大的文档
+    """
+    relevance = docs @ query
+    if len(docs) == 0 or k <= 0:
+        return [], relevance
+    pairwise = docs @ docs.T
+    selected = [int(np.argmax(relevance))]
+    max_sim = pairwise[selected[0]].copy()
+    for _ in range(1, min(k, len(docs))):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_sim
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        np.maximum(max_sim, pairwise[best], out=max_sim)
+    return selected, relevance
+
+
+def mmr_rerank(collection, query_vector, hits: List[dict], top_k: int,
+               lambda_mult: float, min_score: float) -> List[dict]:
+    """
+    hits 为候选文档 (metadata.id 为文档 ID)。从向量库取回候选的向量 (一次批量读取)，
+    丢弃与查询相似度低于 min_score 的候选后做 MMR，结果附带 relevance (余弦相似度)
+    """
+    hits = [hit for hit in hits if hit["metadata"].get("id") is not None]
+    if not hits:
+        return []  # Chroma 的 get 不接受空 ID 列表
+    raw = collection.get(ids=[hit["metadata"]["id"] for hit in hits], include=["embeddings"])
+    vectors = dict(zip(raw["ids"], raw["embeddings"]))
+    candidates = [hit for hit in hits if hit["metadata"]["id"] in vectors]
+    if not candidates:
+        return []
+
+    query = normalize(query_vector)
+    docs = normalize(np.stack([vectors[hit["metadata"]["id"]] for hit in candidates]))
+    keep = np.flatnonzero(docs @ query >= min_score)
+    selected, relevance = mmr(query, docs[keep], top_k, lambda_mult)
+    return [dict(candidates[keep[i]], relevance=round(float(relevance[i]), 4)) for i in selected]
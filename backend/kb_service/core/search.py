@@ -0,0 +1,193 @@
+# kb_service/core/search.py
+import json
+import time
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+from opentelemetry import trace
+from prometheus_client import Histogram
+from .config import settings
+from .chunking import chunk_id, join_chunks
+from .lexical import get_lexical_index, reciprocal_rank_fusion
+from .rerank import mmr_rerank
+
+tracer = trace.get_tracer("kb-service.search")
+
+SEARCH_STAGE_SECONDS = Histogram(
+    "kb_search_stage_seconds",
+    "检索各阶段耗时 (embed / vector_query / lexical / fetch / rerank / expand)",
+    ["stage"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    检索阶段计时：同时生成 kb.{name} 子 span 与直方图样本
+    """
+    start = time.perf_counter()
+    try:
+        with tracer.start_as_current_span(f"kb.{name}"):
+            yield
+    finally:
+        SEARCH_STAGE_SECONDS.labels(stage=name).observe(time.perf_counter() - start)
+
+
+def embed_queries(embeddings, texts: List[str]) -> List[List[float]]:
+    """
+    一次请求拿到所有查询向量 (带缓存时走 CachedEmbeddings.embed_queries)
+    """
+    if hasattr(embeddings, "embed_queries"):
+        return embeddings.embed_queries(texts)
+    return embeddings.embed_documents(texts)
+
+
+def batch_search(vector_store, queries: List[dict]) -> List[List[dict]]:
+    """
+    批量检索。queries 中每项为 {"query", "top_k", "filter"}，返回结果与输入顺序一致。
+    过滤条件相同的查询合并为一次 Chroma query 调用 (Chroma 的 where 对整批生效)
+    """
+    if not queries:
+        return []
+
+    with stage("embed"):
+        vectors = embed_queries(vector_store.embeddings, [q["query"] for q in queries])
+
+    groups = {}  # filter 的规范化 JSON -> 下标列表
+    for i, q in enumerate(queries):
+        key = json.dumps(q.get("filter"), sort_keys=True, ensure_ascii=False)
+        groups.setdefault(key, []).append(i)
+
+    results: List[Optional[List[dict]]] = [None] * len(queries)
+    for key, indexes in groups.items():
+        where = json.loads(key) or None
+        n_results = max(queries[i]["top_k"] for i in indexes)
+        with stage("vector_query"):
+            raw = vector_store._collection.query(
+                query_embeddings=[vectors[i] for i in indexes],
+                n_results=n_results,
+                where=where,
+                include=["documents", "metadatas", "distances"],
+            )
+        for row, i in enumerate(indexes):
+            top_k = queries[i]["top_k"]
+            results[i] = [
+                {"content": content, "metadata": metadata, "score": score}
+                for content, metadata, score in zip(
+                    raw["documents"][row][:top_k],
+                    raw["metadatas"][row][:top_k],
+                    raw["distances"][row][:top_k],
+                )
+            ]
+    return results
+
+
+def fetch_documents(collection, ids: List[str]) -> dict:
+    """
+    按 ID 取回文档内容与元数据 (倒排索引只存 ID)
+    """
+    if not ids:
+        return {}
+    with stage("fetch"):
+        raw = collection.get(ids=ids, include=["documents", "metadatas"])
+    return {
+        doc_id: {"content": content, "metadata": metadata}
+        for doc_id, content, metadata in zip(raw["ids"], raw["documents"], raw["metadatas"])
+    }
+
+
+def vector_search(vector_store, query: str, k: int) -> Tuple[List[dict], List[float]]:
+    """
+    查询向量与向量库查询分两步执行 (等价于 similarity_search_with_score)，便于分别计时；
+    同时返回查询向量，供重排复用
+    """
+    with stage("embed"):
+        vector = embed_queries(vector_store.embeddings, [query])[0]
+    with stage("vector_query"):
+        raw = vector_store._collection.query(
+            query_embeddings=[vector], n_results=k, include=["documents", "metadatas", "distances"]
+        )
+    hits = [
+        {"content": content, "metadata": metadata or {}, "score": score}
+        for content, metadata, score in zip(raw["documents"][0], raw["metadatas"][0], raw["distances"][0])
+    ]
+    return hits, vector
+
+
+def lexical_search(vector_store, query: str, k: int) -> List[dict]:
+    with stage("lexical"):
+        lexical_hits = get_lexical_index().search(query, k)
+    docs = fetch_documents(vector_store._collection, [doc_id for doc_id, _ in lexical_hits])
+    return [dict(docs[doc_id], score=score) for doc_id, score in lexical_hits if doc_id in docs]
+
+
+def hybrid_search(vector_store, query: str, k: int) -> Tuple[List[dict], List[float]]:
+    """
+    两路各多取一倍候选后做 RRF 融合
+    """
+    fetch_k = k * 2
+    with stage("lexical"):
+        lexical_hits = get_lexical_index().search(query, fetch_k)
+    vector_hits, vector = vector_search(vector_store, query, fetch_k)
+    docs = {hit["metadata"].get("id"): {"content": hit["content"], "metadata": hit["metadata"]} for hit in vector_hits}
+    fused = reciprocal_rank_fusion([list(docs), [doc_id for doc_id, _ in lexical_hits]])[:k]
+    docs.update(fetch_documents(vector_store._collection, [doc_id for doc_id, _ in fused if doc_id not in docs]))
+    return [dict(docs[doc_id], score=score) for doc_id, score in fused if doc_id in docs], vector
+
+
+def expand_neighbors(collection, hits: List[dict], window: int) -> List[dict]:
+    """
+    父文档检索：把命中的分块扩展为前后各 window 个相邻分块拼接的文本 (一次批量读取)。
+    同一文档中已被前面 (更相关) 结果覆盖的命中不再重复返回
+    """
+    spans = []
+    for hit in hits:
+        metadata = hit["metadata"]
+        count, index = metadata.get("chunk_count", 1), metadata.get("chunk_index", 0)
+        spans.append((max(0, index - window), min(count - 1, index + window)) if count > 1 else None)
+    wanted = [
+        chunk_id(hit["metadata"]["parent_id"], i, hit["metadata"]["chunk_count"])
+        for hit, span in zip(hits, spans) if span for i in range(span[0], span[1] + 1)
+    ]
+    docs = fetch_documents(collection, list(dict.fromkeys(wanted)))
+
+    results, covered = [], {}
+    for hit, span in zip(hits, spans):
+        if span is None:
+            results.append(hit)
+            continue
+        metadata = hit["metadata"]
+        parent, count = metadata["parent_id"], metadata["chunk_count"]
+        if any(lo <= metadata["chunk_index"] <= hi for lo, hi in covered.get(parent, [])):
+            continue
+        covered.setdefault(parent, []).append(span)
+        chunks = [docs[cid] for cid in (chunk_id(parent, i, count) for i in range(span[0], span[1] + 1)) if cid in docs]
+        results.append(dict(hit, content=join_chunks(chunks), metadata=dict(metadata, chunk_range=list(span))))
+    return results
+
+
+def search(vector_store, query: str, top_k: int, mode: str = "vector", rerank: bool = False,
+           expand: int = 0) -> List[dict]:
+    """
+    单条检索。mode:
+    - vector: 向量相似度，score 为距离 (越小越相关)
+    - lexical: BM25 关键词匹配，score 为 BM25 分数 (越大越相关)
+    - hybrid: 两路各多取一倍候选后做 RRF 融合，score 为 RRF 分数 (越大越相关)
+    rerank=True 时 (仅 vector / hybrid，需要查询向量) 先多取 RERANK_FETCH_FACTOR 倍候选，
+    再按相似度阈值过滤并用 MMR 重排，结果额外带 relevance (与查询的余弦相似度)。
+    结果为分块；expand > 0 时扩展为前后各 expand 个相邻分块拼接的文本
+    """
+    if mode == "lexical":
+        hits = lexical_search(vector_store, query, top_k)
+    else:
+        fetch_k = top_k * settings.RERANK_FETCH_FACTOR if rerank else top_k
+        search_fn = vector_search if mode == "vector" else hybrid_search
+        hits, vector = search_fn(vector_store, query, fetch_k)
+        if rerank:
+            with stage("rerank"):
+                hits = mmr_rerank(vector_store._collection, vector, hits, top_k,
+                                  settings.RERANK_LAMBDA, settings.RERANK_MIN_SCORE)
+    if expand > 0:
+        with stage("expand"):
+            hits = expand_neighbors(vector_store._collection, hits, expand)
+    return hits
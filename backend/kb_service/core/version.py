@@ -0,0 +1,34 @@
+# kb_service/core/version.py
+import threading
+import redis
+from .config import settings
+
+# 知识库版本号：任何写入 (新增/更新/删除) 都会递增，下游缓存 (如 llm_service 的语义缓存) 据此失效。
+# 存在 Redis 中以便多个 worker / ingest 进程共享；Redis 不可用时退化为进程内计数
+VERSION_KEY = "kb:version"
+
+_lock = threading.Lock()
+_local_version = 0
+_client = redis.Redis.from_url(settings.REDIS_URL, socket_timeout=0.2, socket_connect_timeout=0.2) \
+    if settings.REDIS_URL else None
+
+
+def get_kb_version() -> str:
+    if _client is not None:
+        try:
+            value = _client.get(VERSION_KEY)
+            return value.decode() if value else "0"
+        except redis.RedisError:
+            pass
+    return f"local-{_local_version}"
+
+
+def bump_kb_version():
+    global _local_version
+    with _lock:
+        _local_version += 1
+    if _client is not None:
+        try:
+            _client.incr(VERSION_KEY)
+        except redis.RedisError as e:
+            print(f"⚠️ 知识库版本号更新失败: {e}")
@@ -0,0 +1,65 @@
+import argparse
+import json
+import os
+import time
+from core.db import get_vector_store
+from core.search import batch_search
+
+# 默认评测集：用 data.json 中的 similar_questions 作为查询，期望召回所属文档
+DATA_PATH = os.path.join(os.path.dirname(__file__), "data.json")
+
+
+def load_eval_set(path: str):
+    """
+    读取评测集。支持两种格式：
+    1. data.json 格式 (含 similar_questions)，自动展开为 {query, expected_id}
+    2. NDJSON，每行 {"query": "...", "expected_id": "..."}
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".json"):
+            for item in json.load(f):
+                for question in item.get("similar_questions", []):
+                    yield {"query": question, "expected_id": item["id"]}
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def evaluate(path: str, top_k: int, batch_size: int):
+    print(f"🚀 开始评测: {path} (top_k={top_k}, batch_size={batch_size})")
+    vector_store = get_vector_store()
+    cases = list(load_eval_set(path))
+
+    hits, reciprocal_rank = 0, 0.0
+    start = time.perf_counter()
+    for offset in range(0, len(cases), batch_size):
+        batch = cases[offset:offset + batch_size]
+        queries = [{"query": c["query"], "top_k": top_k, "filter": c.get("filter")} for c in batch]
+        for case, results in zip(batch, batch_search(vector_store, queries)):
+            # 结果为分块：按所属文档 (parent_id) 去重后计算排名
+            ids = list(dict.fromkeys(r["metadata"].get("parent_id") or r["metadata"].get("id") for r in results))
+            if case["expected_id"] in ids:
+                hits += 1
+                reciprocal_rank += 1.0 / (ids.index(case["expected_id"]) + 1)
+    elapsed = time.perf_counter() - start
+
+    total = len(cases) or 1
+    report = {
+        "queries": len(cases),
+        f"recall@{top_k}": round(hits / total, 4),
+        "mrr": round(reciprocal_rank / total, 4),
+        "seconds": round(elapsed, 2),
+        "qps": round(len(cases) / elapsed, 1) if elapsed else None,
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="知识库离线检索评测")
+    parser.add_argument("--data", default=DATA_PATH, help="评测集路径 (.json 或 .ndjson)")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=64)
+    args = parser.parse_args()
+    evaluate(args.data, args.top_k, args.batch_size)
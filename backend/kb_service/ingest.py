@@ -1,48 +1,170 @@
+import argparse
 import json
 import os
-from langchain_core.documents import Document
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from core.db import get_vector_store
+from core.bulk import upsert_batch
+from core.lexical import get_lexical_index, flush_lexical_index
 
 # 数据文件路径
 DATA_PATH = os.path.join(os.path.dirname(__file__), "data.json")
 
 
-def ingest_data():
-    print(f"🚀 开始加载数据: {DATA_PATH}")
+# ==========================================
+# 1. 流式读取 (JSON 数组 / NDJSON)
+# ==========================================
+def iter_records(path: str, chunk_size: int = 1 << 16):
+    """
+    逐条读取数据，不把整个文件加载进内存。
+    文件以 '[' 开头按 JSON 数组解析，否则按 NDJSON (每行一个对象) 解析
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        head = f.read(1)
+        while head and head.isspace():
+            head = f.read(1)
+        if head != "[":
+            if head:
+                first_line = head + f.readline()
+                if first_line.strip():
+                    yield json.loads(first_line)
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
 
-    # 1. 读取 JSON
-    with open(DATA_PATH, "r", encoding="utf-8") as f:
-        data = json.load(f)
+        decoder = json.JSONDecoder()
+        buffer = ""
+        while True:
+            buffer = buffer.lstrip().lstrip(",").lstrip()
+            if buffer.startswith("]"):
+                return
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    if buffer.strip():
+                        raise
+                    return
+                buffer += chunk
+                continue
+            yield item
+            buffer = buffer[end:]
 
-    # 2. 转换为 LangChain Document 对象
-    documents = []
-    for item in data:
-        # 将 similar_questions 合并到 content 中，增加被召回的概率
-        enhanced_content = f"{item['content']}\n\n相关问题参考:\n" + "\n".join(item['similar_questions'])
 
-        doc = Document(
-            page_content=enhanced_content,
-            metadata={
-                "id": item["id"],
-                "category": item["category"],
-                "topic": item["topic"],
-                "source": item["source"]
-            }
-        )
-        documents.append(doc)
+# ==========================================
+# 2. 断点续传
+# ==========================================
+def checkpoint_path(path: str) -> str:
+    return f"{path}.checkpoint.json"
 
-    print(f"📄 解析完成，共 {len(documents)} 条文档。正在向量化并存入 Chroma...")
 
-    # 3. 获取向量库连接
-    vector_store = get_vector_store()
+def load_checkpoint(path: str) -> int:
+    try:
+        with open(checkpoint_path(path), "r", encoding="utf-8") as f:
+            return json.load(f).get("done_records", 0)
+    except FileNotFoundError:
+        return 0
 
-    # 4. 存入数据 (add_documents 会自动调用 OpenAI Embedding API)
-    # ids 确保如果重复运行，可以通过 ID 去重或更新（取决于具体实现，Chroma通常需要手动处理去重，这里先简化直接添加）
-    ids = [d.metadata["id"] for d in documents]
-    vector_store.add_documents(documents=documents, ids=ids)
 
-    print("✅ 数据入库成功！")
+def save_checkpoint(path: str, done_records: int):
+    tmp = checkpoint_path(path) + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"done_records": done_records}, f)
+    os.replace(tmp, checkpoint_path(path))
+
+
+# ==========================================
+# 3. 批处理 (去重 -> Embedding -> upsert)
+# ==========================================
+def process_batch(collection, items, retries: int):
+    statuses, tokens = upsert_batch(collection, items, retries)
+    embedded = sum(1 for s in statuses.values() if s == "upserted")
+    return embedded, len(statuses) - embedded, tokens
+
+
+def iter_batches(records, batch_size: int):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def ingest_data(path: str = DATA_PATH, batch_size: int = 64, concurrency: int = 4,
+                retries: int = 3, resume: bool = True):
+    print(f"🚀 开始加载数据: {path}")
+    collection = get_vector_store()._collection
+    get_lexical_index(collection)
+
+    skip = load_checkpoint(path) if resume else 0
+    if skip:
+        print(f"⏩ 从断点继续，跳过前 {skip} 条记录")
+
+    records = iter_records(path)
+    for _ in range(skip):
+        next(records, None)
+
+    stats = {"embedded": 0, "skipped": 0, "tokens": 0}
+    start = time.perf_counter()
+
+    # 按提交顺序记录每批的结束位置，只有连续完成的前缀才写入断点
+    order, finished, done_records = [], set(), skip
+    pending = {}
+
+    def collect(futures):
+        nonlocal done_records
+        for future in futures:
+            batch_no, end = pending.pop(future)
+            embedded, skipped, tokens = future.result()  # 重试耗尽时在这里抛出，断点保持不变
+            stats["embedded"] += embedded
+            stats["skipped"] += skipped
+            stats["tokens"] += tokens
+            finished.add(batch_no)
+        while order and order[0][0] in finished:
+            _, done_records = order.pop(0)
+        save_checkpoint(path, done_records)
+        total = stats["embedded"] + stats["skipped"]
+        print(f"📄 已处理 {total} 条 (新增/更新 {stats['embedded']}，未变更 {stats['skipped']})，"
+              f"{total / (time.perf_counter() - start):.1f} docs/s")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        position = skip
+        for batch_no, batch in enumerate(iter_batches(records, batch_size)):
+            # 有界并发：在途批次过多时先等一批完成，保证内存占用恒定
+            if len(pending) >= concurrency * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            position += len(batch)
+            order.append((batch_no, position))
+            pending[pool.submit(process_batch, collection, batch, retries)] = (batch_no, position)
+        if pending:
+            done, _ = wait(pending)
+            collect(done)
+
+    # 倒排索引写盘，运行中的 kb_service 在下次刷新时发现文件更新，与向量库对账
+    flush_lexical_index()
+
+    elapsed = time.perf_counter() - start
+    total = stats["embedded"] + stats["skipped"]
+    if os.path.exists(checkpoint_path(path)):
+        os.remove(checkpoint_path(path))
+    print(f"✅ 数据入库成功！共 {total} 条，新增/更新 {stats['embedded']}，跳过 {stats['skipped']}，"
+          f"耗时 {elapsed:.1f}s ({total / elapsed if elapsed else 0:.1f} docs/s)，"
+          f"Embedding tokens: {stats['tokens']}")
+    return stats
 
 
 if __name__ == "__main__":
-    ingest_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="知识库批量入库 (增量、可断点续传)")
+    parser.add_argument("--data", default=DATA_PATH, help="数据文件 (JSON 数组或 NDJSON)")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--no-resume", action="store_true", help="忽略断点，从头开始")
+    args = parser.parse_args()
+    ingest_data(args.data, args.batch_size, args.concurrency, args.retries, not args.no_resume)
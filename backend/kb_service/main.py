@@ -1,36 +1,71 @@
-from fastapi import FastAPI, HTTPException, status, Path, Depends, Security
-from pydantic import BaseModel, Field
-from typing import List, Optional
-from core.db import get_vector_store
-from langchain_core.documents import Document
+from fastapi import FastAPI, HTTPException, status, Path, Depends, Security, Request
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, Literal, Optional
+from core.db import run_with_reconnect, warm_up, is_ready, get_vector_store
+from core.search import batch_search, search, embed_queries
+from core.version import get_kb_version
+from core.lexical import get_lexical_index, flush_lexical_index
+from core.bulk import upsert_batch, delete_batch
+from core.config import settings
 from fastapi.security import APIKeyHeader
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
+from contextlib import asynccontextmanager
+import asyncio
+import json
 import os
-from prometheus_fastapi_instrumentator import Instrumentator
-from opentelemetry import trace
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+import tempfile
+from common.observability import instrument_app, start_tracing, shutdown_tracing
 
-app = FastAPI(title="Knowledge Base Service")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_tracing("kb-service")
+    # 启动时预热向量库连接；失败不阻塞启动，由后台任务重试 (连接重建后同样重新预热)
+    try:
+        await run_in_threadpool(warm_up)
+        print("✅ Vector store warmed up")
+    except Exception as e:
+        print(f"⚠️ Vector store warm-up failed: {e}")
+
+    async def warm_up_loop():
+        while True:
+            await asyncio.sleep(settings.WARMUP_RETRY_INTERVAL)
+            if is_ready():
+                continue
+            try:
+                await run_in_threadpool(warm_up)
+                print("✅ Vector store warmed up")
+            except Exception as e:
+                print(f"⚠️ Vector store warm-up failed: {e}")
+
+    # 加载 BM25 倒排索引 (磁盘上没有时从 Chroma 构建一次)，并定期写盘
+    try:
+        index = await run_in_threadpool(lambda: get_lexical_index(get_vector_store()._collection))
+        print(f"✅ Lexical index loaded ({len(index)} docs)")
+    except Exception as e:
+        print(f"⚠️ Lexical index load failed: {e}")
 
-# 自动通过 /metrics 接口暴露指标
-Instrumentator().instrument(app).expose(app)
+    async def flush_loop():
+        while True:
+            await asyncio.sleep(settings.LEXICAL_FLUSH_INTERVAL)
+            try:
+                await run_in_threadpool(flush_lexical_index)
+            except Exception as e:
+                print(f"⚠️ Lexical index flush failed: {e}")
 
-# 设置服务名称
-resource = Resource(attributes={SERVICE_NAME: "kb-service"})
+    flush_task = asyncio.create_task(flush_loop())
+    warm_up_task = asyncio.create_task(warm_up_loop())
+    yield
+    flush_task.cancel()
+    warm_up_task.cancel()
+    await run_in_threadpool(flush_lexical_index)
+    shutdown_tracing()
 
-provider = TracerProvider(resource=resource)
 
-# 配置导出器 (发送到 Jaeger 容器的 4317 端口)
-otlp_exporter = OTLPSpanExporter(endpoint="http://jaeger:4317", insecure=True)
-span_processor = BatchSpanProcessor(otlp_exporter)
-provider.add_span_processor(span_processor)
-trace.set_tracer_provider(provider)
+app = FastAPI(title="Knowledge Base Service", lifespan=lifespan)
 
-# 自动植入 FastAPI
-FastAPIInstrumentor.instrument_app(app)
+# 自动通过 /metrics 接口暴露指标；追踪在 lifespan 中按配置启用
+instrument_app(app)
 
 #零信任安全逻辑
 INTERNAL_KEY = os.getenv("INTERNAL_API_KEY")
@@ -56,6 +91,29 @@ class KnowledgeDoc(BaseModel):
 class SearchRequest(BaseModel):
     query: str
     top_k: int = 3
+    mode: Literal["vector", "lexical", "hybrid"] = Field(
+        default_factory=lambda: settings.SEARCH_MODE, description="检索模式：向量 / 关键词 (BM25) / 混合 (RRF 融合)"
+    )
+    rerank: bool = Field(
+        default_factory=lambda: settings.RERANK_ENABLED, description="MMR 重排 + 相似度阈值过滤 (关键词模式不生效)"
+    )
+    expand: int = Field(
+        default_factory=lambda: settings.SEARCH_EXPAND, ge=0, le=5, description="命中分块向前后各扩展的相邻分块数"
+    )
+
+
+class EmbeddingRequest(BaseModel):
+    texts: List[str] = Field(..., max_length=256)
+
+
+class BatchQuery(BaseModel):
+    query: str
+    top_k: int = Field(3, ge=1, le=50)
+    filter: Optional[dict] = Field(None, description="Chroma metadata 过滤条件，如 {\"category\": \"RAG技术\"}")
+
+
+class BatchSearchRequest(BaseModel):
+    queries: List[BatchQuery] = Field(..., max_length=256)
 
 
 # --- RESTful 接口 ---
@@ -64,24 +122,20 @@ def health_check():
     return {"status": "healthy"}
 
 
+# 就绪检查：预热完成前返回 503，供编排系统决定何时切流量 (只读状态，预热由 lifespan 后台任务负责)
+@app.get("/ready")
+def readiness_check():
+    if not is_ready():
+        return JSONResponse(status_code=503, content={"status": "not ready"})
+    return {"status": "ready"}
+
+
 # 1. 新增知识 (Create)
 @app.post("/documents", status_code=status.HTTP_201_CREATED, dependencies=[Depends(verify_internal_key)])
 def create_document(doc: KnowledgeDoc):
     try:
-        vector_store = get_vector_store()
-
-        # 转换为 LangChain Document
-        new_doc = Document(
-            page_content=doc.content,
-            metadata={
-                "id": doc.id,
-                "category": doc.category,
-                "source": doc.source
-            }
-        )
-
-        # 存入 Chroma
-        vector_store.add_documents(documents=[new_doc], ids=[doc.id])
+        # 切分为分块后存入 Chroma (同 ID 的旧版本分块一并替换)
+        run_with_reconnect(lambda vs: upsert_batch(vs._collection, [doc.model_dump()]))
         return {"message": "Document created successfully", "id": doc.id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -91,9 +145,8 @@ def create_document(doc: KnowledgeDoc):
 @app.delete("/documents/{doc_id}", status_code=status.HTTP_204_NO_CONTENT, dependencies=[Depends(verify_internal_key)])
 def delete_document(doc_id: str = Path(...)):
     try:
-        vector_store = get_vector_store()
-        # Chroma 的 delete 方法
-        vector_store.delete(ids=[doc_id])
+        # 按 parent_id 删除该文档的全部分块
+        run_with_reconnect(lambda vs: delete_batch(vs._collection, [doc_id]))
         return  # 204 不返回内容
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -103,16 +156,116 @@ def delete_document(doc_id: str = Path(...)):
 @app.post("/documents/search", dependencies=[Depends(verify_internal_key)])
 def search_documents(request: SearchRequest):
     try:
-        vector_store = get_vector_store()
-        results = vector_store.similarity_search_with_score(request.query, k=request.top_k)
-
-        response = []
-        for doc, score in results:
-            response.append({
-                "content": doc.page_content,
-                "metadata": doc.metadata,
-                "score": score
-            })
-        return {"results": response}
+        results = run_with_reconnect(lambda vs: search(vs, request.query, request.top_k, request.mode, request.rerank, request.expand))
+        return {"results": results}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# 4. 批量检索 (一次 Embedding 请求 + 按过滤条件分组的 Chroma 批量查询)
+@app.post("/documents/search/batch", dependencies=[Depends(verify_internal_key)])
+def batch_search_documents(request: BatchSearchRequest):
+    try:
+        queries = [q.model_dump() for q in request.queries]
+        results = run_with_reconnect(lambda vs: batch_search(vs, queries))
+        return {"results": [{"query": q["query"], "results": r} for q, r in zip(queries, results)]}
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# ==========================================
+# 5. 批量接口 (NDJSON 流式上传与返回，按批写入，内存占用与请求体大小无关)
+# ==========================================
+class DocRef(BaseModel):
+    id: str
+
+
+async def iter_ndjson(request: Request):
+    """
+    逐行读取 NDJSON 请求体，返回 (行号, 原始行)
+    """
+    buffer = b""
+    line_no = 0
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_no += 1
+            if line.strip():
+                yield line_no, line
+    if buffer.strip():
+        yield line_no + 1, buffer
+
+
+async def run_bulk(request: Request, model, handler):
+    """
+    解析 -> 攒批 -> 线程池中执行 handler(collection, batch)，以 NDJSON 逐行返回每条记录的状态，末行为汇总。
+    状态行先写入临时文件，读完请求体后再流式返回：客户端 (如 httpx) 发完请求体才开始读响应，
+    边读边回会在响应写满 socket 缓冲区后互相等待。内存占用与文档数无关
+    """
+    spool = tempfile.TemporaryFile()
+    counts = {}
+
+    def record(entry):
+        spool.write(json.dumps(entry, ensure_ascii=False).encode("utf-8") + b"\n")
+        counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+
+    async def flush(batch):
+        try:
+            statuses = await run_in_threadpool(
+                run_with_reconnect, lambda vs: handler(vs._collection, [item for _, item in batch])
+            )
+        except Exception as e:
+            for line_no, item in batch:
+                record({"id": item["id"], "line": line_no, "status": "error", "detail": str(e)})
+            return
+        # 按行输出，同一批内的重复 ID 各占一行
+        for line_no, item in batch:
+            record({"id": item["id"], "line": line_no, "status": statuses[item["id"]]})
+
+    try:
+        batch = []
+        async for line_no, line in iter_ndjson(request):
+            try:
+                batch.append((line_no, model.model_validate_json(line).model_dump()))
+            except ValidationError as e:
+                record({"line": line_no, "status": "error", "detail": e.errors(include_url=False, include_input=False)})
+                continue
+            if len(batch) >= settings.BULK_BATCH_SIZE:
+                await flush(batch)
+                batch = []
+        if batch:
+            await flush(batch)
+        spool.write(json.dumps({"counts": counts}).encode("utf-8") + b"\n")
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+
+    def lines():
+        with spool:
+            yield from iter(lambda: spool.read(64 * 1024), b"")
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+# 批量新增/更新 (幂等：相同 ID 覆盖写入，内容未变则跳过，只改元数据时不重新 Embedding)
+@app.post("/documents/bulk", dependencies=[Depends(verify_internal_key)])
+async def bulk_upsert_documents(request: Request):
+    return await run_bulk(request, KnowledgeDoc, lambda collection, items: upsert_batch(collection, items)[0])
+
+
+# 批量删除，每行 {"id": "..."}
+@app.post("/documents/bulk-delete", dependencies=[Depends(verify_internal_key)])
+async def bulk_delete_documents(request: Request):
+    return await run_bulk(request, DocRef, lambda collection, items: delete_batch(collection, [i["id"] for i in items]))
+
+
+# 6. 查询向量 (复用查询向量缓存)，同时返回知识库版本号，供下游做语义缓存
+@app.post("/embeddings", dependencies=[Depends(verify_internal_key)])
+def create_embeddings(request: EmbeddingRequest):
+    try:
+        vectors = run_with_reconnect(lambda vs: embed_queries(vs.embeddings, request.texts))
+        return {"embeddings": vectors, "model": settings.EMBEDDING_MODEL_NAME, "kb_version": get_kb_version()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
@@ -9,9 +9,40 @@ class Config:
     OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
     LLM_MODEL_NAME = os.getenv("LLM_MODEL_NAME", "qwen-plus")
     KB_SERVICE_URL = os.getenv("KB_SERVICE_URL", "http://kb-service:8000")
+    AUTH_SERVICE_URL = os.getenv("AUTH_SERVICE_URL", "http://auth-service:8000")
     REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
     SESSION_TTL = int(os.getenv("SESSION_TTL", 3600))
+    REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 100))
+    # 送入 prompt 的历史消息 token 上限，超出部分在后台折叠为滚动摘要
+    HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", 2000))
     INTERNAL_API_KEY = os.getenv("INTERNAL_API_KEY")
 
+    # 检索条数与【检索知识】的 token 预算 (超出部分在句子边界截断)
+    RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", 3))
+    CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 1200))
+
+    # 预取检索结果的保留时间 (秒)，超时未被聊天请求取走则丢弃
+    PREFETCH_TTL = float(os.getenv("PREFETCH_TTL", 10))
+
+    # 请求合并：相同问题的并发检索共享一次调用；无历史的相同首轮提问在窗口期内共享一次生成
+    COALESCE_GENERATION = os.getenv("COALESCE_GENERATION", "true").lower() == "true"
+    COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", 2.0))
+
+    # 每次回答结束后向 Auth Service 上报 token 用量 (计费)
+    METERING_ENABLED = os.getenv("METERING_ENABLED", "true").lower() == "true"
+
+    # SSE 输出合并：首 token 立即发送，之后缓冲满 SSE_FLUSH_BYTES 字节或等待 SSE_FLUSH_MS 毫秒即发送一帧
+    SSE_FLUSH_MS = float(os.getenv("SSE_FLUSH_MS", 40))
+    SSE_FLUSH_BYTES = int(os.getenv("SSE_FLUSH_BYTES", 512))
+
+    # 结构化日志采样率 (0~1)：正常路径按比例输出，错误日志始终输出
+    LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.01))
+
+    # 语义答案缓存 (默认关闭)：仅对无历史的首轮提问生效
+    SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.95))
+    SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 5000))
+    SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", 24 * 3600))
+
 
 settings = Config()
\ No newline at end of file
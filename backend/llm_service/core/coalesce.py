@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional
+from prometheus_client import Counter
+
+COALESCED_REQUESTS = Counter(
+    "llm_coalesced_requests_total",
+    "Requests served by a shared in-flight call (leader = made the upstream call, follower = joined it)",
+    ["kind", "role"],
+)
+
+
+def coalesce_key(*parts: str) -> str:
+    text = "\x00".join(" ".join(p.split()).lower() for p in parts)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    """
+    相同 key 的并发调用只执行一次，其余调用等待并共享同一个结果
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable]):
+        task = self._inflight.get(key)
+        if task is None:
+            COALESCED_REQUESTS.labels(kind=self.kind, role="leader").inc()
+            task = asyncio.create_task(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            COALESCED_REQUESTS.labels(kind=self.kind, role="follower").inc()
+        # shield：某个调用方断开 (被取消) 时不影响其他等待者
+        return await asyncio.shield(task)
+
+
+class _Broadcast:
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.started = time.monotonic()
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None  # 消费上游流的任务 (持有引用，防止被垃圾回收)
+        self._changed = asyncio.Event()
+
+    def publish(self, chunk=None, done=False, error=None):
+        if chunk is not None:
+            self.chunks.append(chunk)
+        self.done = self.done or done
+        self.error = error or self.error
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self):
+        await self._changed.wait()
+
+
+class StreamFanout:
+    """
+    相同 key 的流式生成在时间窗口内只向上游发起一次，token 广播给所有订阅者；
+    后加入的订阅者先收到已经生成的 token，再跟随实时流。
+    上游流由独立任务消费，任一客户端断开都不会中断其他客户端；所有订阅者都断开后取消上游调用
+    """
+
+    def __init__(self, kind: str, window: float):
+        self.kind = kind
+        self.window = window
+        self._streams: Dict[str, _Broadcast] = {}
+
+    def _expire(self):
+        now = time.monotonic()
+        for key in [k for k, b in self._streams.items() if b.done and now - b.started > self.window]:
+            self._streams.pop(key, None)
+
+    async def _produce(self, broadcast: _Broadcast, factory: Callable[[], AsyncIterator]):
+        try:
+            async for chunk in factory():
+                broadcast.publish(chunk)
+            broadcast.publish(done=True)
+        except Exception as e:
+            broadcast.publish(done=True, error=e)
+
+    async def subscribe(self, key: str, factory: Callable[[], AsyncIterator],
+                        on_join: Optional[Callable[[str], None]] = None) -> AsyncIterator:
+        """
+        on_join 在开始消费时收到本订阅者的角色 (leader / follower)；
+        follower 收到的是 leader 那次上游调用的重放 (含用量)
+        """
+        self._expire()
+        broadcast = self._streams.get(key)
+        if broadcast is None or (broadcast.error is not None):
+            role = "leader"
+            broadcast = _Broadcast()
+            self._streams[key] = broadcast
+            broadcast.task = asyncio.create_task(self._produce(broadcast, factory))
+        else:
+            role = "follower"
+        COALESCED_REQUESTS.labels(kind=self.kind, role=role).inc()
+        if on_join is not None:
+            on_join(role)
+
+        broadcast.subscribers += 1
+        try:
+            index = 0
+            while True:
+                if index < len(broadcast.chunks):
+                    chunk = broadcast.chunks[index]
+                    index += 1
+                    yield chunk
+                elif broadcast.done:
+                    if broadcast.error is not None:
+                        raise broadcast.error
+                    return
+                else:
+                    await broadcast.wait()
+        finally:
+            broadcast.subscribers -= 1
+            if broadcast.subscribers == 0 and not broadcast.done:
+                self._abandon(key, broadcast)
+
+    def _abandon(self, key: str, broadcast: _Broadcast):
+        # 没有人再接收输出：停止向上游拉取 token，之后相同的请求重新发起
+        broadcast.task.cancel()
+        broadcast.publish(done=True, error=RuntimeError("stream abandoned by all subscribers"))
+        if self._streams.get(key) is broadcast:
+            self._streams.pop(key, None)
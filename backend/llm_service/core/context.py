@@ -0,0 +1,51 @@
+import re
+from typing import List, Tuple
+from core.memory import count_tokens
+
+# 检索结果 -> Prompt 中的【检索知识】：按 KB Service 返回的顺序 (已做 MMR 重排) 依次放入，
+# 总量不超过 token 预算；放不下的文档在句子边界截断，不在句子中间切断。
+
+# KB Service 入库时把相似问题拼接在正文之后 (见 kb_service/core/bulk.py)，只用于提高召回，送入 Prompt 前去掉
+SIMILAR_QUESTIONS_MARKER = "\n\n相关问题参考:"
+# 按句末标点切分并保留标点 (英文句号要求后跟空白，避免切断小数、版本号)
+SENTENCE_END = re.compile(r"(?<=[。！？!?；\n])|(?<=\.\s)")
+SEPARATOR = "\n\n"
+
+
+def truncate_sentences(text: str, budget: int) -> str:
+    """
+    取不超过 budget 个 token 的最长整句前缀；第一句就放不下时返回空串
+    """
+    kept, used = [], 0
+    for sentence in SENTENCE_END.split(text):
+        if not sentence:
+            continue
+        cost = count_tokens(sentence)
+        if used + cost > budget:
+            break
+        kept.append(sentence)
+        used += cost
+    return "".join(kept).rstrip()
+
+
+def pack_context(results: List[dict], budget: int) -> Tuple[str, int]:
+    """
+    返回 (上下文文本, 估算 token 数)
+    """
+    parts, used = [], 0
+    for item in results:
+        content = item["content"].split(SIMILAR_QUESTIONS_MARKER, 1)[0].strip()
+        header = f"文档{len(parts) + 1}: "
+        overhead = count_tokens(header) + (count_tokens(SEPARATOR) if parts else 0)
+        remaining = budget - used - overhead
+        if remaining <= 0:
+            break
+        cost = count_tokens(content)
+        if cost > remaining:
+            content = truncate_sentences(content, remaining)
+            if not content:
+                break
+            cost = count_tokens(content)
+        parts.append(header + content)
+        used += overhead + cost
+    return SEPARATOR.join(parts), used
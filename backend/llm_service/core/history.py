@@ -0,0 +1,148 @@
+import json
+from typing import List, Sequence
+import redis
+import redis.asyncio as aioredis
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import (
+    AIMessage, BaseMessage, HumanMessage, SystemMessage, message_to_dict, messages_from_dict,
+)
+from config import settings
+
+# 共享连接池：所有会话复用同一组 Redis 连接
+redis_pool = aioredis.ConnectionPool.from_url(settings.REDIS_URL, max_connections=settings.REDIS_MAX_CONNECTIONS)
+redis_client = aioredis.Redis(connection_pool=redis_pool)
+
+# 新格式使用独立的 key 前缀，避免与旧版 RedisChatMessageHistory (message_store:) 的数据混读。
+# 旧版用 LPUSH 写入 (最新的在前)，读取时若新 key 不存在而旧 key 存在，原子地按时间顺序搬到新 key
+# 并删除旧 key (保留剩余 TTL)，升级前的会话不会丢失历史
+KEY_PREFIX = "chat_history:"
+LEGACY_KEY_PREFIX = "message_store:"
+
+READ_OR_MIGRATE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('LRANGE', KEYS[1], 0, -1)
+end
+local old = redis.call('LRANGE', KEYS[2], 0, -1)
+if #old == 0 then
+    return {}
+end
+for i = #old, 1, -1 do
+    redis.call('RPUSH', KEYS[1], old[i])
+end
+local ttl = redis.call('PTTL', KEYS[2])
+if ttl > 0 then
+    redis.call('PEXPIRE', KEYS[1], ttl)
+end
+redis.call('DEL', KEYS[2])
+return redis.call('LRANGE', KEYS[1], 0, -1)
+"""
+read_or_migrate = redis_client.register_script(READ_OR_MIGRATE_LUA)
+
+# 同步接口共用一个客户端 (自带连接池)，首次使用时创建
+_sync_client = None
+_sync_read_or_migrate = None
+
+
+def sync_redis():
+    """
+    返回 (同步客户端, 读取/迁移脚本)
+    """
+    global _sync_client, _sync_read_or_migrate
+    if _sync_client is None:
+        client = redis.Redis.from_url(settings.REDIS_URL)
+        _sync_read_or_migrate = client.register_script(READ_OR_MIGRATE_LUA)
+        _sync_client = client
+    return _sync_client, _sync_read_or_migrate
+
+
+# 紧凑序列化：常见消息类型只存 {"t": 类型缩写, "c": 内容}，其余类型退回 LangChain 完整格式
+_SHORT_TYPES = {HumanMessage: "h", AIMessage: "a", SystemMessage: "s"}
+_FROM_SHORT = {v: k for k, v in _SHORT_TYPES.items()}
+
+
+def encode_message(message: BaseMessage) -> str:
+    short = _SHORT_TYPES.get(type(message))
+    if short and isinstance(message.content, str) and not message.additional_kwargs:
+        payload = {"t": short, "c": message.content}
+    else:
+        payload = {"t": "x", "d": message_to_dict(message)}
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+
+
+def decode_message(raw) -> BaseMessage:
+    payload = json.loads(raw)
+    if "t" not in payload:
+        # 从旧版 message_store: 迁移过来的消息，仍是 LangChain 完整格式
+        return messages_from_dict([payload])[0]
+    if payload["t"] == "x":
+        return messages_from_dict([payload["d"]])[0]
+    return _FROM_SHORT[payload["t"]](content=payload["c"])
+
+
+def history_key(session_id: str) -> str:
+    return f"{KEY_PREFIX}{session_id}"
+
+
+class AsyncRedisChatMessageHistory(BaseChatMessageHistory):
+    """
+    基于 redis.asyncio 的会话历史，可直接替换 RedisChatMessageHistory。
+    RunnableWithMessageHistory.astream 走 aget_messages / aadd_messages，不会阻塞事件循环；
+    一轮对话的提问与回答在一次 pipeline 中写入，并同时刷新 TTL
+    """
+
+    def __init__(self, session_id: str, ttl: int = None, client: aioredis.Redis = None):
+        self.session_id = session_id
+        self.key = history_key(session_id)
+        self.legacy_key = f"{LEGACY_KEY_PREFIX}{session_id}"
+        self.ttl = ttl
+        self.client = client or redis_client
+
+    def read_raw(self, client=None):
+        """
+        读取原始消息列表 (必要时从旧前缀迁移)；client 可传入 pipeline，与其他命令一起发送
+        """
+        return read_or_migrate(keys=[self.key, self.legacy_key], client=client or self.client)
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        return [decode_message(raw) for raw in await self.read_raw()]
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        if not messages:
+            return
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.rpush(self.key, *[encode_message(m) for m in messages])
+            if self.ttl:
+                for key in self.ttl_keys():
+                    pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    def ttl_keys(self) -> List[str]:
+        # 每次追加消息时一并续期的 key (子类有附属数据时扩展)
+        return [self.key]
+
+    async def aclear(self) -> None:
+        await self.client.delete(self.key, self.legacy_key)
+
+    async def alength(self) -> int:
+        return await self.client.llen(self.key) or await self.client.llen(self.legacy_key)
+
+    # ---------- 同步接口 (兼容 BaseChatMessageHistory，仅供非异步调用方使用) ----------
+    @property
+    def messages(self) -> List[BaseMessage]:
+        _, read = sync_redis()
+        return [decode_message(raw) for raw in read(keys=[self.key, self.legacy_key])]
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        if not messages:
+            return
+        client, _ = sync_redis()
+        pipe = client.pipeline(transaction=False)
+        pipe.rpush(self.key, *[encode_message(m) for m in messages])
+        if self.ttl:
+            for key in self.ttl_keys():
+                pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def clear(self) -> None:
+        client, _ = sync_redis()
+        client.delete(self.key, self.legacy_key)
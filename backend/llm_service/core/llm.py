@@ -1,10 +1,28 @@
+import asyncio
+import functools
+import hashlib
+import time
 import httpx
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.output_parsers import StrOutputParser
-from langchain_community.chat_message_histories import RedisChatMessageHistory
-from langchain_core.runnables.history import RunnableWithMessageHistory
+from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.runnables import RunnableLambda
 from config import settings
+from core.memory import WindowedChatMessageHistory, record_prompt_tokens
+from core.context import pack_context, count_tokens
+from core.semantic_cache import semantic_cache, embed_with_kb_version, CACHE_REQUESTS
+from core.coalesce import SingleFlight, StreamFanout, coalesce_key
+from core.metering import report_usage
+from core.telemetry import tracer, log_event, INTER_TOKEN_SECONDS, TOKENS_PER_SECOND, OUTPUT_TOKENS
+from prometheus_client import Histogram
+
+STAGE_SECONDS = Histogram(
+    "llm_rag_stage_seconds",
+    "Latency of each RAG stage (retrieval / history / semantic_cache / prepare / prompt / ttft / generate)",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
 
 # 1. 初始化模型
 llm = ChatOpenAI(
@@ -12,7 +30,8 @@ llm = ChatOpenAI(
     base_url=settings.OPENAI_BASE_URL,
     model=settings.LLM_MODEL_NAME,
     temperature=0.1,  # 降低温度，让它更死板、更听话
-    streaming=True
+    streaming=True,
+    stream_usage=True  # 流式最后一个 chunk 带回真实 token 用量
 )
 
 # 2. 这里的 Prompt 模板写得越严厉越好
@@ -35,67 +54,278 @@ prompt_template = ChatPromptTemplate.from_messages([
 ])
 
 
-# 3. Redis History
+summary_prompt = ChatPromptTemplate.from_messages([
+    ("system", "你负责压缩客服对话记录。请把【已有摘要】与【新增对话】合并为一段简洁的中文摘要，"
+               "保留用户的问题、关键事实和结论，不超过 300 字。"),
+    ("human", "【已有摘要】：\n{summary}\n\n【新增对话】：\n{dialogue}"),
+])
+
+
+# 4. Prompt 组装 (含 prompt token 计数) 在导入时构建一次，所有请求复用；
+#    与生成 (llm.astream，输出 AIMessageChunk 以便读取 usage_metadata) 分开执行，两段分别计时
+prompt_chain = prompt_template | RunnableLambda(record_prompt_tokens)
+
+
+async def summarize_history(summary: str, messages, username: str = None):
+    dialogue = "\n".join(f"{'用户' if m.type == 'human' else '客服'}：{m.content}" for m in messages)
+    reply = await (summary_prompt | llm).ainvoke({"summary": summary or "无", "dialogue": dialogue})
+    if username and reply.usage_metadata:
+        # 摘要同样调用模型，用量计入会话所属用户
+        report_usage(username, {"usage": {
+            "prompt_tokens": reply.usage_metadata["input_tokens"],
+            "completion_tokens": reply.usage_metadata["output_tokens"],
+        }, "source": "summary"})
+    return StrOutputParser().invoke(reply)
+
+
+# 3. Redis History (异步，共享连接池；按 token 预算截断，旧消息后台折叠为摘要)
 def get_message_history(session_id: str):
-    return RedisChatMessageHistory(
+    return WindowedChatMessageHistory(
         session_id=session_id,
-        url=settings.REDIS_URL,
-        ttl=settings.SESSION_TTL
+        ttl=settings.SESSION_TTL,
+        token_budget=settings.HISTORY_TOKEN_BUDGET,
+        summarizer=functools.partial(summarize_history, username=session_id),  # 会话 ID 即用户名
     )
 
 
+async def has_history(session_id: str) -> bool:
+    return await get_message_history(session_id).alength() > 0
+
+
+retrieval_flight = SingleFlight("retrieval")
+generation_fanout = StreamFanout("generation", window=settings.COALESCE_WINDOW)
+
+
 async def search_knowledge_base(query: str):
     """
-    调用 KB Service 获取相关知识
+    调用 KB Service 获取相关知识 (相同问题的并发检索合并为一次)
+    """
+    return await retrieval_flight.do(coalesce_key(query), lambda: _search_knowledge_base(query))
+
+
+async def _search_knowledge_base(query: str):
+    # 检索请求的 HTTP 客户端 span 由 httpx 自动植入生成，并把 trace 上下文传给 KB Service
+    with tracer.start_as_current_span("rag.kb_search") as span:
+        try:
+            async with httpx.AsyncClient() as client:
+                response = await client.post(
+                    f"{settings.KB_SERVICE_URL}/documents/search",
+                    json={"query": query, "top_k": settings.RETRIEVAL_TOP_K},
+                    timeout=10.0,
+                    headers={"X-Internal-Key": settings.INTERNAL_API_KEY}
+                )
+
+                if response.status_code == 200:
+                    data = response.json()
+                    results = data.get("results", [])
+
+                    # KB Service 已做 MMR 重排与相似度过滤，这里按 token 预算拼接上下文
+                    context, context_tokens = pack_context(results, settings.CONTEXT_TOKEN_BUDGET)
+                    span.set_attribute("rag.kb.hits", len(results))
+                    span.set_attribute("rag.context_tokens", context_tokens)
+                    log_event("kb_search", query_chars=len(query), hits=len(results), context_tokens=context_tokens)
+                    return context if context else ""  # 如果没结果，返回空字符串
+                else:
+                    span.set_attribute("rag.kb.status", response.status_code)
+                    log_event("kb_search_failed", sampled=False, status=response.status_code, detail=response.text[:200])
+                    return ""  # 出错时返回空，防止模型读到错误信息
+        except Exception as e:
+            span.record_exception(e)
+            log_event("kb_search_failed", sampled=False, error=str(e))
+            return ""
+
+
+async def semantic_cache_lookup(query: str, session_id: str):
+    """
+    返回 (问题向量, 知识库版本, 缓存答案)。不满足缓存条件或出错时返回 None
     """
+    if not settings.SEMANTIC_CACHE_ENABLED:
+        return None
     try:
-        print(f"🔍 [DEBUG] 正在检索: {query}")  # 调试日志
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{settings.KB_SERVICE_URL}/documents/search",
-                json={"query": query, "top_k": 3},
-                timeout=10.0,
-                headers={"X-Internal-Key": settings.INTERNAL_API_KEY}
-            )
-
-            if response.status_code == 200:
-                data = response.json()
-                results = data.get("results", [])
-
-                # 打印检索结果长度
-                print(f"✅ [DEBUG] 检索成功，找到 {len(results)} 条文档")
-
-                context = "\n\n".join([f"文档{i + 1}: {item['content']}" for i, item in enumerate(results)])
-                return context if context else ""  # 如果没结果，返回空字符串
-            else:
-                print(f"❌ [DEBUG] KB Service 报错: {response.status_code} - {response.text}")
-                return ""  # 出错时返回空，防止模型读到错误信息
+        # 多轮对话的答案依赖上下文，只缓存首轮提问
+        if await has_history(session_id):
+            CACHE_REQUESTS.labels(result="bypass").inc()
+            return None
+        vector, kb_version = await embed_with_kb_version(query)
     except Exception as e:
-        print(f"❌ [DEBUG] 连接 KB Service 失败: {e}")
-        return ""
+        print(f"⚠️ 语义缓存查询失败: {e}")
+        CACHE_REQUESTS.labels(result="bypass").inc()
+        return None
+    answer = semantic_cache.get(vector, kb_version)
+    CACHE_REQUESTS.labels(result="hit" if answer is not None else "miss").inc()
+    return vector, kb_version, answer
 
 
-async def rag_chat_stream(query: str, session_id: str):
-    # 1. 检索
-    context = await search_knowledge_base(query)
+async def stream_cached_answer(query: str, answer: str, session_id: str, chunk_size: int = 16):
+    # 与正常生成保持一致：按小段流式返回，并写入会话历史
+    for i in range(0, len(answer), chunk_size):
+        yield answer[i:i + chunk_size]
+    await get_message_history(session_id).aadd_messages(
+        [HumanMessage(content=query), AIMessage(content=answer)]
+    )
 
-    # 🔥🔥🔥 关键调试：看看到底发给了模型什么上下文 🔥🔥🔥
-    print(f"📝 [DEBUG] 最终 Context 内容:\n{context}")
-    print("--------------------------------------------------")
 
-    # 2. 构建 Chain
-    chain = prompt_template | llm | StrOutputParser()
+async def timed(stage: str, awaitable):
+    start = time.perf_counter()
+    try:
+        with tracer.start_as_current_span(f"rag.{stage}"):
+            return await awaitable
+    finally:
+        STAGE_SECONDS.labels(stage=stage).observe(time.perf_counter() - start)
 
-    chain_with_history = RunnableWithMessageHistory(
-        chain,
-        get_message_history,
-        input_messages_key="question",
-        history_messages_key="history",
-    )
 
-    # 3. 流式调用
-    async for chunk in chain_with_history.astream(
-            {"question": query, "context": context},
-            config={"configurable": {"session_id": session_id}}
-    ):
-        yield chunk
\ No newline at end of file
+# ==========================================
+# 预取检索：网关在鉴权/转发的同时先发起检索，聊天请求到达时直接复用结果
+# ==========================================
+_prefetched: dict = {}  # (用户, 问题哈希) -> 检索任务，超过 PREFETCH_TTL 未被取走时自动取消并移除
+
+
+def prefetch_key(user_id: str, query: str):
+    return user_id, hashlib.sha256(" ".join(query.split()).encode("utf-8")).hexdigest()
+
+
+def _expire_prefetch(key, task):
+    if _prefetched.get(key) is task:
+        del _prefetched[key]
+        task.cancel()
+
+
+def start_prefetch(user_id: str, query: str):
+    key = prefetch_key(user_id, query)
+    if key not in _prefetched:
+        task = asyncio.create_task(search_knowledge_base(query))
+        _prefetched[key] = task
+        asyncio.get_running_loop().call_later(settings.PREFETCH_TTL, _expire_prefetch, key, task)
+
+
+def take_prefetched(user_id: str, query: str):
+    return _prefetched.pop(prefetch_key(user_id, query), None)
+
+
+def record_generation(span, meta: dict, chunks: int, first_at, last_at):
+    """
+    生成结束 (含中途断开) 时记录输出长度与生成速度，并结束 rag.generate span
+    """
+    usage = meta.get("usage")
+    tokens = usage["completion_tokens"] if usage else chunks
+    if first_at is not None:
+        OUTPUT_TOKENS.observe(tokens)
+        STAGE_SECONDS.labels(stage="generate").observe(last_at - first_at)
+        if last_at > first_at:
+            TOKENS_PER_SECOND.observe(tokens / (last_at - first_at))
+    span.set_attribute("rag.output_tokens", tokens)
+    if meta.get("ttft_ms") is not None:
+        span.set_attribute("rag.ttft_ms", meta["ttft_ms"])
+    span.end()
+
+
+def generation_usage(usage_metadata, prompt_value, parts) -> dict:
+    """
+    模型返回的真实用量；流在最后一个 chunk 之前被取消 (客户端断开) 时按已生成的文本估算
+    """
+    if usage_metadata:
+        return {
+            "prompt_tokens": usage_metadata["input_tokens"],
+            "completion_tokens": usage_metadata["output_tokens"],
+            "total_tokens": usage_metadata["total_tokens"],
+        }
+    prompt_tokens = count_tokens(prompt_value.to_string())
+    completion_tokens = count_tokens("".join(parts))
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+async def shared_generation(prompt_value, username: str):
+    """
+    合并生成的上游流，由 StreamFanout 的独立任务消费；
+    生成结束或被放弃时按发起方计费一次，与发起方的连接是否还在无关
+    """
+    usage_metadata = None
+    parts = []
+    try:
+        async for chunk in llm.astream(prompt_value):
+            usage_metadata = chunk.usage_metadata or usage_metadata
+            parts.append(chunk.content)
+            yield chunk
+    finally:
+        if usage_metadata or any(parts):
+            report_usage(username, {"usage": generation_usage(usage_metadata, prompt_value, parts), "source": "llm"})
+
+
+async def rag_chat_stream(query: str, session_id: str, meta: dict = None):
+    """
+    逐段产出回答文本；meta 不为空时写入来源、token 用量与首 token 耗时，供输出阶段的最后一帧使用
+    """
+    meta = meta if meta is not None else {}
+    started = time.perf_counter()
+    history = get_message_history(session_id)
+
+    # 1. 检索与历史加载并发执行 (有预取结果时直接复用)，首 token 延迟取决于较慢的一方而不是两者之和
+    retrieval = take_prefetched(session_id, query) or search_knowledge_base(query)
+    retrieval_task = asyncio.create_task(timed("retrieval", retrieval))
+    history_task = asyncio.create_task(timed("history", history.aget_messages()))
+
+    # 2. 语义缓存 (与检索并发查询；命中则取消检索，跳过生成)
+    cached = await timed("semantic_cache", semantic_cache_lookup(query, session_id))
+    if cached is not None and cached[2] is not None:
+        retrieval_task.cancel()
+        history_task.cancel()
+        meta["source"] = "semantic_cache"
+        async for chunk in stream_cached_answer(query, cached[2], session_id):
+            yield chunk
+        return
+
+    context, history_messages = await asyncio.gather(retrieval_task, history_task)
+    STAGE_SECONDS.labels(stage="prepare").observe(time.perf_counter() - started)
+    log_event("rag_context", context_chars=len(context), history_messages=len(history_messages))
+
+    # 3. 组装 Prompt，流式调用 (无历史的首轮提问：相同问题+相同检索结果共享同一次生成)
+    inputs = {"question": query, "context": context, "history": history_messages}
+    prompt_value = await timed("prompt", prompt_chain.ainvoke(inputs))
+    coalesced = settings.COALESCE_GENERATION and not history_messages
+    if coalesced:
+        # 用量由生成任务计费 (shared_generation)，订阅者 (包括发起方) 的输出阶段不再计费
+        meta["source"] = "coalesced"
+        stream = generation_fanout.subscribe(coalesce_key(query, context),
+                                             lambda: shared_generation(prompt_value, session_id))
+    else:
+        stream = llm.astream(prompt_value)
+
+    # 生成 span 跨越多次 yield，不能设为当前 span (生成器可能在别的上下文中被关闭)，手动结束
+    span = tracer.start_span("rag.generate", attributes={"rag.coalesced": coalesced})
+    answer = []
+    usage_metadata = None
+    first_at = last_at = None
+    try:
+        async for chunk in stream:
+            usage_metadata = chunk.usage_metadata or usage_metadata
+            if not chunk.content:
+                continue
+            now = time.perf_counter()
+            if first_at is None:
+                first_at = now
+                ttft = now - started
+                STAGE_SECONDS.labels(stage="ttft").observe(ttft)
+                meta["ttft_ms"] = round(ttft * 1000, 1)
+                span.add_event("first_token")
+            else:
+                INTER_TOKEN_SECONDS.observe(now - last_at)
+            last_at = now
+            answer.append(chunk.content)
+            yield chunk.content
+    except Exception as e:
+        span.record_exception(e)
+        raise
+    finally:
+        if usage_metadata or answer:
+            meta["usage"] = generation_usage(usage_metadata, prompt_value, answer)
+        record_generation(span, meta, len(answer), first_at, last_at)
+
+    # 4. 写入会话历史 (一次 pipeline；超出预算的旧消息会在后台折叠为摘要)
+    answer = "".join(answer)
+    await history.aadd_messages([HumanMessage(content=query), AIMessage(content=answer)])
+
+    # 5. 完整生成后写入语义缓存
+    if cached is not None:
+        vector, kb_version, _ = cached
+        semantic_cache.put(vector, kb_version, answer)
@@ -0,0 +1,161 @@
+import asyncio
+from typing import Awaitable, Callable, List, Optional, Sequence
+from langchain_core.messages import BaseMessage, SystemMessage
+from prometheus_client import Histogram
+from config import settings
+from core.history import AsyncRedisChatMessageHistory, decode_message, redis_client
+
+PROMPT_TOKENS = Histogram(
+    "llm_prompt_tokens",
+    "Estimated prompt tokens per request (system + context + history + question)",
+    buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000),
+)
+
+SUMMARY_PREFIX = "chat_summary:"
+GENERATION_PREFIX = "chat_gen:"  # 每次清空会话递增，后台摘要据此判断会话是否已被清空
+
+# 摘要写回：会话代数与读取时一致才裁剪历史并写入摘要，摘要期间被清空的会话不会被写回旧内容
+FOLD_IF_CURRENT_LUA = """
+if (redis.call('GET', KEYS[3]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('LTRIM', KEYS[1], ARGV[2], -1)
+if tonumber(ARGV[4]) > 0 then
+    redis.call('SET', KEYS[2], ARGV[3], 'EX', ARGV[4])
+else
+    redis.call('SET', KEYS[2], ARGV[3])
+end
+return 1
+"""
+fold_if_current = redis_client.register_script(FOLD_IF_CURRENT_LUA)
+
+# ==========================================
+# 1. 本地 token 估算 (优先 tiktoken，不可用时按字符估算)
+# ==========================================
+_encoding = None
+_encoding_loaded = False
+
+
+def count_tokens(text: str) -> int:
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding = None
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    # 粗略估算：中日韩字符约 1 token/字，其余约 4 字符/token
+    cjk = sum(1 for ch in text if "㐀" <= ch <= "鿿")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message_tokens(messages: Sequence[BaseMessage]) -> int:
+    # 每条消息额外约 4 个 token 的角色/分隔符开销
+    return sum(count_tokens(m.content if isinstance(m.content, str) else str(m.content)) + 4 for m in messages)
+
+
+def record_prompt_tokens(prompt_value):
+    """
+    插在 prompt 与 llm 之间的透传步骤，记录每次请求的 prompt token 数
+    """
+    PROMPT_TOKENS.observe(count_message_tokens(prompt_value.to_messages()))
+    return prompt_value
+
+
+# ==========================================
+# 2. 按 token 预算截断的会话历史 + 滚动摘要
+# ==========================================
+Summarizer = Callable[[str, List[BaseMessage]], Awaitable[str]]
+_summarizing: set = set()  # 正在后台摘要的会话，避免重复触发
+_fold_tasks: set = set()  # 持有后台摘要任务的引用，防止执行中被垃圾回收
+
+
+class WindowedChatMessageHistory(AsyncRedisChatMessageHistory):
+    """
+    送入 prompt 的历史 = [滚动摘要] + 预算内最近的若干条原文消息。
+    超出窗口且尚未摘要的旧消息，在本轮回答写入历史后由后台任务折叠进摘要，不占用请求路径
+    """
+
+    def __init__(self, session_id: str, ttl: int = None, token_budget: int = 2000,
+                 summarizer: Optional[Summarizer] = None, **kwargs):
+        super().__init__(session_id, ttl=ttl, **kwargs)
+        self.token_budget = token_budget
+        self.summarizer = summarizer
+        self.summary_key = f"{SUMMARY_PREFIX}{session_id}"
+        self.generation_key = f"{GENERATION_PREFIX}{session_id}"
+
+    def ttl_keys(self) -> List[str]:
+        # 摘要与历史同时续期，活跃会话的摘要不会先于历史过期
+        return [self.key, self.summary_key]
+
+    async def _load(self):
+        """
+        返回 (消息列表, 摘要, 会话代数)
+        """
+        async with self.client.pipeline(transaction=False) as pipe:
+            await self.read_raw(pipe)  # 只是加入 pipeline，execute 时一起发送
+            pipe.get(self.summary_key)
+            pipe.get(self.generation_key)
+            raw, summary, generation = await pipe.execute()
+        return [decode_message(r) for r in raw], (summary.decode() if summary else ""), \
+            (generation.decode() if generation else "0")
+
+    def _window_start(self, messages: List[BaseMessage], summary: str) -> int:
+        """
+        从最新消息往前累加，直到用完 token 预算，返回窗口起点
+        """
+        budget = self.token_budget - (count_tokens(summary) if summary else 0)
+        start = len(messages)
+        # 以"一问一答"为单位保留，避免窗口从回答中间开始
+        while start >= 2:
+            cost = count_message_tokens(messages[start - 2:start])
+            if cost > budget:
+                break
+            budget -= cost
+            start -= 2
+        return start
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        messages, summary, _ = await self._load()
+        window = messages[self._window_start(messages, summary):]
+        if summary:
+            window = [SystemMessage(content=f"以下是此前对话的摘要：\n{summary}")] + window
+        return window
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        await super().aadd_messages(messages)
+        if self.summarizer is not None and self.session_id not in _summarizing:
+            # 本轮回答已流式返回完毕，摘要放到后台执行
+            _summarizing.add(self.session_id)
+            task = asyncio.create_task(self._fold_overflow())
+            _fold_tasks.add(task)
+            task.add_done_callback(_fold_tasks.discard)
+
+    async def _fold_overflow(self):
+        try:
+            messages, summary, generation = await self._load()
+            start = self._window_start(messages, summary)
+            if start == 0:
+                return
+            new_summary = await self.summarizer(summary, messages[:start])
+            # 已折叠进摘要的消息从列表头部裁掉 (新消息只会追加在尾部，不受影响)；摘要期间会话被清空则放弃
+            await fold_if_current(
+                keys=[self.key, self.summary_key, self.generation_key],
+                args=[generation, start, new_summary, self.ttl or 0],
+                client=self.client,
+            )
+        except Exception as e:
+            print(f"⚠️ 会话摘要失败 ({self.session_id}): {e}")
+        finally:
+            _summarizing.discard(self.session_id)
+
+    async def aclear(self) -> None:
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.delete(self.key, self.legacy_key, self.summary_key)
+            pipe.incr(self.generation_key)
+            if self.ttl:
+                pipe.expire(self.generation_key, self.ttl)
+            await pipe.execute()
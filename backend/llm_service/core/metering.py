@@ -0,0 +1,34 @@
+import asyncio
+import httpx
+from config import settings
+
+# 用量上报：每次回答结束后把真实 token 用量发给 Auth Service 记账 (后台任务，不阻塞响应)
+_report_tasks = set()
+NOT_BILLED_SOURCES = {"semantic_cache", "coalesced"}
+
+
+async def _post_usage(username: str, usage: dict):
+    try:
+        async with httpx.AsyncClient() as client:
+            await client.post(
+                f"{settings.AUTH_SERVICE_URL}/usage",
+                json={
+                    "username": username,
+                    "prompt_tokens": usage.get("prompt_tokens", 0),
+                    "completion_tokens": usage.get("completion_tokens", 0),
+                },
+                timeout=5.0,
+                headers={"X-Internal-Key": settings.INTERNAL_API_KEY}
+            )
+    except Exception as e:
+        print(f"⚠️ 用量上报失败 ({username}): {e}")
+
+
+def report_usage(username: str, summary: dict):
+    # 语义缓存命中等没有调用模型的回答不计费；合并生成由生成任务按发起方计费一次 (llm.shared_generation)，订阅者不再计费
+    usage = summary.get("usage")
+    if not settings.METERING_ENABLED or not usage or summary.get("source") in NOT_BILLED_SOURCES:
+        return
+    task = asyncio.create_task(_post_usage(username, usage))
+    _report_tasks.add(task)
+    task.add_done_callback(_report_tasks.discard)
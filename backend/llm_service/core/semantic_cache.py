@@ -0,0 +1,101 @@
+import time
+from typing import Optional
+import httpx
+import numpy as np
+from prometheus_client import Counter, Gauge
+from config import settings
+
+CACHE_REQUESTS = Counter(
+    "llm_semantic_cache_requests_total",
+    "Semantic answer cache lookups (hit / miss / bypass)",
+    ["result"],
+)
+CACHE_ENTRIES = Gauge("llm_semantic_cache_entries", "Entries held by the semantic answer cache")
+
+
+class SemanticCache:
+    """
+    语义答案缓存：按问题向量的余弦相似度查找历史答案。
+    所有条目绑定知识库版本号，版本变化 (知识库被编辑) 时整体清空；
+    容量满时淘汰最久未命中的条目，超过 TTL 的条目视为失效
+    """
+
+    def __init__(self, max_entries: int, threshold: float, ttl: int):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self.kb_version: Optional[str] = None
+        self._vectors: Optional[np.ndarray] = None  # (max_entries, dim)，已归一化
+        self._answers: list = []
+        self._created = np.zeros(max_entries)
+        self._last_used = np.zeros(max_entries)
+
+    def _check_version(self, kb_version: str):
+        if kb_version != self.kb_version:
+            self.kb_version = kb_version
+            self._vectors = None
+            self._answers = []
+            CACHE_ENTRIES.set(0)
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        v = np.asarray(vector, dtype=np.float32)
+        return v / (np.linalg.norm(v) or 1.0)
+
+    def get(self, vector, kb_version: str) -> Optional[str]:
+        self._check_version(kb_version)
+        if not self._answers:
+            return None
+        n = len(self._answers)
+        scores = self._vectors[:n] @ self._normalize(vector)
+        now = time.time()
+        scores[now - self._created[:n] > self.ttl] = -1.0
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        self._last_used[best] = now
+        return self._answers[best]
+
+    def put(self, vector, kb_version: str, answer: str):
+        self._check_version(kb_version)
+        v = self._normalize(vector)
+        if self._vectors is None:
+            self._vectors = np.zeros((self.max_entries, len(v)), dtype=np.float32)
+
+        n = len(self._answers)
+        now = time.time()
+        if n < self.max_entries:
+            slot = n
+            self._answers.append(answer)
+        else:
+            # 优先覆盖已过期的条目，否则淘汰最久未使用的
+            expired = np.flatnonzero(now - self._created > self.ttl)
+            slot = int(expired[0]) if len(expired) else int(np.argmin(self._last_used))
+            self._answers[slot] = answer
+        self._vectors[slot] = v
+        self._created[slot] = now
+        self._last_used[slot] = now
+        CACHE_ENTRIES.set(len(self._answers))
+
+
+semantic_cache = SemanticCache(
+    max_entries=settings.SEMANTIC_CACHE_MAX_ENTRIES,
+    threshold=settings.SEMANTIC_CACHE_THRESHOLD,
+    ttl=settings.SEMANTIC_CACHE_TTL,
+)
+
+
+async def embed_with_kb_version(query: str):
+    """
+    通过 KB Service 获取问题向量 (复用其查询向量缓存) 和当前知识库版本号
+    """
+    async with httpx.AsyncClient() as client:
+        response = await client.post(
+            f"{settings.KB_SERVICE_URL}/embeddings",
+            json={"texts": [query]},
+            timeout=5.0,
+            headers={"X-Internal-Key": settings.INTERNAL_API_KEY}
+        )
+        response.raise_for_status()
+        data = response.json()
+        return data["embeddings"][0], data["kb_version"]
@@ -0,0 +1,116 @@
+import asyncio
+import json
+import time
+from typing import AsyncIterator, Callable, Optional
+from prometheus_client import Histogram
+from config import settings
+
+# 输出阶段：把逐 token 的文本流合并成 SSE data 事件。
+# 首个 token 立即发出 (不影响首字延迟)，之后按 时间(SSE_FLUSH_MS) / 大小(SSE_FLUSH_BYTES) 任一条件刷新，
+# 生成快时多个 token 合并为一帧，生成慢时每个 token 到期即发，减少网关与本服务的逐 token 写入开销。
+
+FRAMES_PER_RESPONSE = Histogram(
+    "llm_sse_frames_per_response",
+    "每个回答输出的 SSE 帧数",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+BYTES_PER_RESPONSE = Histogram(
+    "llm_sse_bytes_per_response",
+    "每个回答输出的 SSE 字节数 (含帧开销)",
+    buckets=(256, 1024, 4096, 16384, 65536, 262144),
+)
+
+
+def format_event(data: str, event: Optional[str] = None) -> bytes:
+    lines = [f"event: {event}"] if event else []
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return ("\n".join(lines) + "\n\n").encode()
+
+
+def new_stream_meta() -> dict:
+    """rag_chat_stream 在生成过程中填写的元数据，输出阶段在最后一帧带给客户端"""
+    return {"source": "llm", "usage": None, "ttft_ms": None}
+
+
+async def sse_stream(chunks: AsyncIterator[str], meta: dict,
+                     on_finish: Optional[Callable[[dict], None]] = None) -> AsyncIterator[bytes]:
+    started = time.perf_counter()
+    flush_after = settings.SSE_FLUSH_MS / 1000
+    frames = 0
+    size = 0
+    buffer = []
+    buffered = 0
+    first_at = None  # 当前缓冲区第一个 token 的到达时间
+
+    def flush() -> bytes:
+        nonlocal frames, size, buffered, first_at
+        frame = format_event("".join(buffer))
+        buffer.clear()
+        buffered = 0
+        first_at = None
+        frames += 1
+        size += len(frame)
+        return frame
+
+    iterator = chunks.__aiter__()
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            # 缓冲区有内容时最多等到刷新时间点；不能用 wait_for，超时会取消上游生成器
+            timeout = None if first_at is None else max(0.0, first_at + flush_after - time.perf_counter())
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                yield flush()
+                continue
+
+            task, pending = pending, None
+            try:
+                chunk = task.result()
+            except StopAsyncIteration:
+                break
+            if not chunk:
+                continue
+
+            buffer.append(chunk)
+            buffered += len(chunk.encode("utf-8"))
+            if first_at is None:
+                first_at = time.perf_counter()
+            if frames == 0 or buffered >= settings.SSE_FLUSH_BYTES:
+                yield flush()
+
+        if buffer:
+            yield flush()
+    except Exception as e:
+        if buffer:
+            yield flush()
+        frame = format_event(f"Error: {str(e)}", event="error")
+        frames += 1
+        size += len(frame)
+        yield frame
+    finally:
+        if pending is not None:
+            # 客户端断开 (取消 / GeneratorExit) 时先等上游生成器收尾，meta 中的用量随之写好
+            pending.cancel()
+            await asyncio.wait({pending})
+        elif hasattr(iterator, "aclose"):
+            await iterator.aclose()
+
+        # 最后一帧：用量与耗时 (网关透传给客户端，也用于计费/压测统计)；
+        # 计费在 finally 中执行，客户端中途断开时已生成的部分同样计费
+        summary = {
+            "source": meta.get("source"),
+            "usage": meta.get("usage"),
+            "ttft_ms": meta.get("ttft_ms"),
+            "total_ms": round((time.perf_counter() - started) * 1000, 1),
+            "frames": frames,
+            "bytes": size,
+        }
+        if on_finish is not None:
+            on_finish(summary)
+
+    frame = format_event(json.dumps(summary, ensure_ascii=False), event="usage")
+    FRAMES_PER_RESPONSE.observe(frames)
+    BYTES_PER_RESPONSE.observe(size + len(frame))
+    yield frame
@@ -0,0 +1,39 @@
+import json
+import random
+from opentelemetry import trace
+from prometheus_client import Histogram
+from config import settings
+
+# RAG 各阶段的链路追踪 + 生成阶段指标 + 采样结构化日志
+# (HTTP 层的整体耗时由 prometheus_fastapi_instrumentator 提供，但流式响应的耗时分布看不出瓶颈在哪)
+
+tracer = trace.get_tracer("llm-service.rag")
+
+INTER_TOKEN_SECONDS = Histogram(
+    "llm_inter_token_seconds",
+    "相邻两个输出 chunk 的间隔",
+    buckets=(0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2),
+)
+TOKENS_PER_SECOND = Histogram(
+    "llm_generation_tokens_per_second",
+    "首 token 之后的生成速度",
+    buckets=(5, 10, 20, 30, 50, 75, 100, 150, 200, 400),
+)
+OUTPUT_TOKENS = Histogram(
+    "llm_output_tokens",
+    "每个回答的输出 token 数 (上游未返回用量时按 chunk 数估计)",
+    buckets=(16, 32, 64, 128, 256, 512, 1024, 2048, 4096),
+)
+
+
+def log_event(event: str, sampled: bool = True, **fields):
+    """
+    输出一行 JSON 日志 (由 Promtail 采集)。sampled=True 时按 LOG_SAMPLE_RATE 采样，
+    未采中时直接返回；调用方只传长度、计数等标量，不要传检索上下文等大文本。
+    """
+    if sampled and random.random() >= settings.LOG_SAMPLE_RATE:
+        return
+    span_context = trace.get_current_span().get_span_context()
+    if span_context.is_valid:
+        fields["trace_id"] = format(span_context.trace_id, "032x")
+    print(json.dumps({"event": event, **fields}, ensure_ascii=False), flush=True)
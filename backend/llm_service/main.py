@@ -1,18 +1,14 @@
 from fastapi import FastAPI, HTTPException, Path, status,Security,Depends
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from core.llm import rag_chat_stream
-from langchain_community.chat_message_histories import RedisChatMessageHistory
+from core.llm import rag_chat_stream, get_message_history, start_prefetch
+from core.streaming import sse_stream, new_stream_meta
+from core.metering import report_usage
 from config import settings
 from fastapi.security import APIKeyHeader
+from contextlib import asynccontextmanager
 import os
-from prometheus_fastapi_instrumentator import Instrumentator
-from opentelemetry import trace
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+from common.observability import instrument_app, start_tracing, shutdown_tracing
 
 INTERNAL_KEY = os.getenv("INTERNAL_API_KEY")
 api_key_header = APIKeyHeader(name="X-Internal-Key", auto_error=False)
@@ -25,26 +21,25 @@ async def verify_internal_key(api_key: str = Security(api_key_header)):
         )
     return api_key
 
-app = FastAPI(title="LLM Service")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 按配置启用链路追踪 (对 KB Service / 模型接口的 httpx 调用传递 trace 上下文)
+    start_tracing("llm-service", instrument_httpx=True)
+    yield
+    shutdown_tracing()
 
-# 自动通过 /metrics 接口暴露指标
-Instrumentator().instrument(app).expose(app)
 
-# 设置服务名称
-resource = Resource(attributes={SERVICE_NAME: "llm-service"})
+app = FastAPI(title="LLM Service", lifespan=lifespan)
 
-provider = TracerProvider(resource=resource)
+# 自动通过 /metrics 接口暴露指标；追踪在 lifespan 中按配置启用
+instrument_app(app)
 
-# 配置导出器 (发送到 Jaeger 容器的 4317 端口)
-otlp_exporter = OTLPSpanExporter(endpoint="http://jaeger:4317", insecure=True)
-span_processor = BatchSpanProcessor(otlp_exporter)
-provider.add_span_processor(span_processor)
-trace.set_tracer_provider(provider)
+class ChatRequest(BaseModel):
+    query: str
+    user_id: str
 
-# 自动植入 FastAPI
-FastAPIInstrumentor.instrument_app(app)
 
-class ChatRequest(BaseModel):
+class PrefetchRequest(BaseModel):
     query: str
     user_id: str
 
@@ -52,24 +47,28 @@ class ChatRequest(BaseModel):
 def health_check():
     return {"status": "healthy"}
 
-# 1. 对话资源 (Chat) - 依然是流式
+# 1. 对话资源 (Chat) - 流式，按 SSE 事件合并输出，最后一帧为用量与耗时
 @app.post("/conversations/chat", dependencies=[Depends(verify_internal_key)])
 async def chat_endpoint(request: ChatRequest):
+    meta = new_stream_meta()
     return StreamingResponse(
-        rag_chat_stream(request.query, session_id=request.user_id),
+        sse_stream(rag_chat_stream(request.query, session_id=request.user_id, meta=meta), meta,
+                   on_finish=lambda summary: report_usage(request.user_id, summary)),
         media_type="text/event-stream"
     )
 
+# 1.1 预取检索 (网关在鉴权的同时调用，聊天请求到达时复用检索结果)
+@app.post("/conversations/prefetch", status_code=status.HTTP_202_ACCEPTED, dependencies=[Depends(verify_internal_key)])
+async def prefetch_endpoint(request: PrefetchRequest):
+    start_prefetch(request.user_id, request.query)
+    return {"status": "accepted"}
+
 # 2. 清空记忆 (Delete History)
 @app.delete("/conversations/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
-def clear_conversation_history(user_id: str = Path(..., description="用户ID")):
+async def clear_conversation_history(user_id: str = Path(..., description="用户ID")):
     try:
         # 直接操作 Redis History 对象来清空
-        history = RedisChatMessageHistory(
-            session_id=user_id,
-            url=settings.REDIS_URL
-        )
-        history.clear()
+        await get_message_history(user_id).aclear()
         return # 204
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
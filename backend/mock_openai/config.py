@@ -0,0 +1,17 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class Config:
+    # 流式输出：首 token 延迟 (毫秒)、每秒输出 token 数、每次回答的 token 数
+    MOCK_TTFT_MS = float(os.getenv("MOCK_TTFT_MS", 300))
+    MOCK_TOKENS_PER_SEC = float(os.getenv("MOCK_TOKENS_PER_SEC", 50))
+    MOCK_OUTPUT_TOKENS = int(os.getenv("MOCK_OUTPUT_TOKENS", 120))
+    # Embedding：向量维度、每次请求的固定延迟 (毫秒)
+    MOCK_EMBEDDING_DIM = int(os.getenv("MOCK_EMBEDDING_DIM", 1536))
+    MOCK_EMBEDDING_LATENCY_MS = float(os.getenv("MOCK_EMBEDDING_LATENCY_MS", 20))
+
+
+settings = Config()
@@ -0,0 +1,127 @@
+import asyncio
+import hashlib
+import json
+import math
+import time
+import uuid
+from typing import List, Optional, Union
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from config import settings
+
+# 本地 OpenAI 兼容替身服务：用于压测，ChatOpenAI / OpenAIEmbeddings 只需把 OPENAI_BASE_URL 指向这里
+app = FastAPI(title="Mock OpenAI Service")
+
+# 回答内容：循环输出这段文字，每个字符算一个 token (与中文模型的实际粒度接近)
+ANSWER_TEXT = "根据知识库中的内容，这个问题可以从以下几个方面来理解。首先需要明确概念，其次结合实际场景进行分析，最后给出可落地的建议。"
+
+
+class ChatRequest(BaseModel):
+    model: str
+    messages: List[dict]
+    stream: bool = False
+    stream_options: Optional[dict] = None
+    max_tokens: Optional[int] = None
+
+
+class EmbeddingRequest(BaseModel):
+    model: str
+    input: Union[str, List[str], List[int], List[List[int]]]
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 2)
+
+
+def embed_text(text: str, dim: int) -> List[float]:
+    """
+    确定性向量：字符二元组做特征哈希 (hashing trick)。
+    相同文本得到相同向量，字面相近的文本余弦相似度也高，方便验证缓存与检索
+    """
+    vector = [0.0] * dim
+    text = text.lower()
+    grams = [text[i:i + 2] for i in range(max(1, len(text) - 1))]
+    for gram in grams:
+        digest = hashlib.md5(gram.encode("utf-8")).digest()
+        index = int.from_bytes(digest[:4], "little") % dim
+        vector[index] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+@app.get("/v1/models")
+def list_models():
+    return {"object": "list", "data": [{"id": "mock-llm", "object": "model", "owned_by": "mock"}]}
+
+
+@app.post("/v1/embeddings")
+async def create_embeddings(request: EmbeddingRequest):
+    inputs = request.input
+    if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+        inputs = [inputs]
+    # 兼容 token 数组形式的输入 (check_embedding_ctx_length=True 时 LangChain 会先分词)
+    texts = [t if isinstance(t, str) else " ".join(map(str, t)) for t in inputs]
+
+    await asyncio.sleep(settings.MOCK_EMBEDDING_LATENCY_MS / 1000)
+    tokens = sum(estimate_tokens(t) for t in texts)
+    return {
+        "object": "list",
+        "model": request.model,
+        "data": [
+            {"object": "embedding", "index": i, "embedding": embed_text(t, settings.MOCK_EMBEDDING_DIM)}
+            for i, t in enumerate(texts)
+        ],
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+def answer_tokens(count: int) -> List[str]:
+    return [ANSWER_TEXT[i % len(ANSWER_TEXT)] for i in range(count)]
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(body: ChatRequest, request: Request):
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+    created = int(time.time())
+    prompt_tokens = sum(estimate_tokens(str(m.get("content", ""))) for m in body.messages)
+    count = min(body.max_tokens or settings.MOCK_OUTPUT_TOKENS, settings.MOCK_OUTPUT_TOKENS)
+    tokens = answer_tokens(count)
+    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": count, "total_tokens": prompt_tokens + count}
+
+    if not body.stream:
+        await asyncio.sleep(settings.MOCK_TTFT_MS / 1000 + count / settings.MOCK_TOKENS_PER_SEC)
+        return {
+            "id": completion_id, "object": "chat.completion", "created": created, "model": body.model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                         "finish_reason": "stop"}],
+            "usage": usage,
+        }
+
+    def chunk(delta: dict, finish_reason=None, with_usage=None):
+        payload = {
+            "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": body.model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if with_usage is None else [],
+        }
+        if with_usage is not None:
+            payload["usage"] = with_usage
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    async def stream():
+        await asyncio.sleep(settings.MOCK_TTFT_MS / 1000)
+        yield chunk({"role": "assistant", "content": ""})
+        interval = 1.0 / settings.MOCK_TOKENS_PER_SEC
+        next_at = time.perf_counter()
+        for token in tokens:
+            if await request.is_disconnected():
+                return
+            yield chunk({"content": token})
+            # 按绝对时间节拍输出，避免 sleep 误差累积
+            next_at += interval
+            await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+        yield chunk({}, finish_reason="stop")
+        if (body.stream_options or {}).get("include_usage"):
+            yield chunk({}, with_usage=usage)
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
@@ -30,6 +30,47 @@ export function useChat() {
 
     loading.value = true
 
+    // 解析 SSE 事件流，断线时带 Last-Event-ID 续传，不需要重新提问
+    let lastEventId = ''
+    let streamId = ''
+    let finished = false
+
+    const consume = async (response: Response) => {
+      if (!response.body) return
+      const reader = response.body.getReader()
+      const decoder = new TextDecoder()
+      let buffer = ''
+
+      while (true) {
+        const { done, value } = await reader.read()
+        if (done) break
+        buffer += decoder.decode(value, { stream: true })
+
+        let boundary
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+          const frame = buffer.slice(0, boundary)
+          buffer = buffer.slice(boundary + 2)
+
+          let event = 'message'
+          const data: string[] = []
+          for (const line of frame.split('\n')) {
+            if (line.startsWith('id: ')) lastEventId = line.slice(4)
+            else if (line.startsWith('event: ')) event = line.slice(7)
+            else if (line.startsWith('data: ')) data.push(line.slice(6))
+          }
+          if (!streamId && lastEventId) streamId = lastEventId.slice(0, lastEventId.lastIndexOf(':'))
+
+          if (event === 'message') {
+            messages.value[messages.value.length - 1].content += data.join('\n')
+          } else if (event === 'error') {
+            messages.value[messages.value.length - 1].content += `\n[${data.join('\n')}]`
+          } else if (event === 'done') {
+            finished = true
+          }
+        }
+      }
+    }
+
     try {
 
       const response = await fetch('http://localhost:8000/api/conversations/chat', {
@@ -49,16 +90,27 @@ export function useChat() {
         return
       }
 
-      if (!response.body) return
-
-      const reader = response.body.getReader()
-      const decoder = new TextDecoder()
+      streamId = response.headers.get('X-Stream-Id') || ''
+      try {
+        await consume(response)
+      } catch (error) {
+        console.warn('Stream interrupted, resuming:', error)
+      }
 
-      while (true) {
-        const { done, value } = await reader.read()
-        if (done) break
-        const chunk = decoder.decode(value)
-        messages.value[messages.value.length - 1].content += chunk
+      // 连接中途断开：最多续传 3 次
+      for (let attempt = 0; !finished && streamId && attempt < 3; attempt++) {
+        try {
+          const resumed = await fetch(`http://localhost:8000/api/conversations/chat/${streamId}`, {
+            headers: {
+              'Authorization': `Bearer ${token}`,
+              'Last-Event-ID': lastEventId
+            }
+          })
+          if (!resumed.ok) break
+          await consume(resumed)
+        } catch (error) {
+          await new Promise(resolve => setTimeout(resolve, 1000 * (attempt + 1)))
+        }
       }
 
     } catch (error) {
@@ -0,0 +1,43 @@
+import importlib
+import os
+import sys
+import tempfile
+
+BACKEND = os.path.abspath(os.path.join(os.path.dirname(__file__), '../backend'))
+sys.path.append(BACKEND)  # 共享的 common 包
+
+# 各服务导入时需要的环境变量 (CI 中也会设置，这里只补默认值)
+os.environ.setdefault("INTERNAL_API_KEY", "test_key")
+os.environ.setdefault("SECRET_KEY", "test_secret")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/auth_test.db")
+
+
+_parked = {}  # 服务名 -> {模块名: 模块}，切换到其他服务时暂存，切回时放回 (模块只导入一次，指标不会重复注册)
+
+
+def _service_of(module):
+    path = os.path.abspath(getattr(module, "__file__", None) or os.sep)
+    if not path.startswith(BACKEND + os.sep):
+        return None
+    service = os.path.relpath(path, BACKEND).split(os.sep)[0]
+    return None if service == "common" else service
+
+
+def load_module(service: str, name: str):
+    """
+    导入 backend/<service> 下的模块。各服务都是扁平目录，config / core 等顶层模块同名，
+    导入前先把其他服务已加载的模块移出 sys.modules，导入后把服务目录移出 sys.path，避免影响其他测试文件
+    """
+    for module_name, module in list(sys.modules.items()):
+        owner = _service_of(module)
+        if owner is not None and owner != service:
+            _parked.setdefault(owner, {})[module_name] = sys.modules.pop(module_name)
+    sys.modules.update(_parked.pop(service, {}))
+
+    root = os.path.join(BACKEND, service)
+    sys.path.insert(0, root)
+    try:
+        return importlib.import_module(name)
+    finally:
+        sys.path.remove(root)
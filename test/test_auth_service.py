@@ -0,0 +1,282 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import fakeredis.aioredis
+import pytest
+from passlib.context import CryptContext
+from sqlalchemy import delete, select
+from conftest import BACKEND, load_module
+
+# 计费与用户缓存共用 database.redis_client，导入前换成 fakeredis
+database = load_module("auth_service", "database")
+database.redis_client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+models = load_module("auth_service", "models")
+metering = load_module("auth_service", "metering")
+auth = load_module("auth_service", "main")
+hasher = load_module("auth_service", "hasher")
+user_cache = load_module("auth_service", "user_cache")
+redis = database.redis_client
+
+
+async def _reset(balances: dict):
+    await redis.flushall()
+    async with database.engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.create_all)
+    async with database.SessionLocal() as db:
+        await db.execute(delete(models.User))
+        db.add_all(models.User(username=name, hashed_password="x", balance=balance)
+                   for name, balance in balances.items())
+        await db.commit()
+
+
+async def _balances() -> dict:
+    async with database.SessionLocal() as db:
+        return dict((await db.execute(select(models.User.username, models.User.balance))).all())
+
+
+def _run(coro):
+    async def main():
+        try:
+            return await coro
+        finally:
+            await database.engine.dispose()  # 每个测试一个事件循环，连接不能跨循环复用
+    return asyncio.run(main())
+
+
+def test_flush_pending_charges_once_and_drains_insufficient():
+    cost = metering.usage_cost(1000, 1000)
+
+    async def main():
+        await _reset({"alice": 10.0, "bob": cost / 2})
+        for _ in range(3):
+            await metering.record_usage("alice", 1000, 1000)
+        await metering.record_usage("bob", 1000, 1000)
+        assert float(await redis.hget("billing:alice", "pending")) == pytest.approx(3 * cost)
+
+        await metering.flush_pending()
+        balances = await _balances()
+        cached = {name: await redis.hgetall(f"billing:{name}") for name in ("alice", "bob")}
+        await metering.flush_pending()  # 没有新用量时不会重复扣费
+        return balances, cached, await _balances(), await redis.smembers(metering.DIRTY_KEY)
+
+    balances, cached, again, dirty = _run(main())
+    assert balances["alice"] == pytest.approx(10.0 - 3 * cost)
+    assert balances["bob"] == 0  # 余额不足：扣到 0
+    assert again == balances
+    assert "pending" not in cached["alice"]  # 全部落库后删除 pending，不留浮点残差
+    assert float(cached["alice"]["balance"]) == pytest.approx(10.0 - 3 * cost)
+    assert float(cached["bob"]["balance"]) == 0
+    assert dirty == set()
+
+
+def test_flush_pending_keeps_usage_recorded_during_flush():
+    """落库期间新增的用量留在 pending 里，由下一轮扣减"""
+    cost = metering.usage_cost(1000, 0)
+    apply_charges = metering._apply_charges
+
+    async def racing_apply(charges):
+        await metering.record_usage("alice", 1000, 0)
+        return await apply_charges(charges)
+
+    async def main():
+        await _reset({"alice": 10.0})
+        await metering.record_usage("alice", 1000, 0)
+        metering._apply_charges = racing_apply
+        try:
+            await metering.flush_pending()
+        finally:
+            metering._apply_charges = apply_charges
+        first = (await _balances())["alice"], float(await redis.hget("billing:alice", "pending"))
+        await metering.flush_pending()
+        return first, (await _balances())["alice"]
+
+    (after_first, pending), after_second = _run(main())
+    assert after_first == pytest.approx(10.0 - cost)
+    assert pending == pytest.approx(cost)
+    assert after_second == pytest.approx(10.0 - 2 * cost)
+
+
+def test_flush_pending_requeues_on_database_error():
+    async def failing_apply(charges):
+        raise RuntimeError("database unavailable")
+
+    async def main():
+        await _reset({"alice": 10.0})
+        await metering.record_usage("alice", 1000, 1000)
+        apply_charges, metering._apply_charges = metering._apply_charges, failing_apply
+        try:
+            with pytest.raises(RuntimeError):
+                await metering.flush_pending()
+        finally:
+            metering._apply_charges = apply_charges
+        return await redis.smembers(metering.DIRTY_KEY), await redis.hget("billing:alice", "pending")
+
+    dirty, pending = _run(main())
+    assert dirty == {"alice"}
+    assert float(pending) == pytest.approx(metering.usage_cost(1000, 1000))
+
+
+def test_flush_pending_leaves_no_float_residue():
+    """HINCRBYFLOAT 反复加减的残差不会在下一轮被当作新扣费"""
+    amounts = [(1, 0), (3, 7), (11, 13)]
+
+    async def main():
+        await _reset({"alice": 10.0})
+        for prompt, completion in amounts:
+            await metering.record_usage("alice", prompt, completion)
+        await metering.flush_pending()
+        await redis.sadd(metering.DIRTY_KEY, "alice")  # 即使再次被标记为待扣
+        await metering.flush_pending()
+        return (await _balances())["alice"], await redis.hgetall("billing:alice"), await redis.ttl("billing:alice")
+
+    balance, cached, ttl = _run(main())
+    assert balance == pytest.approx(10.0 - sum(metering.usage_cost(p, c) for p, c in amounts))
+    assert "pending" not in cached
+    assert 0 < ttl <= metering.BILLING_CACHE_TTL
+
+
+def test_deduct_balance_updates_billing_cache_with_ttl():
+    async def main():
+        await _reset({"alice": 10.0})
+        async with database.SessionLocal() as db:
+            user_id = (await db.execute(select(models.User.id))).scalar_one()
+            result = await auth.deduct_balance(user_id, 4.0, db)
+            with pytest.raises(auth.HTTPException) as insufficient:
+                await auth.deduct_balance(user_id, 7.0, db)
+        return result, insufficient.value.status_code, await redis.hgetall("billing:alice"), await redis.ttl("billing:alice")
+
+    result, status_code, cached, ttl = _run(main())
+    assert result == {"status": "success", "new_balance": 6.0}
+    assert status_code == 402
+    assert float(cached["balance"]) == 6.0
+    assert 0 < ttl <= metering.BILLING_CACHE_TTL
+
+
+def test_deduct_balance_survives_redis_failure(monkeypatch):
+    async def broken(username, balance):
+        raise ConnectionError("redis down")
+
+    monkeypatch.setattr(auth, "cache_balance", broken)
+
+    async def main():
+        await _reset({"alice": 10.0})
+        async with database.SessionLocal() as db:
+            user_id = (await db.execute(select(models.User.id))).scalar_one()
+            return await auth.deduct_balance(user_id, 4.0, db)
+
+    assert _run(main())["new_balance"] == 6.0  # 扣费已落库，缓存失败不影响响应
+
+
+# --- 密码哈希进程池 ---
+def test_hasher_rejects_when_queue_is_full():
+    release = threading.Event()
+    pool = hasher.PasswordHasher(workers=1, max_queue=1)
+    pool._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def main():
+        busy = [asyncio.create_task(pool._run("hash", release.wait)) for _ in range(2)]  # 一个执行中，一个排队
+        await asyncio.sleep(0.01)
+        with pytest.raises(hasher.HasherOverloaded):
+            await pool.hash("secret")
+        release.set()
+        await asyncio.gather(*busy)
+        return pool._pending
+
+    try:
+        assert asyncio.run(main()) == 0
+    finally:
+        pool.shutdown()
+
+
+def test_hasher_pool_hashes_and_upgrades_in_worker_processes(monkeypatch):
+    # 任务按模块名 pickle 到子进程：先把本服务的 utils 放回 sys.modules，子进程按父进程的 sys.path 导入
+    load_module("auth_service", "utils")
+    monkeypatch.syspath_prepend(os.path.join(BACKEND, "auth_service"))
+    pool = hasher.PasswordHasher(workers=1, max_queue=4)
+    legacy = CryptContext(schemes=["argon2"], argon2__time_cost=1, argon2__memory_cost=1024,
+                          argon2__parallelism=1).hash("secret")
+
+    async def main():
+        await pool.warm_up()
+        hashed = await pool.hash("secret")
+        return (hashed, await pool.verify_and_update("secret", hashed),
+                await pool.verify_and_update("wrong", hashed), await pool.verify_and_update("secret", legacy))
+
+    pool.start()
+    try:
+        hashed, current, wrong, upgraded = asyncio.run(main())
+    finally:
+        pool.shutdown()
+    assert hashed.startswith("$argon2")
+    assert current == (True, None) and wrong == (False, None)
+    assert upgraded[0] is True and upgraded[1].startswith("$argon2")  # 旧参数的哈希按新参数重算
+
+
+# --- 用户资料缓存 ---
+def _loader(calls, profile):
+    async def load():
+        calls.append(1)
+        return profile
+    return load
+
+
+def test_user_cache_reads_through_local_and_redis_tiers():
+    profile = {"id": 1, "username": "alice", "balance": 10.0}
+
+    async def main():
+        await redis.flushall()
+        calls = []
+        first, other_instance = user_cache.UserCache(), user_cache.UserCache()
+        results = [await first.get("alice", _loader(calls, profile)) for _ in range(2)]  # 第二次命中进程内缓存
+        results.append(await other_instance.get("alice", _loader(calls, profile)))  # 其他实例命中 Redis
+        missing = await first.get("nobody", _loader(calls, None))
+        return results, missing, len(calls), await redis.ttl("user:alice"), await redis.exists("user:nobody")
+
+    results, missing, loads, ttl, cached_missing = asyncio.run(main())
+    assert results == [profile] * 3 and loads == 2
+    assert missing is None and cached_missing == 0  # 不存在的用户不缓存
+    assert 0 < ttl <= user_cache.USER_CACHE_TTL
+
+
+def test_user_cache_invalidation_wins_over_concurrent_load():
+    stale = {"id": 1, "username": "alice", "balance": 10.0}
+    fresh = {"id": 1, "username": "alice", "balance": 6.0}
+
+    async def main():
+        await redis.flushall()
+        cache = user_cache.UserCache()
+
+        async def slow_load():
+            await cache.invalidate("alice")  # 读库期间余额变化并失效
+            return stale
+
+        during = await cache.get("alice", slow_load)
+        calls = []
+        after = await cache.get("alice", _loader(calls, fresh))  # 旧数据没有回填，重新读库
+        await cache.invalidate("alice")
+        return during, after, len(calls), await redis.exists("user:alice"), "alice" in cache._local
+
+    during, after, loads, cached, local = asyncio.run(main())
+    assert during == stale  # 本次请求仍返回读到的数据
+    assert after == fresh and loads == 1
+    assert cached == 0 and local is False
+
+
+def test_user_cache_falls_back_to_database_when_redis_fails(monkeypatch):
+    class BrokenRedis:
+        async def mget(self, keys):
+            raise ConnectionError("redis down")
+
+    async def broken_fill(**kwargs):
+        raise ConnectionError("redis down")
+
+    profile = {"id": 1, "username": "alice", "balance": 10.0}
+    cache = user_cache.UserCache()
+    cache._fill = broken_fill
+    monkeypatch.setattr(user_cache, "redis_client", BrokenRedis())
+
+    calls = []
+    assert asyncio.run(cache.get("alice", _loader(calls, profile))) == profile
+    assert asyncio.run(cache.get("alice", _loader(calls, profile))) == profile
+    assert len(calls) == 2  # 未写入缓存，每次读库
@@ -1,9 +1,7 @@
 from fastapi.testclient import TestClient
-import sys
-import os
-sys.path.append(os.path.join(os.path.dirname(__file__), '../backend/gateway'))
+from conftest import load_module
 
-from main import app
+app = load_module("gateway", "main").app
 
 client = TestClient(app)
 
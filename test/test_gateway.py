@@ -0,0 +1,280 @@
+import asyncio
+import time
+import fakeredis.aioredis
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from jose import JWTError, jwt
+from conftest import load_module
+
+ratelimit = load_module("gateway", "ratelimit")
+auth_cache = load_module("gateway", "auth_cache")
+upstream = load_module("gateway", "upstream")
+sse = load_module("gateway", "sse")
+gateway = load_module("gateway", "main")
+settings = ratelimit.settings
+
+USER = {"username": "alice"}
+
+
+@pytest.fixture(autouse=True)
+def redis_timeout(monkeypatch):
+    # fakeredis 首次执行 Lua 较慢，放宽超时避免误判为 Redis 不可用
+    monkeypatch.setattr(settings, "RATE_LIMIT_REDIS_TIMEOUT", 1.0)
+
+
+# --- 限流 ---
+def test_rule_resolution():
+    limiter = ratelimit.HybridRateLimiter({"chat": {"default": "10/60", "role:vip": "100/60", "user:bob": "1/60"}})
+    assert limiter.resolve("chat", {"username": "alice"}) == (10, 60.0)
+    assert limiter.resolve("chat", {"username": "carol", "role": "vip"}) == (100, 60.0)
+    assert limiter.resolve("chat", {"username": "bob", "role": "vip"}) == (1, 60.0)
+    assert limiter.resolve("search", USER) is None
+
+
+def test_local_token_bucket_without_redis():
+    """未绑定 Redis (降级) 时按本地令牌桶判断，令牌按速率恢复"""
+    limiter = ratelimit.HybridRateLimiter({"chat": {"default": "3/60"}})
+
+    async def main():
+        return [await limiter.check("chat", USER) for _ in range(4)]
+
+    decisions = asyncio.run(main())
+    assert [allowed for allowed, _ in decisions] == [True, True, True, False]
+    assert 0 < decisions[-1][1] <= 20  # 约一个令牌的恢复时间
+
+    subject = limiter._subjects[("chat", "alice")]
+    subject.updated -= 20  # 经过 20 秒恢复一个令牌
+    assert asyncio.run(limiter.check("chat", USER))[0] is True
+
+
+def test_sliding_window_shared_across_instances():
+    """两个网关实例共用 Redis 窗口：本地放行的命中同步后计入全局，总放行数不超过上限"""
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    first = ratelimit.HybridRateLimiter({"chat": {"default": "4/60"}})
+    second = ratelimit.HybridRateLimiter({"chat": {"default": "4/60"}})
+    first.bind(redis)
+    second.bind(redis)
+
+    async def main():
+        allowed = [(await first.check("chat", USER))[0] for _ in range(3)]
+        await first.sync()
+        allowed += [(await second.check("chat", USER))[0] for _ in range(3)]
+        allowed += [(await first.check("chat", USER))[0] for _ in range(2)]
+        return allowed, await redis.zcard("rl:chat:alice")
+
+    allowed, count = asyncio.run(main())
+    assert sum(allowed) == 4
+    assert allowed[:4] == [True, True, True, True]
+    assert count == 4
+
+
+def test_redis_failure_degrades_to_local():
+    class BrokenRedis:
+        def register_script(self, script):
+            async def call(**kwargs):
+                raise ConnectionError("redis down")
+            return call
+
+    limiter = ratelimit.HybridRateLimiter({"chat": {"default": "2/60"}})
+    limiter.bind(BrokenRedis())
+
+    async def main():
+        return [(await limiter.check("chat", USER))[0] for _ in range(3)]
+
+    assert asyncio.run(main()) == [True, True, False]
+    assert limiter.degraded
+
+
+def test_pending_hits_survive_redis_failure():
+    """Redis 调用失败时本地已放行的命中不丢失，恢复后补记到全局窗口"""
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    limiter = ratelimit.HybridRateLimiter({"chat": {"default": "10/60"}})
+    limiter.bind(redis)
+    script = limiter._script
+
+    async def broken(**kwargs):
+        raise ConnectionError("redis down")
+
+    async def queued(**kwargs):
+        pass
+
+    class BrokenPipeline:
+        async def execute(self):
+            raise ConnectionError("redis down")
+
+    class BrokenRedis:
+        def pipeline(self, transaction):
+            return BrokenPipeline()
+
+    async def main():
+        await limiter.check("chat", USER)  # 首次请求同步走 Redis，得到全局计数
+        for _ in range(3):
+            await limiter.check("chat", USER)  # 余量充足，本地放行
+        subject = limiter._subjects[("chat", "alice")]
+        limiter.redis, limiter._script = BrokenRedis(), queued
+        await limiter.sync()  # pipeline 失败
+        after_sync = subject.pending
+        limiter._degraded_until = 0.0
+        subject.global_count = None
+        limiter.redis, limiter._script = redis, broken
+        await limiter.check("chat", USER)  # 同步检查失败，降级放行
+        after_check = subject.pending
+        limiter._script, limiter._degraded_until = script, 0.0
+        await limiter.sync()
+        return after_sync, after_check, subject.pending, await redis.zcard("rl:chat:alice")
+
+    after_sync, after_check, left, count = asyncio.run(main())
+    assert (after_sync, after_check, left) == (3, 3, 0)
+    assert count == 4  # 首次检查 + 3 次本地放行，降级期间的命中不补记
+
+
+# --- JWT 校验缓存与吊销 ---
+def _token(username="alice", ttl=600):
+    return jwt.encode({"sub": username, "exp": int(time.time()) + ttl}, settings.SECRET_KEY,
+                      algorithm=settings.ALGORITHM)
+
+
+def test_token_cache_hits_and_rejects_invalid():
+    cache = auth_cache.VerifiedTokenCache(max_entries=2)
+    token = _token()
+    assert cache.decode(token)["sub"] == "alice"
+    assert cache.decode(token)["sub"] == "alice"
+    assert len(cache._entries) == 1
+    with pytest.raises(JWTError):
+        cache.decode(token[:-2] + "xx")
+    for name in ("bob", "carol"):
+        cache.decode(_token(name))
+    assert len(cache._entries) == 2  # LRU 上限
+
+
+def test_token_revocation_reaches_other_instances():
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    local, remote = auth_cache.VerifiedTokenCache(100), auth_cache.VerifiedTokenCache(100)
+    local.bind(redis)
+    remote.bind(redis)
+    token = _token()
+
+    async def main():
+        await remote.refresh_revoked()
+        claims = local.decode(token)
+        remote.decode(token)  # 另一实例已缓存 claims
+        await local.revoke(token, claims)
+        with pytest.raises(JWTError):
+            local.decode(token)  # 本实例立即生效
+        remote.decode(token)  # 其他实例在刷新前仍按旧快照放行
+        await remote.refresh_revoked()
+        with pytest.raises(JWTError):
+            remote.decode(token)
+        remote.decode(_token("bob"))  # 其他 Token 不受影响
+
+    asyncio.run(main())
+
+
+# --- 上游连接池统计 ---
+def test_in_flight_transport_counts_open_responses():
+    transport = upstream.InFlightTransport(httpx.MockTransport(lambda request: httpx.Response(200, text="ok")))
+
+    async def main():
+        async with httpx.AsyncClient(transport=transport, base_url="http://kb") as client:
+            response = await client.send(client.build_request("GET", "/"), stream=True)
+            during = transport.in_flight
+            await response.aread()
+            await response.aclose()
+            await client.get("/")
+            return during, transport.in_flight
+
+    assert asyncio.run(main()) == (1, 0)
+    # 不是 httpcore 连接池时读不到内部状态，报告 unknown 而不是抛错
+    assert upstream._pool_state(transport.transport) == ("unknown", "unknown")
+
+
+# --- 可续传 SSE ---
+def test_upstream_frames_split_across_packets():
+    async def packets():
+        for text in ("data: 你", "好\n\nevent: usage\ndata: {}\n\ndata: a\ndata: b\n", "\n"):
+            yield text
+
+    async def main():
+        return [batch async for batch in sse.iter_upstream_events(packets())]
+
+    assert asyncio.run(main()) == [[("message", "你好"), ("usage", "{}")], [("message", "a\nb")]]
+    assert sse.parse_last_event_id("abc:3") == ("abc", 3)
+    assert sse.parse_last_event_id("garbage") == (None, 0)
+
+
+def _replay_buffer(monkeypatch):
+    monkeypatch.setattr(settings, "SSE_KEEPALIVE", 0.02)
+    buffer = sse.SSEReplayBuffer()
+    buffer.bind(fakeredis.aioredis.FakeRedis(decode_responses=True))
+    return buffer
+
+
+def test_replay_resumes_after_last_event_id_and_follows_live(monkeypatch):
+    buffer = _replay_buffer(monkeypatch)
+
+    async def main():
+        stream = await buffer.open("alice")
+        await stream.append_many([("message", "第一段"), ("message", "第二段\n第三行")])
+        # 客户端收到第 1 条后断线，带 Last-Event-ID 重连：补发缺失事件后继续跟随实时输出
+        reader = asyncio.create_task(_collect(buffer.events(stream.stream_id, after_seq=1)))
+        await asyncio.sleep(0.05)
+        await stream.append("message", "第四段")
+        await stream.append("done")
+        frames = await reader
+        ttl = await buffer.redis.ttl(sse.STREAM_KEY.format(stream.stream_id))
+        return stream.stream_id, frames, await buffer.owner(stream.stream_id), ttl
+
+    async def _collect(events):
+        return [frame async for frame in events]
+
+    stream_id, frames, owner, ttl = asyncio.run(main())
+    data = [frame for frame in frames if not frame.startswith(b":")]  # 去掉保活注释行
+    assert data == [
+        f"id: {stream_id}:2\ndata: 第二段\ndata: 第三行\n\n".encode(),
+        f"id: {stream_id}:3\ndata: 第四段\n\n".encode(),
+        f"id: {stream_id}:4\nevent: done\ndata: \n\n".encode(),
+    ]
+    assert owner == "alice" and 0 < ttl <= settings.SSE_BUFFER_TTL
+
+
+def test_replay_reports_gap_after_trim_and_idle_timeout(monkeypatch):
+    buffer = _replay_buffer(monkeypatch)
+    monkeypatch.setattr(settings, "SSE_BUFFER_MAXLEN", 2)
+    monkeypatch.setattr(settings, "SSE_IDLE_TIMEOUT", 0.05)
+
+    async def main():
+        stream = await buffer.open("alice")
+        await stream.append_many([("message", str(i)) for i in range(4)])  # 只保留最后 2 条
+        gap = [frame async for frame in buffer.events(stream.stream_id, after_seq=1)]
+        idle = [frame async for frame in buffer.events(stream.stream_id, after_seq=4)]
+        return gap, idle
+
+    gap, idle = asyncio.run(main())
+    assert len(gap) == 1 and b"event: error" in gap[0] and b"stream gap" in gap[0]
+    assert idle[0] == b": ping\n\n" and b"stream timeout" in idle[-1]
+
+
+# --- 预取检索 ---
+def test_speculative_prefetch_runs_only_after_token_check(monkeypatch):
+    posted = []
+
+    class LLMUpstream:
+        async def post(self, path, json, headers):
+            posted.append((path, json))
+
+    async def deny(route, user):
+        return False, 30.0
+
+    monkeypatch.setattr(settings, "SPECULATIVE_RETRIEVAL", True)
+    monkeypatch.setattr(gateway.upstreams, "get", lambda name: LLMUpstream())
+    monkeypatch.setattr(gateway.limiter, "check", deny)
+    client = TestClient(gateway.app)
+
+    body = {"query": "什么是 RAG"}
+    resp = client.post("/api/conversations/chat", json=body, headers={"Authorization": "Bearer invalid"})
+    assert resp.status_code == 401 and posted == []
+
+    resp = client.post("/api/conversations/chat", json=body, headers={"Authorization": f"Bearer {_token()}"})
+    assert resp.status_code == 429  # 预取在限流之前发出，按用户隔离
+    assert posted == [("/conversations/prefetch", {"query": "什么是 RAG", "user_id": "alice"})]
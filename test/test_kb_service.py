@@ -0,0 +1,375 @@
+import json
+import fakeredis
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from conftest import load_module
+
+lexical = load_module("kb_service", "core.lexical")
+local_store = load_module("kb_service", "core.local_store")
+rerank = load_module("kb_service", "core.rerank")
+chunking = load_module("kb_service", "core.chunking")
+kb_main = load_module("kb_service", "main")
+bulk = load_module("kb_service", "core.bulk")
+db = load_module("kb_service", "core.db")
+version = load_module("kb_service", "core.version")
+embedding_cache = load_module("kb_service", "core.embedding_cache")
+
+
+# --- 关键词检索 ---
+def test_reciprocal_rank_fusion():
+    fused = lexical.reciprocal_rank_fusion([["a", "b", "c"], ["b", "d"]], k=60)
+    assert fused[0] == ("b", 1 / 62 + 1 / 61)
+    assert dict(fused)["a"] == 1 / 61
+    assert {doc_id for doc_id, _ in fused} == {"a", "b", "c", "d"}
+
+
+def test_bm25_search_and_remove():
+    index = lexical.BM25Index("ngram")
+    index.add_many([
+        ("e1", "error code E1001 connection refused"),
+        ("e2", "如何配置 Redis 连接池"),
+        ("e3", "Redis 持久化配置说明"),
+    ])
+    assert [doc_id for doc_id, _ in index.search("E1001", 3)] == ["e1"]
+    hits = index.search("Redis 连接池", 3)
+    assert hits[0][0] == "e2" and {doc_id for doc_id, _ in hits} == {"e2", "e3"}
+
+    index.remove_many(["e2"])
+    assert [doc_id for doc_id, _ in index.search("连接池", 3)] == []
+    index.add_many([("e3", "完全不同的内容")])  # 同 ID 覆盖旧版本
+    assert index.search("持久化", 3) == []
+    assert len(index) == 2
+
+
+def test_bm25_save_load_and_diff(tmp_path):
+    """快照带 content_hash，加载后与向量库对账找出需删除 / 重新索引的文档"""
+    index = lexical.BM25Index("ngram")
+    index.add_many([("a", "苹果 apple"), ("b", "香蕉 banana")], {"a": "h1", "b": "h2"})
+    path = str(tmp_path / "lexical.idx")
+    index.save(path)
+
+    loaded = lexical.BM25Index.load(path, "ngram")
+    assert loaded.search("banana", 1)[0][0] == "b"
+    assert lexical.BM25Index.load(path, "jieba") is None
+    stale, missing = loaded.diff({"a": "h1", "b": "h2-new", "c": "h3"})
+    assert stale == []
+    assert sorted(missing) == ["b", "c"]
+    assert loaded.diff({"a": "h1"}) == (["b"], [])
+
+
+# --- 本地向量库 ---
+def test_local_collection_query_and_get(tmp_path):
+    collection = local_store.LocalCollection(str(tmp_path))
+    collection.upsert(
+        ids=["a", "b", "c#0", "c#1"],
+        embeddings=[[1, 0, 0], [0, 2, 0], [0, 0, 1], [0.6, 0.8, 0]],
+        documents=["doc a", "doc b", "chunk 0", "chunk 1"],
+        metadatas=[{"id": "a", "category": "x"}, {"id": "b", "category": "y"},
+                   {"id": "c#0", "parent_id": "c"}, {"id": "c#1", "parent_id": "c"}],
+    )
+    assert collection.count() == 4
+
+    result = collection.query(query_embeddings=[[0, 1, 0]], n_results=2)
+    assert result["ids"][0] == ["b", "c#1"]
+    assert result["distances"][0][0] < result["distances"][0][1]
+    filtered = collection.query(query_embeddings=[[0, 1, 0]], n_results=2, where={"category": "x"})
+    assert filtered["ids"][0] == ["a"]
+
+    got = collection.get(where={"$or": [{"parent_id": {"$in": ["c"]}}, {"id": {"$in": ["c"]}}]})
+    assert got["ids"] == ["c#0", "c#1"]
+    vectors = collection.get(ids=["b"], include=["embeddings"])["embeddings"]
+    assert np.allclose(vectors[0], [0, 1, 0])  # 入库时已归一化
+
+    collection.upsert(ids=["b"], embeddings=[[1, 0, 0]], documents=["doc b v2"], metadatas=[{"id": "b"}])
+    collection.delete(ids=["a"])
+    assert collection.count() == 3
+    assert collection.get(ids=["b"])["documents"] == ["doc b v2"]
+    assert collection.query(query_embeddings=[[1, 0, 0]], n_results=1)["ids"][0] == ["b"]
+
+    # 另一个进程 (这里用第二个实例模拟) 能看到已提交的写入
+    reader = local_store.LocalCollection(str(tmp_path), readonly=True)
+    assert reader.count() == 3
+
+
+def test_local_collection_rejects_unsafe_where_keys(tmp_path):
+    collection = local_store.LocalCollection(str(tmp_path))
+    collection.upsert(ids=["a"], embeddings=[[1, 0]], metadatas=[{"id": "a"}])
+    with pytest.raises(ValueError):
+        collection.get(where={"id') OR 1=1 OR json_extract(metadata, '$.id": "x"})
+    with pytest.raises(ValueError):
+        collection.query(query_embeddings=[[1, 0]], where={"a.b": "x"})
+
+
+def test_local_collection_filtered_query_ignores_unmapped_rows(tmp_path):
+    """过滤查询读到其他进程刚追加、本进程尚未映射的行时跳过，不越界"""
+    reader = local_store.LocalCollection(str(tmp_path))
+    reader.upsert(ids=["a"], embeddings=[[1, 0]], metadatas=[{"tag": "t"}])
+    reader.count()
+    writer = local_store.LocalCollection(str(tmp_path))
+    writer.upsert(ids=[f"n{i}" for i in range(1100)], embeddings=[[0, 1]] * 1100, metadatas=[{"tag": "t"}] * 1100)
+
+    reader._refresh = lambda: None  # 模拟刷新之后、按条件查询之前发生的写入
+    result = reader.query(query_embeddings=[[1, 0]], n_results=2, where={"tag": "t"})
+    assert result["ids"][0][0] == "a"
+
+
+# --- MMR 重排 ---
+def test_mmr_prefers_diverse_documents():
+    query = rerank.normalize([0.95, 0.312])
+    docs = rerank.normalize([[1.0, 0.0], [0.999, 0.045], [0.6, 0.8]])
+    by_relevance, _ = rerank.mmr(query, docs, 3, lambda_mult=1.0)
+    assert by_relevance == [1, 0, 2]
+    # 第二条与第一条几乎相同，多样性权重下让位于内容不同的文档
+    diverse, relevance = rerank.mmr(query, docs, 2, lambda_mult=0.5)
+    assert diverse == [1, 2]
+    assert np.allclose(relevance, docs @ query)
+
+
+def test_mmr_rerank_without_candidates_skips_lookup():
+    """没有候选时不访问向量库 (Chroma 的 get 不接受空 ID 列表)"""
+    class Collection:
+        def get(self, **kwargs):
+            raise AssertionError("collection.get should not be called")
+
+    assert rerank.mmr_rerank(Collection(), [1.0, 0.0], [], 3, 0.5, 0.2) == []
+    assert rerank.mmr_rerank(Collection(), [1.0, 0.0], [{"content": "x", "metadata": {}}], 3, 0.5, 0.2) == []
+
+
+def _long_document():
+    return (
+        "# 安装\n\n" + "".join(f"第{i}步：执行安装命令并检查输出结果是否正常。" for i in range(60)) + "\n\n"
+        + " ".join(f"Step {i} checks the output." for i in range(80)) + "\n\n"
+        + "# 配置\n\n" + "".join(f"配置项{i}用于控制服务行为，默认值可以在环境变量中覆盖。" for i in range(40))
+    )
+
+
+# --- 分块 ---
+def test_split_text_keeps_short_text_whole():
+    """短文本不切分，只有一块时沿用文档 ID"""
+    assert chunking.split_text("LangChain 的 Chain 是什么") == [("LangChain 的 Chain 是什么", 0)]
+    [(chunk_id, _, metadata)] = chunking.chunk_document("doc", "短文本", {"category": "General"})
+    assert chunk_id == "doc"
+    assert metadata["parent_id"] == "doc" and metadata["chunk_count"] == 1
+
+
+def test_chunks_respect_size_and_headings():
+    """每块不超过 CHUNK_SIZE，且不跨越标题"""
+    text = _long_document()
+    chunks = chunking.chunk_document("doc", text, {})
+    assert len(chunks) > 2
+    assert [c[0] for c in chunks] == [f"doc#{i}" for i in range(len(chunks))]
+    for _, content, metadata in chunks:
+        assert chunking.estimate_tokens(content) <= chunking.settings.CHUNK_SIZE
+        assert "# 配置" not in content or content.startswith("# 配置")
+        assert metadata["chunk_count"] == len(chunks)
+
+
+def test_join_chunks_round_trip():
+    """按顺序拼接全部分块 (去掉重叠部分) 还原原文，段落首尾空白除外"""
+    text = _long_document()
+    chunks = chunking.chunk_document("doc", text, {})
+    assert any(metadata["overlap"] for _, _, metadata in chunks)
+    joined = chunking.join_chunks([{"content": content, "metadata": metadata} for _, content, metadata in chunks])
+    assert [p.strip() for p in joined.split("\n\n")] == [p.strip() for p in text.split("\n\n")]
+
+
+# --- 批量写入 ---
+HEADERS = {"X-Internal-Key": "test_key"}
+
+
+class CountingEmbeddings:
+    def __init__(self):
+        self.calls = []
+
+    def embed_query(self, text):
+        self.calls.append([text])
+        return [float(len(text)), 1.0]
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(t)), 1.0] for t in texts]
+
+
+@pytest.fixture
+def kb(tmp_path, monkeypatch):
+    """本地向量库 + 假 Embedding，返回 (TestClient, 集合, 每次 Embedding 的文本列表)"""
+    embedded = []
+
+    def embed_batch(texts):
+        embedded.append(list(texts))
+        return CountingEmbeddings().embed_documents(texts), 0
+
+    monkeypatch.setattr(kb_main.settings, "VECTOR_BACKEND", "local")
+    monkeypatch.setattr(kb_main.settings, "LOCAL_STORE_PATH", str(tmp_path / "store"))
+    monkeypatch.setattr(kb_main.settings, "LEXICAL_INDEX_PATH", str(tmp_path / "lexical.idx"))
+    monkeypatch.setattr(kb_main, "INTERNAL_KEY", HEADERS["X-Internal-Key"])
+    monkeypatch.setattr(db, "_embeddings", CountingEmbeddings())
+    monkeypatch.setattr(version, "_client", None)
+    monkeypatch.setattr(bulk, "embed_batch", embed_batch)
+    db.reset_vector_store()
+    lexical._index = None
+    yield TestClient(kb_main.app), db.get_vector_store()._collection, embedded
+    db.reset_vector_store()
+    lexical._index = None
+
+
+def _bulk(client, path, rows):
+    body = "\n".join(row if isinstance(row, str) else json.dumps(row, ensure_ascii=False) for row in rows)
+    resp = client.post(path, content=body, headers=HEADERS)
+    assert resp.status_code == 200 and resp.headers["content-type"].startswith("application/x-ndjson")
+    *lines, summary = [json.loads(line) for line in resp.text.splitlines()]
+    return lines, summary["counts"]
+
+
+def test_bulk_upsert_reports_every_line(kb):
+    client, collection, embedded = kb
+    lines, counts = _bulk(client, "/documents/bulk", [
+        {"id": "a", "content": "第一版"}, {"id": "b", "content": "文档 b"}, "{bad", {"id": "a", "content": "第二版"},
+    ])
+    # 校验失败的行立即输出，其余按批输出，用行号对应请求体
+    assert sorted((row["line"], row.get("id"), row["status"]) for row in lines) == [
+        (1, "a", "upserted"), (2, "b", "upserted"), (3, None, "error"), (4, "a", "upserted"),
+    ]
+    assert counts == {"upserted": 3, "error": 1}
+    assert collection.get(ids=["a"])["documents"] == ["第二版"]  # 同一批内重复 ID 以最后一条为准
+    assert len(embedded) == 1
+
+    lines, counts = _bulk(client, "/documents/bulk", [{"id": "a", "content": "第二版"}])
+    assert counts == {"unchanged": 1} and len(embedded) == 1
+
+
+def test_bulk_metadata_change_is_written_without_embedding(kb):
+    client, collection, embedded = kb
+    _bulk(client, "/documents/bulk", [{"id": "a", "content": "内容", "category": "旧分类"}])
+    before = version.get_kb_version()
+    lines, counts = _bulk(client, "/documents/bulk", [{"id": "a", "content": "内容", "category": "新分类"}])
+    assert counts == {"metadata_updated": 1}
+    assert collection.get(ids=["a"])["metadatas"][0]["category"] == "新分类"
+    assert len(embedded) == 1  # 只改元数据不重新 Embedding
+    assert version.get_kb_version() != before
+
+
+def test_bulk_delete_reports_missing_without_bumping_version(kb):
+    client, collection, _ = kb
+    _bulk(client, "/documents/bulk", [{"id": "a", "content": "内容"}])
+    lines, counts = _bulk(client, "/documents/bulk-delete", [{"id": "a"}, {"id": "missing"}])
+    assert [row["status"] for row in lines] == ["deleted", "not_found"]
+    assert collection.count() == 0
+
+    before = version.get_kb_version()
+    _, counts = _bulk(client, "/documents/bulk-delete", [{"id": "missing"}])
+    assert counts == {"not_found": 1}
+    assert version.get_kb_version() == before
+
+
+def test_create_document_applies_metadata_edit(kb):
+    """单条新增走 upsert_batch：同内容只改分类也要写入，旧版本多出来的分块被删除"""
+    client, collection, embedded = kb
+    long_text = _long_document()
+    assert client.post("/documents", json={"id": "d", "content": long_text}, headers=HEADERS).status_code == 201
+    assert len(collection.get(where={"parent_id": "d"})["ids"]) > 1
+
+    resp = client.post("/documents", json={"id": "d", "content": long_text, "category": "FAQ"}, headers=HEADERS)
+    assert resp.status_code == 201
+    assert {m["category"] for m in collection.get(where={"parent_id": "d"})["metadatas"]} == {"FAQ"}
+    assert len(embedded) == 1
+
+    client.post("/documents", json={"id": "d", "content": "短文本"}, headers=HEADERS)
+    assert collection.get(where={"parent_id": "d"})["ids"] == ["d"]
+
+
+# --- 查询向量缓存 ---
+def _redis_tier(client):
+    tier = embedding_cache.RedisEmbeddingTier("redis://unused:6379/0", ttl=60)
+    tier._client = client
+    return tier
+
+
+def test_embedding_lru_evicts_by_bytes():
+    lru = embedding_cache.EmbeddingLRU(max_bytes=16)  # 两个 2 维 float32 向量
+    for key in ("a", "b"):
+        lru.put(key, embedding_cache.array("f", [1.0, 2.0]))
+    lru.get("a")  # a 变为最近使用
+    lru.put("c", embedding_cache.array("f", [3.0, 4.0]))
+    assert lru.get("b") is None
+    assert lru.get("a") is not None and lru.get("c") is not None
+
+
+def test_cached_embeddings_share_redis_and_batch_misses():
+    redis = fakeredis.FakeRedis()
+    first, second = CountingEmbeddings(), CountingEmbeddings()
+    cache = embedding_cache.CachedEmbeddings(first, "m", embedding_cache.EmbeddingLRU(1 << 20), _redis_tier(redis))
+    other = embedding_cache.CachedEmbeddings(second, "m", embedding_cache.EmbeddingLRU(1 << 20), _redis_tier(redis))
+
+    assert cache.embed_query("Hello World") == [11.0, 1.0]
+    assert cache.embed_query("  ｈｅｌｌｏ   world") == [11.0, 1.0]  # 归一化后命中同一条
+    assert other.embed_query("hello world") == [11.0, 1.0]  # 另一个进程从 Redis 命中
+    assert second.calls == []
+
+    # 批量：命中的直接返回，未命中的去重后合并成一次请求
+    vectors = other.embed_queries(["hello world", "abc", "ABC", "de"])
+    assert vectors == [[11.0, 1.0], [3.0, 1.0], [3.0, 1.0], [2.0, 1.0]]
+    assert second.calls == [["abc", "de"]]
+    assert len(first.calls) == 1
+
+
+def test_redis_tier_failure_pauses_lookups():
+    class BrokenRedis:
+        calls = 0
+
+        def get(self, key):
+            BrokenRedis.calls += 1
+            raise embedding_cache.redis.ConnectionError("down")
+
+        set = get
+
+    inner = CountingEmbeddings()
+    cache = embedding_cache.CachedEmbeddings(inner, "m", embedding_cache.EmbeddingLRU(1 << 20), _redis_tier(BrokenRedis()))
+    assert cache.embed_query("a") == [1.0, 1.0]
+    assert cache.embed_query("b") == [1.0, 1.0]
+    assert BrokenRedis.calls == 1  # 首次失败后冷却期内不再访问 Redis
+
+
+# --- 多 worker 关键词索引同步 ---
+def test_search_results_keep_score_field(kb):
+    client, _, _ = kb
+    _bulk(client, "/documents/bulk", [{"id": "a", "content": "苹果 apple"}, {"id": "b", "content": "香蕉 banana"}])
+    for mode in ("vector", "lexical", "hybrid"):
+        resp = client.post("/documents/search", json={"query": "apple", "top_k": 2, "mode": mode, "rerank": False},
+                           headers=HEADERS)
+        hits = resp.json()["results"]
+        assert hits and all(set(hit) == {"content", "metadata", "score"} for hit in hits)
+
+
+def test_lexical_index_replays_other_workers_changes(kb, monkeypatch):
+    """每个 worker 只回放其他 worker 追加到变更日志的改动，不做全量对账；日志轮转后退回全量对账"""
+    client, collection, _ = kb
+    _bulk(client, "/documents/bulk", [{"id": "a", "content": "alpha 苹果"}])
+    lexical.flush_lexical_index()
+    worker_a = lexical._index, lexical._writer_id, lexical._log_position
+
+    # 另一个 worker：独立的索引、写入标记与日志读取位置
+    lexical._index, lexical._writer_id = None, "worker-b"
+    lexical.get_lexical_index(collection)
+    _bulk(client, "/documents/bulk", [{"id": "b", "content": "beta 香蕉"}])
+    _bulk(client, "/documents/bulk-delete", [{"id": "a"}])
+    lexical.flush_lexical_index()
+    worker_b = lexical._index, lexical._writer_id, lexical._log_position
+
+    lexical._index, lexical._writer_id, lexical._log_position = worker_a
+    reconcile = lexical.reconcile_with_collection
+    monkeypatch.setattr(lexical, "reconcile_with_collection", lambda *args: pytest.fail("full reconcile"))
+    lexical.flush_lexical_index()
+    assert [doc_id for doc_id, _ in lexical._index.search("香蕉", 3)] == ["b"]
+    assert lexical._index.search("苹果", 3) == []
+
+    # 日志超过上限时轮转，读取位置落在旧日志上的 worker 全量对账一次
+    monkeypatch.setattr(lexical, "reconcile_with_collection", reconcile)
+    monkeypatch.setattr(lexical.settings, "LEXICAL_CHANGELOG_MAX_BYTES", 1)
+    _bulk(client, "/documents/bulk", [{"id": "c", "content": "gamma 橙子"}])
+    lexical.flush_lexical_index()
+    assert lexical._log_position[1] == 0
+    lexical._index, lexical._writer_id, lexical._log_position = worker_b
+    lexical.flush_lexical_index()
+    assert sorted(lexical._index._doc_index) == ["b", "c"]
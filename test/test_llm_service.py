@@ -0,0 +1,414 @@
+import asyncio
+import json
+import fakeredis
+import fakeredis.aioredis
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage, message_to_dict
+from langchain_core.prompt_values import StringPromptValue
+from langchain_core.runnables import RunnableLambda
+from conftest import load_module
+
+coalesce = load_module("llm_service", "core.coalesce")
+context = load_module("llm_service", "core.context")
+count_tokens = context.count_tokens
+semantic_cache = load_module("llm_service", "core.semantic_cache")
+history = load_module("llm_service", "core.history")
+memory = load_module("llm_service", "core.memory")
+llm = load_module("llm_service", "core.llm")
+streaming = load_module("llm_service", "core.streaming")
+
+
+# --- 请求合并 ---
+def test_single_flight_shares_one_call():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def main():
+        flight = coalesce.SingleFlight("test")
+        results = await asyncio.gather(*(flight.do("k", fetch) for _ in range(5)))
+        again = await flight.do("k", fetch)  # 完成后不再复用
+        return results, again
+
+    results, again = asyncio.run(main())
+    assert results == ["result"] * 5 and again == "result"
+    assert len(calls) == 2
+
+
+def test_stream_fanout_replays_to_followers():
+    calls = []
+
+    async def tokens():
+        calls.append(1)
+        for i in range(5):
+            await asyncio.sleep(0.005)
+            yield i
+
+    async def main():
+        fanout = coalesce.StreamFanout("test", window=5)
+        roles = []
+
+        async def consume(delay=0.0):
+            await asyncio.sleep(delay)
+            return [c async for c in fanout.subscribe("k", tokens, roles.append)]
+
+        # 第二个订阅者在生成中途加入，第三个在生成结束后 (窗口期内) 加入
+        results = await asyncio.gather(consume(), consume(0.012), consume(0.05))
+        return results, roles
+
+    results, roles = asyncio.run(main())
+    assert results == [[0, 1, 2, 3, 4]] * 3
+    assert roles == ["leader", "follower", "follower"]
+    assert len(calls) == 1
+
+
+def test_stream_fanout_cancels_upstream_without_subscribers():
+    pulled = []
+
+    async def tokens():
+        for i in range(100):
+            await asyncio.sleep(0.005)
+            pulled.append(i)
+            yield i
+
+    async def main():
+        fanout = coalesce.StreamFanout("test", window=5)
+        stream = fanout.subscribe("k", tokens)
+        got = [await stream.__anext__() for _ in range(3)]
+        await stream.aclose()  # 唯一的订阅者断开
+        await asyncio.sleep(0.05)
+        restarted = []
+        async for chunk in fanout.subscribe("k", tokens, restarted.append):
+            break
+        return got, restarted
+
+    got, restarted = asyncio.run(main())
+    assert got == [0, 1, 2]
+    assert len(pulled) < 10  # 上游调用已取消
+    assert restarted == ["leader"]  # 之后相同的请求重新发起生成
+
+
+def test_stream_fanout_propagates_errors():
+    async def failing():
+        yield "partial"
+        raise RuntimeError("upstream failed")
+
+    async def main():
+        fanout = coalesce.StreamFanout("test", window=5)
+        received = []
+        try:
+            async for chunk in fanout.subscribe("k", failing):
+                received.append(chunk)
+        except RuntimeError as e:
+            return received, str(e)
+
+    assert asyncio.run(main()) == (["partial"], "upstream failed")
+
+
+# --- 检索上下文打包 ---
+def _doc(content):
+    return {"content": content, "metadata": {}}
+
+
+def test_pack_context_fits_everything_within_budget():
+    text, used = context.pack_context([_doc("第一篇。"), _doc("第二篇。\n\n相关问题参考:\n问题?")], 1000)
+    assert text == "文档1: 第一篇。\n\n文档2: 第二篇。"  # 相似问题只用于召回，不进 Prompt
+    assert used <= 1000
+
+
+def test_pack_context_truncates_at_sentence_boundary():
+    sentences = "".join(f"这是第{i}句话，用来占用预算。" for i in range(50))
+    for budget in (30, 60, 120):
+        text, used = context.pack_context([_doc("简短的第一篇。"), _doc(sentences)], budget)
+        assert used <= budget
+        assert count_tokens(text) <= budget
+        assert text.endswith("。")  # 只在句末截断
+    text, _ = context.pack_context([_doc("简短的第一篇。"), _doc(sentences)], 60)
+    assert text.startswith("文档1: 简短的第一篇。\n\n文档2: 这是第0句话")
+
+
+def test_pack_context_stops_when_nothing_fits():
+    text, used = context.pack_context([_doc("一句非常非常非常非常非常非常长的话。")], 3)
+    assert (text, used) == ("", 0)
+
+
+# --- 语义答案缓存 ---
+def test_semantic_cache_matches_similar_questions():
+    cache = semantic_cache.SemanticCache(max_entries=4, threshold=0.95, ttl=60)
+    cache.put([1.0, 0.0], "v1", "答案 A")
+    assert cache.get([0.99, 0.05], "v1") == "答案 A"  # 余弦相似度高于阈值
+    assert cache.get([0.6, 0.8], "v1") is None
+    assert cache.get([1.0, 0.0], "v2") is None  # 知识库版本变化后整体失效
+    assert cache.get([1.0, 0.0], "v1") is None
+
+
+def test_semantic_cache_expires_and_evicts_least_recently_used():
+    cache = semantic_cache.SemanticCache(max_entries=2, threshold=0.95, ttl=60)
+    cache.put([1.0, 0.0], "v1", "A")
+    cache.put([0.0, 1.0], "v1", "B")
+    cache._last_used[1] -= 10
+    cache.get([1.0, 0.0], "v1")  # A 最近被使用
+    cache.put([0.7, 0.7], "v1", "C")  # 容量满，淘汰最久未使用的 B
+    assert cache.get([0.0, 1.0], "v1") is None
+    assert cache.get([1.0, 0.0], "v1") == "A"
+
+    cache._created[:] -= 61  # 全部超过 TTL
+    assert cache.get([1.0, 0.0], "v1") is None
+
+
+# --- 会话历史存储 ---
+def test_history_migrates_legacy_message_store_keys():
+    """旧版 RedisChatMessageHistory 的数据 (LPUSH，最新在前) 首次读取时按时间顺序迁移到新前缀"""
+    server = fakeredis.FakeServer()
+    redis = fakeredis.aioredis.FakeRedis(server=server)
+    store = history.AsyncRedisChatMessageHistory("s1", ttl=600, client=redis)
+
+    async def main():
+        for message in (HumanMessage(content="你好"), AIMessage(content="你好！")):
+            await redis.lpush("message_store:s1", json.dumps(message_to_dict(message)))
+        await redis.expire("message_store:s1", 300)
+        migrated = await store.aget_messages()
+        await store.aadd_messages([HumanMessage(content="再见")])
+        return migrated, await store.aget_messages(), await redis.exists("message_store:s1"), await redis.ttl(store.key)
+
+    migrated, after, legacy_left, ttl = asyncio.run(main())
+    assert [(type(m), m.content) for m in migrated] == [(HumanMessage, "你好"), (AIMessage, "你好！")]
+    assert [m.content for m in after] == ["你好", "你好！", "再见"]
+    assert legacy_left == 0 and 0 < ttl <= 600
+
+
+def test_history_sync_interface_reuses_one_client(monkeypatch):
+    server = fakeredis.FakeServer()
+    created = []
+
+    def from_url(url):
+        created.append(url)
+        return fakeredis.FakeRedis(server=server)
+
+    monkeypatch.setattr(history.redis.Redis, "from_url", staticmethod(from_url))
+    monkeypatch.setattr(history, "_sync_client", None)
+    store = history.AsyncRedisChatMessageHistory("s2", ttl=600)
+    store.add_messages([HumanMessage(content="问题"), AIMessage(content="回答")])
+    assert [m.content for m in store.messages] == ["问题", "回答"]
+    store.clear()
+    assert store.messages == []
+    assert len(created) == 1
+
+
+# --- 历史窗口与滚动摘要 ---
+def _turns(n):
+    return [m for i in range(n) for m in (HumanMessage(content=f"问题{i}" * 10), AIMessage(content=f"回答{i}" * 10))]
+
+
+def _windowed(redis, summarizer=None, budget=None):
+    per_turn = memory.count_message_tokens(_turns(1))
+    return memory.WindowedChatMessageHistory("s", ttl=600, token_budget=budget or per_turn * 2,
+                                             summarizer=summarizer, client=redis)
+
+
+def test_window_keeps_recent_turns_and_summary():
+    redis = fakeredis.aioredis.FakeRedis()
+    store = _windowed(redis)
+
+    async def main():
+        await store.aadd_messages(_turns(4))
+        window = await store.aget_messages()
+        await redis.set(store.summary_key, "早先的摘要")
+        return window, await store.aget_messages()
+
+    window, with_summary = asyncio.run(main())
+    assert [m.content for m in window] == [m.content for m in _turns(4)[-4:]]  # 预算内最近两轮
+    assert isinstance(with_summary[0], SystemMessage) and "早先的摘要" in with_summary[0].content
+    assert len(with_summary) < len(window) + 1  # 摘要占用预算后保留的原文更少
+
+
+def test_fold_overflow_summarizes_old_turns():
+    redis = fakeredis.aioredis.FakeRedis()
+    folded = []
+
+    async def summarizer(summary, messages):
+        folded.append([m.content for m in messages])
+        return "摘要"
+
+    store = _windowed(redis, summarizer)
+
+    async def main():
+        await store.aadd_messages(_turns(4))
+        await asyncio.gather(*memory._fold_tasks)
+        return await redis.lrange(store.key, 0, -1), await redis.get(store.summary_key), await redis.ttl(store.summary_key)
+
+    remaining, summary, ttl = asyncio.run(main())
+    assert folded == [[m.content for m in _turns(4)[:4]]]
+    assert len(remaining) == 4 and summary.decode() == "摘要" and 0 < ttl <= 600
+
+
+def test_clear_during_summarization_discards_the_summary():
+    redis = fakeredis.aioredis.FakeRedis()
+
+    async def main():
+        started, release = asyncio.Event(), asyncio.Event()
+
+        async def summarizer(summary, messages):
+            started.set()
+            await release.wait()
+            return "已清空会话的摘要"
+
+        store = _windowed(redis, summarizer)
+        await store.aadd_messages(_turns(4))
+        await started.wait()
+        await store.aclear()
+        await store.aadd_messages([HumanMessage(content="新问题"), AIMessage(content="新回答")])  # 清空后的新对话
+        release.set()
+        await asyncio.gather(*memory._fold_tasks)
+        return await redis.get(store.summary_key), [m.content for m in await store.aget_messages()]
+
+    summary, messages = asyncio.run(main())
+    assert summary is None
+    assert messages == ["新问题", "新回答"]
+
+
+def test_summarize_history_reports_usage(monkeypatch):
+    reports = []
+    reply = AIMessage(content="摘要", usage_metadata={"input_tokens": 120, "output_tokens": 30, "total_tokens": 150})
+    monkeypatch.setattr(llm, "llm", RunnableLambda(lambda prompt: reply))
+    monkeypatch.setattr(llm, "report_usage", lambda username, summary: reports.append((username, summary)))
+
+    assert asyncio.run(llm.get_message_history("alice").summarizer("", _turns(1))) == "摘要"
+    assert reports == [("alice", {"usage": {"prompt_tokens": 120, "completion_tokens": 30}, "source": "summary"})]
+
+
+# --- 预取检索 ---
+def test_prefetch_is_per_user_and_expires(monkeypatch):
+    searches = []
+
+    async def search(query):
+        searches.append(query)
+        await asyncio.sleep(1)
+        return "context"
+
+    monkeypatch.setattr(llm, "search_knowledge_base", search)
+    monkeypatch.setattr(llm.settings, "PREFETCH_TTL", 0.02)
+
+    async def main():
+        llm.start_prefetch("alice", "什么是 RAG")
+        llm.start_prefetch("alice", "什么是  RAG")  # 同一用户的相同问题只预取一次
+        other_user = llm.take_prefetched("bob", "什么是 RAG")
+        expiring = llm._prefetched[llm.prefetch_key("alice", "什么是 RAG")]
+        await asyncio.sleep(0.05)  # 超过 TTL 未被取走
+        return other_user, expiring, llm.take_prefetched("alice", "什么是 RAG")
+
+    other_user, expiring, expired = asyncio.run(main())
+    assert other_user is None and expired is None
+    assert expiring.cancelled()
+    assert len(searches) == 1 and llm._prefetched == {}
+
+
+# --- SSE 输出合并 ---
+def _frames(chunks, monkeypatch, flush_ms=1000, flush_bytes=512):
+    monkeypatch.setattr(streaming.settings, "SSE_FLUSH_MS", flush_ms)
+    monkeypatch.setattr(streaming.settings, "SSE_FLUSH_BYTES", flush_bytes)
+
+    async def main():
+        meta = streaming.new_stream_meta()
+        return [frame async for frame in streaming.sse_stream(chunks(), meta)]
+
+    return asyncio.run(main())
+
+
+def test_sse_stream_sends_first_token_then_coalesces(monkeypatch):
+    async def chunks():
+        for text in ("首", "a", "b\nc", "d"):
+            yield text
+
+    frames = _frames(chunks, monkeypatch)
+    assert frames[:2] == ["data: 首\n\n".encode(), b"data: ab\ndata: cd\n\n"]  # 首 token 立即发出，其余合并
+    summary = json.loads(frames[-1].decode().split("data: ", 1)[1])
+    assert frames[-1].startswith(b"event: usage\n")
+    assert summary["frames"] == 2 and summary["bytes"] == len(frames[0]) + len(frames[1])
+
+
+def test_sse_stream_flushes_on_size_and_time(monkeypatch):
+    async def bursts():
+        for text in ("0", "12345", "678", "9"):
+            yield text
+
+    frames = _frames(bursts, monkeypatch, flush_bytes=4)
+    assert frames[:-1] == [b"data: 0\n\n", b"data: 12345\n\n", b"data: 6789\n\n"]  # 缓冲满 4 字节即刷新
+
+    async def slow():
+        yield "0"
+        yield "1"
+        await asyncio.sleep(0.1)  # 超过刷新间隔，已缓冲的内容先发出
+        yield "2"
+
+    frames = _frames(slow, monkeypatch, flush_ms=20)
+    assert frames[:-1] == [b"data: 0\n\n", b"data: 1\n\n", b"data: 2\n\n"]
+
+
+def test_sse_stream_reports_errors_as_event(monkeypatch):
+    async def failing():
+        yield "部分"
+        yield "回答"
+        raise RuntimeError("upstream failed")
+
+    frames = _frames(failing, monkeypatch)
+    assert frames[1] == "data: 回答\n\n".encode()  # 出错前缓冲的内容先发出
+    assert frames[2] == b"event: error\ndata: Error: upstream failed\n\n"
+    assert frames[3].startswith(b"event: usage\n")
+
+
+# --- 输出阶段与计费 ---
+def test_sse_stream_meters_when_client_disconnects():
+    finished = []
+
+    async def chunks(meta):
+        try:
+            for i in range(100):
+                await asyncio.sleep(0.005)
+                yield f"token{i}"
+        finally:
+            meta["usage"] = {"prompt_tokens": 10, "completion_tokens": 1, "total_tokens": 11}
+
+    async def main():
+        meta = streaming.new_stream_meta()
+        stream = streaming.sse_stream(chunks(meta), meta, on_finish=finished.append)
+        first = await stream.__anext__()
+        await stream.aclose()  # 客户端断开
+        return first
+
+    assert asyncio.run(main()) == b"data: token0\n\n"
+    assert len(finished) == 1
+    assert finished[0]["usage"]["completion_tokens"] == 1  # 上游生成器收尾后才计费
+
+
+def test_shared_generation_bills_the_leader_after_it_disconnects(monkeypatch):
+    reports = []
+
+    class FakeModel:
+        async def astream(self, prompt_value):
+            for i in range(5):
+                await asyncio.sleep(0.005)
+                yield AIMessageChunk(content=f"t{i}")
+            yield AIMessageChunk(content="", usage_metadata={"input_tokens": 50, "output_tokens": 5, "total_tokens": 55})
+
+    monkeypatch.setattr(llm, "llm", FakeModel())
+    monkeypatch.setattr(llm, "report_usage", lambda username, summary: reports.append((username, summary)))
+
+    async def main():
+        fanout = coalesce.StreamFanout("test", window=5)
+        factory = lambda: llm.shared_generation(StringPromptValue(text="问题"), "alice")
+        leader = fanout.subscribe("k", factory)
+        await leader.__anext__()
+        follower = asyncio.create_task(_collect(fanout.subscribe("k", factory)))
+        await asyncio.sleep(0)
+        await leader.aclose()  # 发起方中途断开，跟随者继续接收
+        return await follower
+
+    async def _collect(stream):
+        return [chunk.content async for chunk in stream]
+
+    assert asyncio.run(main())[-1] == ""
+    assert reports == [("alice", {"usage": {"prompt_tokens": 50, "completion_tokens": 5, "total_tokens": 55},
+                                  "source": "llm"})]
@@ -0,0 +1,96 @@
+"""
+测量各服务的冷启动导入耗时：每次新开一个解释器执行 `import main`，取中位数，
+并用 -X importtime 列出 main 直接导入的模块中最耗时的几个。
+
+导入阶段不连接任何外部服务，缺少的必需环境变量用占位值补齐。
+
+示例：
+    python tools/import_time.py
+    python tools/import_time.py --services gateway llm_service --runs 10 --top 8
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BACKEND = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "backend"))
+SERVICES = ["gateway", "auth_service", "llm_service", "kb_service"]
+
+# 模块导入时就会读取的配置
+PLACEHOLDER_ENV = {
+    "DATABASE_URL": "sqlite://",
+    "OPENAI_API_KEY": "placeholder",
+    "SECRET_KEY": "placeholder",
+    "INTERNAL_API_KEY": "placeholder",
+}
+
+TIMER = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+
+
+def service_env() -> dict:
+    env = {**PLACEHOLDER_ENV, **os.environ}
+    # 服务目录自身 (main.py 所在处) + backend (共享的 common 包)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [BACKEND, env.get("PYTHONPATH")]))
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    return env
+
+
+def run(service: str, args: list) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *args], cwd=os.path.join(BACKEND, service), env=service_env(),
+        capture_output=True, text=True, check=True,
+    )
+
+
+def measure(service: str, runs: int) -> list:
+    return [float(run(service, ["-c", TIMER]).stdout.strip().splitlines()[-1]) * 1000 for _ in range(runs)]
+
+
+def top_imports(service: str, n: int) -> list:
+    """
+    解析 -X importtime 输出 ("import time: self | cumulative | name")，取 main 的直接依赖按累计耗时排序
+    """
+    stderr = run(service, ["-X", "importtime", "-c", "import main"]).stderr
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue  # 表头
+        # 每层嵌套缩进 2 个空格；main 为第 0 层，其直接依赖为第 1 层
+        if len(name) - len(name.lstrip(" ")) == 3:
+            entries.append((name.strip(), int(cumulative) / 1000))
+    return [{"module": m, "cumulative_ms": round(ms, 1)} for m, ms in sorted(entries, key=lambda e: -e[1])[:n]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="各服务 import main 的冷启动耗时")
+    parser.add_argument("--services", nargs="+", default=SERVICES)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5, help="列出最耗时的直接依赖个数，0 表示不统计")
+    args = parser.parse_args()
+
+    report = []
+    for service in args.services:
+        try:
+            samples = measure(service, args.runs)
+        except subprocess.CalledProcessError as e:
+            report.append({"service": service, "error": e.stderr.strip().splitlines()[-1]})
+            continue
+        entry = {
+            "service": service,
+            "median_ms": round(statistics.median(samples), 1),
+            "min_ms": round(min(samples), 1),
+            "max_ms": round(max(samples), 1),
+        }
+        if args.top:
+            entry["top_imports"] = top_imports(service, args.top)
+        report.append(entry)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+端到端 RAG 压测工具：通过网关登录并驱动 /api/conversations/chat，输出 JSON 报告。
+
+配合 backend/mock_openai 使用 (OPENAI_BASE_URL 指向替身服务) 即可在不消耗真实 API 的情况下压测
+gateway -> llm_service -> kb_service 全链路。
+
+注意：网关的聊天接口有限流，压测前请调高限流阈值，否则大部分请求会返回 429。
+
+示例：
+    python tools/loadgen.py --base-url http://localhost:8000 --users 20 --concurrency 20 --duration 60
+    python tools/loadgen.py --rps 5 --requests 500 --output report.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import time
+from typing import List, Optional
+
+import httpx
+
+DEFAULT_QUERIES = os.path.join(os.path.dirname(__file__), "..", "backend", "kb_service", "data.json")
+
+
+def load_queries(path: str) -> List[str]:
+    """
+    读取压测问题：data.json 格式取 similar_questions，或每行一个问题的纯文本文件
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".json"):
+            return [q for item in json.load(f) for q in item.get("similar_questions", [])]
+        return [line.strip() for line in f if line.strip()]
+
+
+def percentiles(values: List[float]) -> Optional[dict]:
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pick(p):
+        return round(values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000, 1)
+
+    return {
+        "p50_ms": pick(50), "p90_ms": pick(90), "p95_ms": pick(95), "p99_ms": pick(99),
+        "mean_ms": round(statistics.fmean(values) * 1000, 1), "count": len(values),
+    }
+
+
+class Stats:
+    def __init__(self):
+        self.ttft: List[float] = []
+        self.itl: List[float] = []
+        self.total: List[float] = []
+        self.output_bytes = 0
+        self.errors = {}
+        self.completed = 0
+
+    def error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+async def login(client: httpx.AsyncClient, username: str, password: str) -> str:
+    await client.post("/api/auth/register", json={"username": username, "password": password})  # 已存在时忽略
+    resp = await client.post("/api/auth/token", json={"username": username, "password": password})
+    resp.raise_for_status()
+    return resp.json()["access_token"]
+
+
+async def chat_once(client: httpx.AsyncClient, token: str, query: str, stats: Stats):
+    start = time.perf_counter()
+    last = None
+    try:
+        async with client.stream(
+                "POST", "/api/conversations/chat",
+                json={"query": query},
+                headers={"Authorization": f"Bearer {token}"},
+        ) as resp:
+            if resp.status_code != 200:
+                stats.error(f"http_{resp.status_code}")
+                await resp.aread()
+                return
+            async for chunk in resp.aiter_bytes():
+                now = time.perf_counter()
+                if not chunk.strip() or chunk.startswith(b":"):  # 跳过 SSE 保活注释
+                    continue
+                if last is None:
+                    stats.ttft.append(now - start)
+                    # 网关/服务内部错误：旧版为 "Error:" 文本，SSE 版为 error 事件
+                    if chunk.startswith(b"Error:") or b"event: error" in chunk:
+                        stats.error("upstream")
+                        return
+                else:
+                    stats.itl.append(now - last)
+                last = now
+                stats.output_bytes += len(chunk)
+        if last is None:
+            stats.error("empty_response")
+            return
+        stats.total.append(time.perf_counter() - start)
+        stats.completed += 1
+    except httpx.HTTPError as e:
+        stats.error(type(e).__name__)
+
+
+async def run(args):
+    queries = load_queries(args.queries)
+    stats = Stats()
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        tokens = await asyncio.gather(*(
+            login(client, f"{args.user_prefix}{i}", args.password) for i in range(args.users)
+        ))
+        print(f"🔑 已登录 {len(tokens)} 个压测用户")
+
+        deadline = time.perf_counter() + args.duration if args.duration else None
+        budget = {"left": args.requests}
+
+        def next_request() -> bool:
+            if deadline is not None and time.perf_counter() >= deadline:
+                return False
+            if budget["left"] is not None:
+                if budget["left"] <= 0:
+                    return False
+                budget["left"] -= 1
+            return True
+
+        started = time.perf_counter()
+        if args.rps:
+            # 开环：按固定速率发起请求，并发上限为 concurrency
+            semaphore = asyncio.Semaphore(args.concurrency)
+            pending = set()
+
+            async def fire(i):
+                async with semaphore:
+                    await chat_once(client, tokens[i % len(tokens)], random.choice(queries), stats)
+
+            i = 0
+            while next_request():
+                task = asyncio.create_task(fire(i))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                i += 1
+                await asyncio.sleep(1.0 / args.rps)
+            if pending:
+                await asyncio.gather(*pending)
+        else:
+            # 闭环：concurrency 个虚拟用户循环发送
+            async def worker(i):
+                while next_request():
+                    await chat_once(client, tokens[i % len(tokens)], random.choice(queries), stats)
+
+            await asyncio.gather(*(worker(i) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    attempted = stats.completed + sum(stats.errors.values())
+    return {
+        "config": {
+            "base_url": args.base_url, "concurrency": args.concurrency, "rps": args.rps,
+            "users": args.users, "duration": args.duration, "requests": args.requests,
+        },
+        "elapsed_s": round(elapsed, 2),
+        "requests": attempted,
+        "completed": stats.completed,
+        "throughput_rps": round(stats.completed / elapsed, 2) if elapsed else None,
+        "error_rate": round(sum(stats.errors.values()) / attempted, 4) if attempted else None,
+        "errors": stats.errors,
+        "ttft": percentiles(stats.ttft),
+        "inter_token_latency": percentiles(stats.itl),
+        "total_latency": percentiles(stats.total),
+        "output_bytes": stats.output_bytes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG 全链路压测 (TTFT / 逐 token 延迟 / 总延迟 / 错误率)")
+    parser.add_argument("--base-url", default="http://localhost:8000", help="网关地址")
+    parser.add_argument("--users", type=int, default=10, help="压测用户数 (自动注册)")
+    parser.add_argument("--user-prefix", default="loadtest_user_")
+    parser.add_argument("--password", default="loadtest_password")
+    parser.add_argument("--concurrency", type=int, default=10, help="并发数 (闭环模式下的虚拟用户数)")
+    parser.add_argument("--rps", type=float, default=None, help="开环模式：目标每秒请求数")
+    parser.add_argument("--duration", type=float, default=None, help="压测时长 (秒)")
+    parser.add_argument("--requests", type=int, default=None, help="总请求数")
+    parser.add_argument("--queries", default=DEFAULT_QUERIES, help="问题集 (data.json 或每行一个问题)")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--output", default=None, help="报告输出路径 (默认打印到标准输出)")
+    args = parser.parse_args()
+    if args.duration is None and args.requests is None:
+        args.requests = 100
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()